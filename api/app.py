@@ -1,8 +1,143 @@
 import streamlit as st
 import requests
+import hashlib
 import io
+import os
+import time
+from core.artifacts import ArtifactStore, EncodeOptions, encode_image
+from core.color_distance import DISTANCE_METRICS
+from core.dither import DITHER_METHODS
 from core.palette import mardPalette
-from core.hanlde_image import create_image_from_bytes, resize_image, split_image_into_tiles, preview_tiles
+from core.hanlde_image import decode_image_from_bytes, resize_image, split_image_into_tiles, preview_tiles
+from core.instrument import Profile
+from core.jobs import JobQueue, JobSpec, QueueFullError
+from core.tile_grid import TileGrid
+
+PREVIEW_TILE_SIZE = (50, 50)
+PREVIEW_ENCODING = EncodeOptions.from_env()
+# 目标像素数或上传大小超过这些值的任务交给后台进程池（JobQueue），页面轮询状态，不阻塞会话
+LARGE_JOB_PIXELS = int(os.environ.get('PIXEL_ART_APP_JOB_PIXELS', 1_000_000))
+LARGE_JOB_BYTES = int(os.environ.get('PIXEL_ART_APP_JOB_BYTES', 8 * 1024 ** 2))
+JOB_POLL_SECONDS = 0.5
+# 设置 PIXEL_ART_TRACE_MEMORY=1 后性能面板会显示每个阶段的 tracemalloc 峰值（会拖慢处理）
+TRACE_MEMORY = os.environ.get('PIXEL_ART_TRACE_MEMORY', '') not in ('', '0')
+
+
+# 色板和查找表在所有会话间共享，只构建一次
+@st.cache_resource
+def load_palette():
+    mardPalette.build_lut('exact')
+    return mardPalette
+
+
+# 设置 PIXEL_ART_ARTIFACT_DIR 后，预览图在后台按内容哈希保存
+@st.cache_resource
+def artifact_store():
+    directory = os.environ.get('PIXEL_ART_ARTIFACT_DIR')
+    return ArtifactStore(directory) if directory else None
+
+
+# 以下每个阶段按上传内容哈希和各自的参数缓存；以 "_" 开头的参数不参与缓存键计算。
+# 缓存未命中时会调用上一个阶段，上一个阶段的参数未变化就直接命中缓存。
+@st.cache_data(max_entries=16, show_spinner=False)
+def decode_stage(image_hash, _image_data, target_size):
+    # 返回 (图像, 格式, IngestReport)，报告显示在性能面板里
+    return decode_image_from_bytes(io.BytesIO(_image_data), target_size)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def resize_stage(image_hash, _image_data, target_size):
+    image, _, _ = decode_stage(image_hash, _image_data, target_size)
+    return resize_image(image, target_size)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def tiles_stage(image_hash, _image_data, target_size, tile_shape, palette_hash, metric, dither):
+    resized_image = resize_stage(image_hash, _image_data, target_size)
+    tiles, _, _ = split_image_into_tiles(resized_image, tile_shape, load_palette(), metric=metric, dither=dither)
+    return tiles.indices
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def preview_stage(image_hash, _image_data, target_size, tile_shape, palette_hash, metric, dither, preview_tile_size,
+                  encoding):
+    # 预览图在内存中编码，每个会话拿到自己的字节，不再写共享的 preview.png
+    tiles = TileGrid(tiles_stage(image_hash, _image_data, target_size, tile_shape, palette_hash, metric, dither),
+                     load_palette())
+    preview_image = preview_tiles(tiles, tiles.shape, preview_tile_size, load_palette())
+    return encode_image(preview_image, encoding)
+
+
+# 所有会话共用一个任务队列（进程池大小等见 JobQueue.from_env）
+@st.cache_resource
+def job_queue():
+    return JobQueue.from_env()
+
+
+def is_large_job(image_data: bytes, target_size) -> bool:
+    return target_size[0] * target_size[1] >= LARGE_JOB_PIXELS or len(image_data) >= LARGE_JOB_BYTES
+
+
+def run_inline(image_hash, image_data, params, color_palette):
+    """在当前会话中按阶段运行（各阶段有缓存），返回 (缩放图, 色块网格, 预览图字节, 性能记录)"""
+    stage_args = (image_hash, image_data, params['target_size'])
+    tile_args = stage_args + (params['tile_shape'], color_palette.palette_hash, params['metric'], params['dither'])
+
+    # 只记录本次重跑实际执行的阶段，命中缓存的阶段不会出现
+    with Profile(trace_memory=TRACE_MEMORY) as profile:
+        resized_image = resize_stage(*stage_args)
+        tiles = TileGrid(tiles_stage(*tile_args), color_palette)
+        preview_bytes = preview_stage(*tile_args, PREVIEW_TILE_SIZE, PREVIEW_ENCODING)
+    # 解码阶段已缓存，这里只取出当初解码的记录
+    ingest_report = decode_stage(*stage_args)[2]
+    return resized_image, tiles, preview_bytes, {**profile.as_dict(), 'ingest': ingest_report.as_dict()}
+
+
+def run_as_job(image_hash, image_data, params, color_palette):
+    """
+    提交到 JobQueue 并轮询状态：任务未结束时显示进度，稍等后 st.rerun() 重跑页面（不会返回）；
+    完成后返回与 run_inline 相同的结果（没有缩放图）
+    """
+    queue = job_queue()
+    job_key = (image_hash, tuple(sorted(params.items())))
+    if st.session_state.get('job_key') != job_key:
+        spec = JobSpec(params['target_size'], params['tile_shape'], metric=params['metric'], dither=params['dither'],
+                       preview_tile_size=PREVIEW_TILE_SIZE, preview_format=PREVIEW_ENCODING.format)
+        st.session_state['job_id'] = queue.submit(image_data, spec)
+        st.session_state['job_key'] = job_key
+
+    try:
+        status = queue.status(st.session_state['job_id'])
+    except KeyError:
+        # 任务记录已过期，下次重跑重新提交
+        st.session_state.pop('job_key', None)
+        st.rerun()
+    if status['state'] == 'failed':
+        st.session_state.pop('job_key', None)
+        raise ValueError(status['error'])
+    if status['state'] != 'done':
+        with st.status(f"Job {status['state']}" + (f": {status['stage']}" if status['stage'] else ""),
+                       state='running'):
+            st.write(f"Stages: {', '.join(status['stages']) or 'waiting for a worker'}")
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+
+    output = queue.result(st.session_state['job_id'])
+    if output is None:
+        # 结果已被缓存淘汰，重新提交
+        st.session_state.pop('job_key', None)
+        st.rerun()
+    return None, TileGrid(output.indices, color_palette), output.preview, output.profile
+
+
+def upload_hash(image_file) -> str:
+    """上传文件的内容哈希，同一个上传只计算一次"""
+    upload_id = getattr(image_file, 'file_id', None) or (image_file.name, image_file.size)
+    if st.session_state.get('upload_id') != upload_id:
+        st.session_state['upload_id'] = upload_id
+        st.session_state['upload_hash'] = hashlib.sha256(image_file.getvalue()).hexdigest()
+    return st.session_state['upload_hash']
+
 
 # Streamlit 页面标题
 st.title("Image Tile Generator")
@@ -19,44 +154,80 @@ tile_size_height = st.number_input("Tile Size Height", min_value=1, value=50)
 # 选择调色板
 palette = st.selectbox("Select Palette", options=["Palette 1", "Palette 2"])  # 示例调色板
 
-# 提交按钮
+# 颜色匹配公式：redmean 最快，ciede2000 对肤色和浅色更准确
+metric = st.selectbox("Color Matching", options=list(DISTANCE_METRICS))
+
+# 抖动：渐变较多的图片用误差扩散可以减少色带
+dither = st.selectbox("Dithering", options=list(DITHER_METHODS))
+
+# 提交按钮：记录本次生成的参数，之后的重跑（例如调整其他控件）继续展示这次的结果
 if st.button("Generate Tiles"):
     if image_file is not None:
-        try:
-            # 读取图像数据
-            image_data = image_file.getvalue()
-            if image_data:  # Check if image_data is valid
-                image, image_format = create_image_from_bytes(io.BytesIO(image_data))
-                resized_image = resize_image(image, (target_size_width, target_size_height))
-                
-                tiles, tile_image, color_counts = split_image_into_tiles(resized_image, 
-                                                                         (target_size_width // tile_size_width, target_size_height // tile_size_height), 
-                                                                         mardPalette)
-                preview_image = preview_tiles(tiles, 
-                                              (tile_size_width, tile_size_height), 
-                                              (50, 50), 
-                                              mardPalette)
-                preview_image.save("preview.png")
-
-                # 显示结果
-                st.image(resized_image, caption="Resized Image" )
-                st.image(preview_image, caption="Preview Image")
-                st.success("Tiles generated successfully!")
-
-                # 显示颜色统计信息
-                st.subheader("Color Counts")
-                sorted_color_counts = sorted(color_counts.items(), key=lambda item: item[1], reverse=True)
-                
-                # 使用表格展示颜色统计信息
-                color_table = "| Color Example | Color | Count |\n|---------------|-------|-------|\n"
-                for color, count in sorted_color_counts:
-                    color_table += f"| <div style='width: 20px; height: 20px; background-color: #{mardPalette.get_hex_from_name(color)};'></div> | {color} | {count} |\n"
-                
-                st.markdown(color_table, unsafe_allow_html=True)
-
-            else:
-                st.error("Invalid image data.")
-        except ValueError as e:
-            st.error(f"Failed to create image from bytes: {e}")
+        st.session_state['generate_params'] = {
+            'target_size': (int(target_size_width), int(target_size_height)),
+            'tile_shape': (int(target_size_width // tile_size_width), int(target_size_height // tile_size_height)),
+            'metric': metric,
+            'dither': dither,
+        }
     else:
-        st.error("Please upload an image.")
\ No newline at end of file
+        st.session_state.pop('generate_params', None)
+        st.error("Please upload an image.")
+
+params = st.session_state.get('generate_params')
+if params is not None and image_file is not None:
+    try:
+        # 读取图像数据
+        image_data = image_file.getvalue()
+        if image_data:  # Check if image_data is valid
+            color_palette = load_palette()
+            image_hash = upload_hash(image_file)
+            run = run_as_job if is_large_job(image_data, params['target_size']) else run_inline
+            resized_image, tiles, preview_bytes, timings = run(image_hash, image_data, params, color_palette)
+            color_counts = tiles.counts
+
+            store = artifact_store()
+            if store is not None:
+                store.put_async(preview_bytes, PREVIEW_ENCODING.extension)
+
+            # 显示结果
+            if resized_image is not None:
+                st.image(resized_image, caption="Resized Image" )
+            st.image(preview_bytes, caption="Preview Image")
+            st.download_button("Download Preview", preview_bytes,
+                               file_name=f"preview.{PREVIEW_ENCODING.extension}", mime=PREVIEW_ENCODING.mime_type)
+            st.success("Tiles generated successfully!")
+
+            # 显示颜色统计信息
+            st.subheader("Color Counts")
+            sorted_color_counts = sorted(color_counts.items(), key=lambda item: item[1], reverse=True)
+
+            # 使用表格展示颜色统计信息
+            color_table = "| Color Example | Color | Count |\n|---------------|-------|-------|\n"
+            for color, count in sorted_color_counts:
+                color_table += f"| <div style='width: 20px; height: 20px; background-color: #{color_palette.get_hex_from_name(color)};'></div> | {color} | {count} |\n"
+
+            st.markdown(color_table, unsafe_allow_html=True)
+
+            with st.expander("Performance"):
+                if timings['stages']:
+                    st.table(timings['stages'])
+                    st.caption(f"wall {timings['wall_seconds'] * 1000:.1f} ms, cpu {timings['cpu_seconds'] * 1000:.1f} ms, "
+                               f"peak RSS {timings['peak_rss_bytes'] / 1024 ** 2:.0f} MiB")
+                else:
+                    st.caption("All stages were served from the cache.")
+                ingest_report = timings.get('ingest')
+                if ingest_report:
+                    source_width, source_height = ingest_report['source_size']
+                    decoded_width, decoded_height = ingest_report['decoded_size']
+                    st.caption(f"decoded {ingest_report['format']} {source_width}x{source_height}"
+                               f" -> {decoded_width}x{decoded_height} (1/{ingest_report['reduction']}),"
+                               f" {ingest_report['actual_bytes'] / 1024 ** 2:.1f} MiB"
+                               + (", over the decode budget" if ingest_report['budget_exceeded'] else ""))
+                    st.json(ingest_report, expanded=False)
+
+        else:
+            st.error("Invalid image data.")
+    except QueueFullError as e:
+        st.error(f"The server is busy, try again shortly: {e}")
+    except ValueError as e:
+        st.error(f"Failed to create image from bytes: {e}")
@@ -0,0 +1,14 @@
+# gunicorn -c api/gunicorn.conf.py api.rest:app
+import multiprocessing
+import os
+
+bind = os.environ.get('PIXEL_ART_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('PIXEL_ART_WORKERS', multiprocessing.cpu_count()))
+# 在 master 中导入应用（加载色板查找表）后再 fork，worker 之间共享这部分内存
+preload_app = True
+timeout = int(os.environ.get('PIXEL_ART_TIMEOUT', 120))
+max_requests = int(os.environ.get('PIXEL_ART_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+# 回收 worker 时给它的任务进程池留出跑完当前任务的时间；仍被强制结束的任务在 JobStore 中记为失败
+graceful_timeout = timeout
+# 异步任务的进程池：PIXEL_ART_JOB_PROCESSES（默认 CPU 数）是所有 worker 合计的上限，见 JobQueue.from_env
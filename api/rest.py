@@ -0,0 +1,260 @@
+"""
+Headless HTTP API for pattern generation.
+
+Dev run:
+    export PYTHONPATH=`pwd`
+    flask --app api.rest run
+
+Prod run (pre-forked workers, palette lookup tables loaded once before forking):
+    gunicorn -c api/gunicorn.conf.py api.rest:app
+"""
+import os
+import threading
+from typing import Optional
+
+from flask import Flask, Response, request
+from flask_cors import CORS
+from flask_restx import Api, Namespace, Resource, inputs, reqparse
+
+from core.artifacts import EncodeOptions, encode_image
+from core.block_reduce import TILE_REDUCERS
+from core.color_distance import DISTANCE_METRICS
+from core.dither import DITHER_METHODS
+from core.hanlde_image import ColorPalette
+from core.ingest import IngestLimits
+from core.instrument import MetricsRegistry, Profile, default_metrics
+from core.jobs import JobQueue, JobSpec, QueueFullError
+from core.palette import PALETTES, build_luts, lut_metrics_from_env
+from core.pipeline import run_pipeline
+from core.tile_grid import TileGrid
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def init_palettes(lut_mode: str = os.environ.get('PIXEL_ART_LUT_MODE', 'exact')) -> None:
+    """构建（或从磁盘缓存加载）所有色板的查找表；在 fork 之前调用时各 worker 共享同一份内存"""
+    build_luts(lut_mode, lut_metrics_from_env())
+
+
+pattern_args = reqparse.RequestParser()
+pattern_args.add_argument('width', type=inputs.positive, required=True, location='args',
+                          help="Target width the image is resized to")
+pattern_args.add_argument('height', type=inputs.positive, required=True, location='args',
+                          help="Target height the image is resized to")
+pattern_args.add_argument('tile_width', type=inputs.positive, default=1, location='args',
+                          help="Tile width in pixels of the resized image")
+pattern_args.add_argument('tile_height', type=inputs.positive, default=1, location='args',
+                          help="Tile height in pixels of the resized image")
+pattern_args.add_argument('palette', choices=tuple(PALETTES), default='mard', location='args')
+pattern_args.add_argument('reducer', choices=tuple(TILE_REDUCERS), default='mode', location='args')
+pattern_args.add_argument('metric', choices=tuple(DISTANCE_METRICS), default='redmean', location='args',
+                          help="Color distance used to match tiles to the palette")
+pattern_args.add_argument('dither', choices=DITHER_METHODS, default='none', location='args',
+                          help="Dithering applied while matching tiles to the palette (not with palette_vote)")
+pattern_args.add_argument('format', choices=('json', 'png', 'webp'), default='json', location='args',
+                          help="json returns the index grid, png/webp stream the labeled preview")
+pattern_args.add_argument('cell_width', type=inputs.positive, default=50, location='args',
+                          help="Width of one tile in the preview")
+pattern_args.add_argument('cell_height', type=inputs.positive, default=50, location='args',
+                          help="Height of one tile in the preview")
+
+ns = Namespace('patterns', description="Bead pattern generation")
+
+
+def check_size_limits(namespace: Namespace, args: dict) -> None:
+    """请求的目标尺寸或预览尺寸超出内存预算时返回 400，在解码和分配之前拒绝"""
+    preview_tile_size = (args['cell_width'], args['cell_height'])
+    try:
+        IngestLimits.from_env().check_output_size((args['width'], args['height']),
+                                                  (args['tile_width'], args['tile_height']),
+                                                  preview_tile_size if args['format'] != 'json' else None)
+    except ValueError as e:
+        namespace.abort(400, str(e))
+
+
+def read_upload() -> bytes:
+    """读取上传的图像：multipart 的 image 字段，或者整个请求体"""
+    if 'image' in request.files:
+        return request.files['image'].read()
+    return request.get_data(cache=False)
+
+
+def stream_bytes(data: bytes, mimetype: str, headers: Optional[dict] = None) -> Response:
+    def chunks():
+        for start in range(0, len(data), STREAM_CHUNK_SIZE):
+            yield data[start:start + STREAM_CHUNK_SIZE]
+    return Response(chunks(), mimetype=mimetype, headers={'Content-Length': str(len(data)), **(headers or {})})
+
+
+def server_timing(profile: dict) -> str:
+    """Server-Timing 响应头，浏览器开发者工具可以直接展示各阶段耗时"""
+    return ", ".join(f"{record['name']};dur={record['wall_seconds'] * 1000:.2f}" for record in profile['stages'])
+
+
+def grid_payload(tiles, color_palette: ColorPalette) -> dict:
+    columns, rows = tiles.shape
+    return {
+        'columns': columns,
+        'rows': rows,
+        'palette_hash': color_palette.palette_hash,
+        'palette': [{'name': color.name, 'color': color.color_hex} for color in color_palette.colors],
+        'indices': tiles.indices.tolist(),
+        'counts': tiles.counts,
+    }
+
+
+@ns.route('')
+class Patterns(Resource):
+    @ns.expect(pattern_args)
+    def post(self):
+        """Convert an uploaded image (multipart field 'image' or raw body) into a pattern"""
+        args = pattern_args.parse_args()
+        check_size_limits(ns, args)
+        image_data = read_upload()
+        if not image_data:
+            ns.abort(400, "No image uploaded")
+
+        color_palette = PALETTES[args['palette']]
+        profile = Profile()
+        try:
+            with profile:
+                result = run_pipeline(image_data,
+                                      (args['width'], args['height']),
+                                      (args['tile_width'], args['tile_height']),
+                                      color_palette,
+                                      reducer=args['reducer'],
+                                      metric=args['metric'],
+                                      dither=args['dither'],
+                                      preview_tile_size=(args['cell_width'], args['cell_height']),
+                                      with_preview=args['format'] != 'json',
+                                      profile=profile)
+                if args['format'] != 'json':
+                    options = EncodeOptions(format=args['format'].upper())
+                    preview = encode_image(result.preview_image, options)
+        except ValueError as e:
+            ns.abort(400, str(e))
+        timings = profile.as_dict()
+        default_metrics.observe(timings)
+
+        headers = {'Server-Timing': server_timing(timings)}
+        if args['format'] == 'json':
+            profile_payload = {**timings, 'ingest': result.ingest.as_dict() if result.ingest else None}
+            return {**grid_payload(result.tiles, color_palette), 'profile': profile_payload}, 200, headers
+        return stream_bytes(preview, options.mime_type, headers)
+
+
+jobs_ns = Namespace('jobs', description="Asynchronous pattern jobs for large inputs")
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    每个 HTTP worker 进程在第一次用到时创建自己的队列（不在 fork 之前创建）。
+    进程池大小按 PIXEL_ART_JOB_PROCESSES 在各 worker 间平分，任务状态和结果经 JobStore 共享，
+    轮询可以落到任意一个 worker 上
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue.from_env()
+        return _job_queue
+
+
+@jobs_ns.route('')
+class Jobs(Resource):
+    @jobs_ns.expect(pattern_args)
+    def post(self):
+        """Queue a pattern job; poll /api/jobs/<id> for progress"""
+        args = pattern_args.parse_args()
+        check_size_limits(jobs_ns, args)
+        image_data = read_upload()
+        if not image_data:
+            jobs_ns.abort(400, "No image uploaded")
+
+        spec = JobSpec(target_size=(args['width'], args['height']),
+                       tile_shape=(args['tile_width'], args['tile_height']),
+                       palette=args['palette'],
+                       reducer=args['reducer'],
+                       metric=args['metric'],
+                       dither=args['dither'],
+                       preview_tile_size=(args['cell_width'], args['cell_height']),
+                       with_preview=args['format'] != 'json',
+                       preview_format='PNG' if args['format'] == 'json' else args['format'].upper())
+        try:
+            job_id = get_job_queue().submit(image_data, spec)
+        except QueueFullError as e:
+            jobs_ns.abort(429, str(e))
+        return {'id': job_id, 'status_url': f"/api/jobs/{job_id}"}, 202
+
+
+@jobs_ns.route('/<string:job_id>')
+class JobStatus(Resource):
+    def get(self, job_id):
+        """State and current pipeline stage of a job"""
+        try:
+            return get_job_queue().status(job_id)
+        except KeyError:
+            jobs_ns.abort(404, f"Unknown job {job_id}")
+
+
+result_args = reqparse.RequestParser()
+result_args.add_argument('format', choices=('json', 'preview'), default='json', location='args')
+
+
+@jobs_ns.route('/<string:job_id>/result')
+class JobResult(Resource):
+    @jobs_ns.expect(result_args)
+    def get(self, job_id):
+        """Index grid (format=json) or preview image (format=preview) of a finished job"""
+        args = result_args.parse_args()
+        job_queue = get_job_queue()
+        try:
+            status = job_queue.status(job_id)
+            output = job_queue.result(job_id)
+        except KeyError:
+            jobs_ns.abort(404, f"Unknown job {job_id}")
+        if status['state'] != 'done':
+            jobs_ns.abort(409, f"Job {job_id} is {status['state']}")
+        if output is None:
+            jobs_ns.abort(410, f"Result of job {job_id} has been evicted from the cache")
+
+        if args['format'] == 'json':
+            color_palette = PALETTES[status['spec']['palette']]
+            return grid_payload(TileGrid(output.indices, color_palette), color_palette)
+        if output.preview is None:
+            jobs_ns.abort(404, f"Job {job_id} was submitted without a preview")
+        return stream_bytes(output.preview, EncodeOptions(format=output.preview_format).mime_type)
+
+
+health_ns = Namespace('health', description="Liveness check")
+
+
+@health_ns.route('')
+class Health(Resource):
+    def get(self):
+        return {'status': 'ok', 'palettes': {name: sorted(p.luts) for name, p in PALETTES.items()}}
+
+
+def create_app(metrics: MetricsRegistry = default_metrics) -> Flask:
+    init_palettes()
+    app = Flask(__name__)
+    CORS(app)
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        """Prometheus text exposition of per-stage timings (this worker process only)"""
+        return Response(metrics.render(), content_type=MetricsRegistry.CONTENT_TYPE)
+
+    api = Api(app, title="Pixel Art API", prefix='/api', doc='/api/docs')
+    api.add_namespace(ns, path='/patterns')
+    api.add_namespace(jobs_ns, path='/jobs')
+    api.add_namespace(health_ns, path='/health')
+    return app
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
@@ -0,0 +1,283 @@
+"""
+Bead patterns for every frame of an animated GIF or APNG.
+
+Usage:
+    python -m core.animation input.gif --out patterns/input --size 100 100 --tile 2 2
+
+Writes <out>.preview.gif (or .png with --apng), an animation of the pattern previews,
+and <out>.grids.npy, the index grids of all frames stacked into (frames, rows, columns).
+"""
+import argparse
+import io
+import os
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from .block_reduce import ReducerName, image_to_array, reduce_tiles, tile_blocks
+from .color_distance import DistanceMetric
+from .hanlde_image import HEIGHT, WIDTH, ColorPalette, preview_tiles, resize_image
+from .ingest import IngestLimits
+from .instrument import stage
+from .palette import PALETTES, build_luts
+from .pipeline import PREVIEW_TILE_SIZE
+from .tile_grid import TileGrid
+
+# 帧数上限，防止超长动画占满内存和工作进程
+MAX_FRAMES = 1000
+# 文件没有写明帧时长时使用的时长（毫秒）
+DEFAULT_FRAME_DURATION = 100
+# 每个任务处理的连续帧数：块内的帧复用上一帧未变化的色块，块的第一帧完整计算
+CHUNK_FRAMES = 16
+
+
+@dataclass
+class AnimationResult:
+    """Patterns of all frames of an animation."""
+    frames: List[TileGrid]
+    # 每帧显示的毫秒数
+    durations: List[int]
+    # 循环次数，0 表示无限循环
+    loop: int
+    # 沿用上一帧结果、没有重新归约的色块数
+    reused_tiles: int = 0
+
+    @property
+    def total_tiles(self) -> int:
+        return sum(len(frame) for frame in self.frames)
+
+    def stacked_indices(self) -> np.ndarray:
+        """所有帧的索引网格，形状为 (帧数, 行数, 列数)"""
+        if not self.frames:
+            return np.zeros((0, 0, 0), dtype=np.uint8)
+        return np.stack([frame.indices for frame in self.frames])
+
+
+def iter_frames(image_stream, limits: Optional[IngestLimits] = None) -> Iterator[Tuple[Image.Image, int]]:
+    """
+    Decode the frames of an animation one at a time.
+
+    Pillow composites every frame onto the previous ones (GIF disposal, APNG blending),
+    so each yielded frame is the full picture as displayed. Still images yield one frame.
+
+    :param image_stream: Byte stream of the image
+    :param limits: Memory budget for one decoded frame, IngestLimits.from_env() by default
+    :return: Iterator of (RGB or RGBA frame, duration in milliseconds)
+    """
+    limits = limits or IngestLimits.from_env()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        image = Image.open(image_stream)
+    num_frames = getattr(image, 'n_frames', 1)
+    if num_frames > MAX_FRAMES:
+        raise ValueError(f"Animation has {num_frames} frames, at most {MAX_FRAMES} are supported")
+    # 动画帧无法降分辨率解码，超出预算直接拒绝
+    if image.width * image.height > min(limits.max_pixels, limits.max_decoded_bytes // 4):
+        raise ValueError(f"Animation frames of {image.width}x{image.height} pixels exceed the decode budget")
+
+    for frame in ImageSequence.Iterator(image):
+        with stage('decode', pixels=frame.width * frame.height):
+            has_alpha = 'transparency' in frame.info or frame.mode in ('RGBA', 'LA', 'PA')
+            decoded = frame.convert('RGBA' if has_alpha else 'RGB')
+        yield decoded, int(frame.info.get('duration') or DEFAULT_FRAME_DURATION)
+
+
+def reduce_frames(frames: List[np.ndarray], tile_shape: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette,
+                  reducer: ReducerName = 'mode', metric: DistanceMetric = 'redmean') -> Tuple[List[np.ndarray], int]:
+    """
+    Reduce consecutive resized frames to palette indices, reusing unchanged tiles.
+
+    Every tile is reduced from its own pixels only, so a tile whose pixels are the same
+    as in the previous frame gets the same index again. Blocks are compared byte for
+    byte with the previous frame's, and only the changed tiles are reduced and matched;
+    the result is identical to reducing every frame on its own.
+
+    :param frames: Arrays of shape (H, W, C) of the same size, in display order
+    :param tile_shape: Tuple of (width, height) of each tile
+    :param color_palette: The palette to match against
+    :param reducer: Tile reducer, see split_image_into_tiles
+    :param metric: Color distance used for palette matching, see split_image_into_tiles
+    :return: Tuple of (flat index arrays, one per frame, number of reused tiles)
+    """
+    previous_blocks = previous_indices = None
+    results = []
+    reused = 0
+    for pixels in frames:
+        blocks = tile_blocks(pixels, tile_shape)
+        if previous_blocks is None or previous_blocks.shape != blocks.shape:
+            indices = reduce_tiles(blocks, color_palette, reducer, metric)
+        else:
+            changed = (blocks != previous_blocks).reshape(len(blocks), -1).any(axis=1)
+            indices = previous_indices.copy()
+            if changed.any():
+                indices[changed] = reduce_tiles(blocks[changed], color_palette, reducer, metric)
+            reused += len(blocks) - int(np.count_nonzero(changed))
+        results.append(indices)
+        previous_blocks, previous_indices = blocks, indices
+    return results, reused
+
+
+def _reduce_chunk(frames: List[np.ndarray], tile_shape: Tuple[WIDTH, HEIGHT], palette_name: str,
+                  reducer: str, metric: str) -> Tuple[List[np.ndarray], int]:
+    return reduce_frames(frames, tile_shape, PALETTES[palette_name], reducer, metric)
+
+
+def _iter_chunks(image_stream, target_size: Tuple[WIDTH, HEIGHT], chunk_frames: int,
+                 limits: Optional[IngestLimits]) -> Iterator[Tuple[List[np.ndarray], List[int]]]:
+    """逐帧解码并缩放，按 chunk_frames 帧一组产出；只保留缩放后的小图"""
+    chunk, durations = [], []
+    for frame, duration in iter_frames(image_stream, limits):
+        chunk.append(image_to_array(resize_image(frame, target_size)))
+        durations.append(duration)
+        if len(chunk) == chunk_frames:
+            yield chunk, durations
+            chunk, durations = [], []
+    if chunk:
+        yield chunk, durations
+
+
+def process_animation(image_stream, target_size: Tuple[WIDTH, HEIGHT], tile_shape: Tuple[WIDTH, HEIGHT],
+                      palette: str = 'mard', reducer: ReducerName = 'mode', metric: DistanceMetric = 'redmean',
+                      workers: Optional[int] = 1, lut_mode: str = 'none', chunk_frames: int = CHUNK_FRAMES,
+                      limits: Optional[IngestLimits] = None) -> AnimationResult:
+    """
+    Turn every frame of an animation into a tile grid.
+
+    Frames are decoded and resized lazily, grouped into chunks of chunk_frames
+    consecutive frames and reduced with reduce_frames, so tiles that do not change
+    between frames are only matched once per chunk. With workers > 1 the chunks run on
+    a spawned process pool (each worker loads the palette lookup tables once with
+    build_luts, as core.batch and core.jobs do) with at most 2 * workers chunks in flight; chunk results are put
+    back in frame order. Dithering is not supported: it would make every tile depend
+    on its neighbours.
+
+    :param image_stream: Byte stream of the GIF, APNG or still image
+    :param target_size: Tuple of (width, height) every frame is resized to
+    :param tile_shape: Tuple of (width, height) of each tile in the resized frames
+    :param palette: Name of a palette in PALETTES
+    :param reducer: Tile reducer, see split_image_into_tiles
+    :param metric: Color distance used for palette matching, see split_image_into_tiles
+    :param workers: Number of worker processes; None uses every CPU, 1 runs in this process
+    :param lut_mode: Palette lookup table each worker builds, 'none', 'exact' or 'compact'
+    :param chunk_frames: Consecutive frames handled by one task
+    :param limits: Memory budget for one decoded frame
+    :return: AnimationResult with one TileGrid per frame
+    """
+    if chunk_frames < 1:
+        raise ValueError("chunk_frames must be at least 1")
+    image_stream.seek(0)
+    loop = Image.open(image_stream).info.get('loop', 0)
+    image_stream.seek(0)
+    color_palette = PALETTES[palette]
+    num_tiles_x = target_size[0] // tile_shape[0]
+    num_tiles_y = target_size[1] // tile_shape[1]
+    chunks = _iter_chunks(image_stream, target_size, chunk_frames, limits)
+
+    results: List[Tuple[List[np.ndarray], int]] = []
+    durations: List[int] = []
+    if workers == 1:
+        build_luts(lut_mode, (metric,))
+        for frames, chunk_durations in chunks:
+            with stage('tile_reduce', pixels=sum(frame.shape[0] * frame.shape[1] for frame in frames)):
+                results.append(reduce_frames(frames, tile_shape, color_palette, reducer, metric))
+            durations.extend(chunk_durations)
+    else:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=build_luts,
+                                 initargs=(lut_mode, (metric,))) as executor:
+            max_pending = 2 * workers
+            futures = []
+            pending = set()
+            for frames, chunk_durations in chunks:
+                while len(pending) >= max_pending:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(_reduce_chunk, frames, tile_shape, palette, reducer, metric)
+                futures.append(future)
+                pending.add(future)
+                durations.extend(chunk_durations)
+            results = [future.result() for future in futures]
+
+    grids = [TileGrid(indices.reshape(num_tiles_y, num_tiles_x), color_palette)
+             for chunk_indices, _ in results for indices in chunk_indices]
+    return AnimationResult(grids, durations, loop, sum(reused for _, reused in results))
+
+
+def animated_preview(result: AnimationResult, color_palette: ColorPalette, format: str = 'GIF',
+                     tile_image_size: Tuple[WIDTH, HEIGHT] = PREVIEW_TILE_SIZE, show_labels: bool = False) -> bytes:
+    """
+    Encode the frame previews as an animation.
+
+    GIF frames are written as palette images that use the bead palette directly, so
+    colors are exact and Pillow only stores the region that changed between frames;
+    GIF can not hold anti-aliased labels, so show_labels needs 'PNG' (APNG). Palettes
+    of more than 256 colors are quantized by Pillow when written as GIF.
+
+    :param result: Output of process_animation
+    :param color_palette: The palette the grids index into
+    :param format: 'GIF' or 'PNG' (APNG)
+    :param tile_image_size: Size of each tile in the preview
+    :param show_labels: Draw color names on the tiles (APNG only)
+    :return: The encoded animation
+    """
+    if format not in ('GIF', 'PNG'):
+        raise ValueError(f"Unsupported animation format: {format}")
+    if show_labels and format == 'GIF':
+        raise ValueError("Labelled previews need the PNG (APNG) format")
+    if not result.frames:
+        raise ValueError("The animation has no frames")
+
+    scale_x, scale_y = tile_image_size
+    use_palette_images = format == 'GIF' and len(color_palette.colors) <= 256
+    if use_palette_images:
+        gif_palette = color_palette.rgb.astype(np.uint8).ravel().tolist()
+    images = []
+    for tiles in result.frames:
+        if use_palette_images:
+            indices = tiles.indices.astype(np.uint8)
+            rows, columns = indices.shape
+            expanded = np.broadcast_to(indices[:, None, :, None], (rows, scale_y, columns, scale_x))
+            image = Image.fromarray(np.ascontiguousarray(expanded.reshape(rows * scale_y, columns * scale_x)), 'P')
+            image.putpalette(gif_palette)
+        else:
+            image = preview_tiles(tiles, tiles.shape, tile_image_size, color_palette, show_labels=show_labels)
+        images.append(image)
+
+    buffer = io.BytesIO()
+    with stage('encode', pixels=images[0].width * images[0].height * len(images)):
+        images[0].save(buffer, format, save_all=True, append_images=images[1:], duration=result.durations,
+                       loop=result.loop)
+    return buffer.getvalue()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='GIF or APNG file')
+    parser.add_argument('--out', required=True, help='Output path prefix')
+    parser.add_argument('--size', type=int, nargs=2, required=True, metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--tile', type=int, nargs=2, required=True, metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--palette', default='mard', choices=sorted(PALETTES))
+    parser.add_argument('--reducer', default='mode')
+    parser.add_argument('--metric', default='redmean')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes, 0 for one per CPU')
+    parser.add_argument('--lut', default='exact', choices=('none', 'exact', 'compact'))
+    parser.add_argument('--apng', action='store_true', help='Write the preview as APNG with color labels')
+    args = parser.parse_args(argv)
+
+    with open(args.input, 'rb') as f:
+        result = process_animation(f, tuple(args.size), tuple(args.tile), args.palette, args.reducer, args.metric,
+                                   workers=args.workers or None, lut_mode=args.lut)
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    np.save(args.out + '.grids.npy', result.stacked_indices())
+    preview_format = 'PNG' if args.apng else 'GIF'
+    with open(args.out + ('.preview.png' if args.apng else '.preview.gif'), 'wb') as f:
+        f.write(animated_preview(result, PALETTES[args.palette], preview_format, show_labels=args.apng))
+    print(f"{len(result.frames)} frames, {result.total_tiles} tiles, {result.reused_tiles} reused")
+
+
+if __name__ == '__main__':
+    main()
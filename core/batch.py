@@ -0,0 +1,245 @@
+"""
+Convert whole directories of images into bead patterns.
+
+Usage:
+    python -m core.batch "catalog/**/*.jpg" --out patterns --size 100 100 --tile 2 2
+
+For every input the output directory gets <file>.preview.png, <file>.grid.npy (the
+index grid) and <file>.counts.csv, plus <file>.pattern (see core.pattern_io) with
+--pattern. <file> is the input file name with its extension, e.g. a.jpg.preview.png,
+so a.jpg and a.png in the same directory do not overwrite each other. Inputs whose outputs already exist are skipped, so an interrupted run can
+simply be restarted.
+"""
+import argparse
+import csv
+import glob
+import io
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .artifacts import EncodeOptions, encode_image
+from .block_reduce import TILE_REDUCERS
+from .color_distance import DISTANCE_METRICS
+from .dither import DITHER_METHODS
+from .hanlde_image import HEIGHT, WIDTH, preview_tiles
+from .palette import PALETTES, build_luts
+from .pattern_io import save_pattern
+from .pipeline import PREVIEW_TILE_SIZE, run_pipeline
+from .streaming import collect_tile_rows, stream_tile_rows
+
+OUTPUT_SUFFIXES = ('.preview.png', '.grid.npy', '.counts.csv')
+
+
+@dataclass(frozen=True)
+class BatchOptions:
+    target_size: Tuple[WIDTH, HEIGHT]
+    tile_shape: Tuple[WIDTH, HEIGHT]
+    palette: str = 'mard'
+    reducer: str = 'mode'
+    metric: str = 'redmean'
+    dither: str = 'none'
+    preview_tile_size: Tuple[WIDTH, HEIGHT] = PREVIEW_TILE_SIZE
+    png_compress_level: int = 1
+    # 逐条带缩放和归约，不生成完整的缩放图（不支持抖动）
+    stream: bool = False
+    # 额外写出二进制图纸文件时的压缩方式：'none'、'rle' 或 'zlib'，None 表示不写
+    pattern: Optional[str] = None
+
+    @property
+    def output_suffixes(self) -> Tuple[str, ...]:
+        return OUTPUT_SUFFIXES + (('.pattern',) if self.pattern is not None else ())
+
+
+def output_base(out_dir: str, relative_path: str) -> str:
+    """Output path prefix of an input, keeping its sub-directory and its extension (a.jpg -> a.jpg.preview.png)."""
+    return os.path.join(out_dir, relative_path)
+
+
+def is_done(base: str, suffixes: Tuple[str, ...] = OUTPUT_SUFFIXES) -> bool:
+    return all(os.path.exists(base + suffix) for suffix in suffixes)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def convert_one(image_bytes: bytes, base: str, options: BatchOptions) -> int:
+    """
+    Run the pipeline on one image and write its outputs.
+
+    :param image_bytes: Raw bytes of the image
+    :param base: Output path prefix
+    :param options: Conversion parameters
+    :return: Number of tiles in the pattern
+    """
+    color_palette = PALETTES[options.palette]
+    if options.stream:
+        tiles = collect_tile_rows(stream_tile_rows(io.BytesIO(image_bytes), options.target_size, options.tile_shape,
+                                                   color_palette, options.reducer, options.metric), color_palette)
+        preview_image = preview_tiles(tiles, tiles.shape, options.preview_tile_size, color_palette)
+    else:
+        # 每张图只处理一次，不经过结果缓存
+        result = run_pipeline(image_bytes, options.target_size, options.tile_shape, color_palette,
+                              reducer=options.reducer, metric=options.metric, dither=options.dither,
+                              preview_tile_size=options.preview_tile_size, cache=None)
+        tiles, preview_image = result.tiles, result.preview_image
+
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+    buffer = io.BytesIO()
+    np.save(buffer, tiles.indices)
+    _write_atomic(base + '.grid.npy', buffer.getvalue())
+
+    rows = io.StringIO()
+    writer = csv.writer(rows)
+    writer.writerow(['name', 'color', 'count'])
+    for name, count in sorted(tiles.counts.items(), key=lambda item: item[1], reverse=True):
+        writer.writerow([name, color_palette.get_hex_from_name(name), count])
+    _write_atomic(base + '.counts.csv', rows.getvalue().encode('utf-8'))
+
+    if options.pattern is not None:
+        save_pattern(base + '.pattern', tiles, options.tile_shape, options.pattern)
+
+    # 预览图最后写入，它存在即表示这张图已经处理完
+    preview = encode_image(preview_image, EncodeOptions(compress_level=options.png_compress_level))
+    _write_atomic(base + '.preview.png', preview)
+    return len(tiles)
+
+
+def _prefetch(paths: List[Tuple[str, str]], out_dir: str, buffer: 'queue.Queue',
+              suffixes: Tuple[str, ...] = OUTPUT_SUFFIXES) -> None:
+    """后台线程：按顺序读取尚未处理的文件，队列满时阻塞"""
+    for path, relative_path in paths:
+        base = output_base(out_dir, relative_path)
+        if is_done(base, suffixes):
+            buffer.put((path, base, None))
+            continue
+        try:
+            with open(path, 'rb') as f:
+                buffer.put((path, base, f.read()))
+        except OSError as e:
+            buffer.put((path, base, e))
+    buffer.put(None)
+
+
+def expand_inputs(patterns: List[str]) -> List[Tuple[str, str]]:
+    """Expand glob patterns into (path, path relative to the common input directory) pairs."""
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern, recursive=True) if os.path.isfile(path)})
+    if not paths:
+        return []
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    return [(path, os.path.relpath(os.path.abspath(path), root)) for path in paths]
+
+
+def run_batch(patterns: List[str], out_dir: str, options: BatchOptions, workers: Optional[int] = None,
+              prefetch: int = 8, lut_mode: str = 'exact', log=sys.stderr) -> dict:
+    """
+    Convert every image matching the glob patterns.
+
+    Files are read by a background thread into a bounded queue and converted on a
+    process pool; at most `prefetch` images are buffered or in flight at a time.
+
+    :return: Summary with counts of converted, skipped and failed images and throughput
+    """
+    inputs = expand_inputs(patterns)
+    buffer: 'queue.Queue' = queue.Queue(maxsize=prefetch)
+    reader = threading.Thread(target=_prefetch, args=(inputs, out_dir, buffer, options.output_suffixes), daemon=True)
+    reader.start()
+
+    converted = skipped = failed = tiles = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=build_luts,
+                             initargs=(lut_mode, (options.metric,))) as executor:
+        pending = {}
+
+        def collect(done) -> None:
+            nonlocal converted, failed, tiles
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    tiles += future.result()
+                    converted += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"failed: {path}: {e}", file=log)
+
+        for item in iter(buffer.get, None):
+            path, base, data = item
+            if data is None:
+                skipped += 1
+                continue
+            if isinstance(data, Exception):
+                failed += 1
+                print(f"failed: {path}: {data}", file=log)
+                continue
+            while len(pending) >= prefetch:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(convert_one, data, base, options)] = path
+        collect(wait(pending).done)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'converted': converted,
+        'skipped': skipped,
+        'failed': failed,
+        'tiles': tiles,
+        'seconds': elapsed,
+        'images_per_second': converted / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Convert images into bead patterns in bulk")
+    parser.add_argument('inputs', nargs='+', help="Input files or glob patterns (quote them, ** is supported)")
+    parser.add_argument('--out', required=True, help="Output directory")
+    parser.add_argument('--size', type=int, nargs=2, required=True, metavar=('WIDTH', 'HEIGHT'),
+                        help="Size the images are resized to")
+    parser.add_argument('--tile', type=int, nargs=2, default=(1, 1), metavar=('WIDTH', 'HEIGHT'),
+                        help="Tile size in pixels of the resized image")
+    parser.add_argument('--palette', choices=sorted(PALETTES), default='mard')
+    parser.add_argument('--reducer', choices=sorted(TILE_REDUCERS), default='mode')
+    parser.add_argument('--metric', choices=list(DISTANCE_METRICS), default='redmean',
+                        help="Color distance used to match tiles to the palette")
+    parser.add_argument('--dither', choices=DITHER_METHODS, default='none',
+                        help="Dithering applied while matching tiles to the palette (not with palette_vote)")
+    parser.add_argument('--stream', action='store_true',
+                        help="Resize and reduce each image in bands of tile rows instead of all at once "
+                             "(bounded memory for very large --size; no dithering)")
+    parser.add_argument('--cell', type=int, nargs=2, default=(50, 50), metavar=('WIDTH', 'HEIGHT'),
+                        help="Size of one tile in the preview")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--prefetch', type=int, default=8, help="Images buffered or in flight at once")
+    parser.add_argument('--lut', choices=['none', 'exact', 'compact'], default='exact',
+                        help="Palette lookup table each worker loads at startup (built once per metric and "
+                             "cached on disk; the first ciede2000 table takes minutes)")
+    parser.add_argument('--png-compress-level', type=int, default=1)
+    parser.add_argument('--pattern', choices=['none', 'rle', 'zlib'], default=None,
+                        help="Also write <name>.pattern, the index grid in the binary pattern format, "
+                             "with this compression")
+    args = parser.parse_args(argv)
+    if args.stream and args.dither != 'none':
+        parser.error("--dither needs the whole tile grid and can not be combined with --stream")
+
+    options = BatchOptions(tuple(args.size), tuple(args.tile), palette=args.palette, reducer=args.reducer,
+                           metric=args.metric, dither=args.dither, preview_tile_size=tuple(args.cell),
+                           png_compress_level=args.png_compress_level, stream=args.stream, pattern=args.pattern)
+    summary = run_batch(args.inputs, args.out, options, args.workers, max(1, args.prefetch), args.lut)
+    print(f"converted {summary['converted']}, skipped {summary['skipped']}, failed {summary['failed']} "
+          f"in {summary['seconds']:.1f}s ({summary['images_per_second']:.2f} images/sec)")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+Benchmarks for the image pipeline.
+
+Run with:
+    python -m core.benchmark
+    python -m core.benchmark --suite --json bench.json               # full pipeline sweep
+    python -m core.benchmark --suite --json new.json --compare bench.json
+    python -m core.benchmark --crossover                              # palette index vs brute force
+    python -m core.benchmark --dither --lut exact                     # dithering a 300x300 bead grid
+    python -m core.benchmark --stream --size 3000 3000 --tile 1 1 --lut exact  # banded vs whole-image split
+    python -m core.benchmark --pattern-io --size 400 400 --tile 1 1   # stored pattern vs PNG re-quantization
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .block_reduce import TILE_REDUCERS, image_to_array, reduce_tiles, tile_blocks
+from .dither import DITHER_METHODS, dither_colors
+from .hanlde_image import (HEIGHT, WIDTH, ColorPalette, create_image_from_bytes, preview_tiles, resize_image,
+                           split_image_into_tiles)
+from .palette import mardPalette
+from .palette_index import INDEXED_METRICS
+from .parallel import reduce_tiles_parallel
+from .pattern_io import load_pattern, save_pattern
+from .streaming import collect_tile_rows, iter_tile_rows
+
+SAMPLE_IMAGES = ['test.jpg', 'test2.jpg', 'test3.webp']
+
+# 流水线基准的扫描参数：合成图的原始尺寸、缩放目标尺寸、块大小、预览中每块的尺寸
+SUITE_SOURCE_SIZES = [(640, 480), (1920, 1080)]
+SUITE_TARGET_SIZES = [(100, 100), (400, 400)]
+SUITE_TILE_SHAPES = [(1, 1), (4, 4)]
+SUITE_PREVIEW_TILE_SIZES = [(20, 20), (50, 50)]
+# closest_color 单次调用太快，每次计时调用这么多次
+CLOSEST_COLOR_CALLS = 1000
+# 空间索引与穷举匹配的交叉点扫描：随机色板大小和每批像素数
+CROSSOVER_PALETTE_SIZES = [16, 32, 64, 167, 512, 1024, 4096]
+CROSSOVER_BATCH_SIZES = [256, 1024, 4096, 16384, 65536]
+# 抖动基准的色块网格尺寸
+DITHER_GRID_SIZE = (300, 300)
+
+
+def time_runs(fn: Callable[[], object], repeat: int = 3) -> Dict[str, float]:
+    """Run fn `repeat` times and summarize the wall times in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+
+def best_of(fn: Callable[[], object], repeat: int = 3) -> float:
+    """Run fn `repeat` times and return the fastest wall time in seconds."""
+    return time_runs(fn, repeat)['best']
+
+
+def synthetic_image(kind: str, size: Tuple[WIDTH, HEIGHT], seed: int = 0) -> Image.Image:
+    """
+    Reproducible synthetic input.
+
+    :param kind: 'noise' (uniform random RGB) or 'gradient' (smooth RGB ramps with a little noise)
+    :param size: Tuple of (width, height)
+    :param seed: Random seed
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    if kind == 'noise':
+        pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    elif kind == 'gradient':
+        x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+        channels = [x + 0 * y, y + 0 * x, (x + y) / 2]
+        pixels = np.stack(channels, axis=-1) + rng.normal(0, 4, (height, width, 3)).astype(np.float32)
+        pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    else:
+        raise ValueError(f"Unknown synthetic image kind: {kind}")
+    return Image.fromarray(pixels, 'RGB')
+
+
+def benchmark_reducers(image: Image.Image, tile_shape: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette,
+                       repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Time every tile reducer on the same image and compare its output with 'mode'.
+
+    :param image: The input image
+    :param tile_shape: Tuple of (width, height) of each tile
+    :param color_palette: The palette to match against
+    :param repeat: Number of runs per reducer, the fastest one is reported
+    :return: {reducer name: {'seconds': ..., 'agreement_with_mode': ...}}
+    """
+    blocks = tile_blocks(image_to_array(image), tile_shape)
+    reference = reduce_tiles(blocks, color_palette, 'mode')
+    results = {}
+    for name in TILE_REDUCERS:
+        indices = reduce_tiles(blocks, color_palette, name)
+        results[name] = {
+            'seconds': best_of(lambda: reduce_tiles(blocks, color_palette, name), repeat),
+            'agreement_with_mode': float(np.mean(indices == reference)) if len(reference) else 1.0,
+        }
+    return results
+
+
+def benchmark_parallel_scaling(image: Image.Image, tile_shape: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette,
+                               worker_counts: List[int], reducer: str = 'mode',
+                               use_processes: Optional[bool] = None, repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Time the banded tile reduction for several worker counts and check it matches the serial result.
+
+    :return: {worker count: {'seconds': ..., 'speedup': ..., 'identical': 1.0 or 0.0}}
+    """
+    pixels = image_to_array(image)
+    serial = reduce_tiles(tile_blocks(pixels, tile_shape), color_palette, reducer)
+    results = {}
+    baseline = None
+    for workers in worker_counts:
+        run = lambda: reduce_tiles_parallel(pixels, tile_shape, color_palette, reducer, workers, use_processes)
+        identical = np.array_equal(run(), serial)
+        seconds = best_of(run, repeat)
+        baseline = baseline or seconds
+        results[str(workers)] = {'seconds': seconds, 'speedup': baseline / seconds, 'identical': float(identical)}
+    return results
+
+
+def random_palette(num_colors: int, seed: int = 0) -> ColorPalette:
+    """A palette of uniformly random colors."""
+    rng = np.random.default_rng(seed)
+    rgb = rng.integers(0, 256, (num_colors, 3))
+    return ColorPalette([{'name': f'C{i}', 'color': '%02x%02x%02x' % tuple(color)} for i, color in enumerate(rgb)])
+
+
+def benchmark_index_crossover(palette_sizes: List[int], batch_sizes: List[int], metric: str = 'redmean',
+                              repeat: int = 3) -> List[Dict]:
+    """
+    Time closest_colors with and without the palette index over palette and batch sizes.
+
+    The index is built before timing (it is built once per palette and reused); its
+    build time is reported separately. Pixels are uniform random colors, the worst
+    case for the index since every region of the RGB cube gets queried.
+
+    :return: One record per (palette size, batch size) with 'brute', 'index' and 'speedup'
+    """
+    rng = np.random.default_rng(1)
+    records = []
+    for num_colors in palette_sizes:
+        color_palette = random_palette(num_colors)
+        build_start = time.perf_counter()
+        palette_index = color_palette.index(metric)
+        build_seconds = time.perf_counter() - build_start
+        for batch_size in batch_sizes:
+            pixels = rng.integers(0, 256, (batch_size, 3), dtype=np.uint8)
+            brute = best_of(lambda: color_palette.closest_colors(pixels, metric=metric, use_index=False), repeat)
+            indexed = best_of(lambda: color_palette.closest_colors(pixels, metric=metric, use_index=True), repeat)
+            records.append({'colors': num_colors, 'pixels': batch_size, 'brute': brute, 'index': indexed,
+                            'speedup': brute / indexed, 'build': build_seconds,
+                            'mean_candidates': palette_index.mean_candidates()})
+    return records
+
+
+def benchmark_dithering(grid_size: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette, metric: str = 'redmean',
+                        repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Time every dither method on a gradient grid of tile colors.
+
+    :return: {method: {'seconds': ..., 'colors_used': ...}}
+    """
+    colors = image_to_array(synthetic_image('gradient', grid_size))
+    results = {}
+    for method in DITHER_METHODS:
+        indices = dither_colors(colors, color_palette, method, metric)
+        results[method] = {
+            'seconds': best_of(lambda: dither_colors(colors, color_palette, method, metric), repeat),
+            'colors_used': float(len(np.unique(indices))),
+        }
+    return results
+
+
+def benchmark_streaming(image: Image.Image, target_size: Tuple[WIDTH, HEIGHT], tile_shape: Tuple[WIDTH, HEIGHT],
+                        color_palette: ColorPalette) -> Dict[str, Dict[str, float]]:
+    """
+    Compare resize + split of the whole image with the banded iter_tile_rows.
+
+    Each variant runs once under tracemalloc, so the times include its overhead.
+
+    :return: {'whole' / 'stream': {'seconds': ..., 'peak_mib': ...}} plus the fraction of differing tiles
+    """
+    variants = {
+        'whole': lambda: split_image_into_tiles(resize_image(image, target_size), tile_shape, color_palette)[0],
+        'stream': lambda: collect_tile_rows(iter_tile_rows(image, target_size, tile_shape, color_palette),
+                                            color_palette),
+    }
+    results, grids = {}, {}
+    for name, run in variants.items():
+        tracemalloc.start()
+        start = time.perf_counter()
+        grids[name] = run().indices
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'seconds': seconds, 'peak_mib': peak / 1024 ** 2}
+    results['stream']['differing_tiles'] = float(np.mean(grids['whole'] != grids['stream']))
+    return results
+
+
+def benchmark_pattern_io(tiles, tile_shape: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette,
+                         repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Time loading a stored pattern against recovering it from a one-pixel-per-tile PNG.
+
+    The PNG path decodes the image and matches every pixel to the palette again, which
+    is what reprinting from a preview costs today.
+
+    :return: {variant: {'seconds': ..., 'bytes': ...}}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        png_path = os.path.join(directory, 'pattern.png')
+        Image.fromarray(tiles.rgb, 'RGB').save(png_path, compress_level=1)
+
+        def from_png():
+            with Image.open(png_path) as image:
+                return color_palette.closest_colors(np.asarray(image.convert('RGB')))
+
+        results['png'] = {'seconds': best_of(from_png, repeat), 'bytes': float(os.path.getsize(png_path))}
+        for compression in ('none', 'rle', 'zlib'):
+            path = os.path.join(directory, f'pattern.{compression}')
+            size = save_pattern(path, tiles, tile_shape, compression)
+            results[compression] = {'seconds': best_of(lambda: load_pattern(path, color_palette=color_palette),
+                                                       repeat),
+                                    'bytes': float(size)}
+    return results
+
+
+def suite_inputs(sample_paths: List[str], source_sizes: List[Tuple[WIDTH, HEIGHT]]) -> List[Tuple[str, bytes]]:
+    """
+    Encoded inputs of the pipeline suite: the sample files as they are, plus noise and
+    gradient images of every source size encoded as PNG.
+
+    :return: List of (input name, image bytes)
+    """
+    inputs = []
+    for path in sample_paths:
+        with open(path, 'rb') as f:
+            inputs.append((os.path.basename(path), f.read()))
+    for kind in ('noise', 'gradient'):
+        for size in source_sizes:
+            buffer = io.BytesIO()
+            synthetic_image(kind, size).save(buffer, format='PNG', compress_level=1)
+            inputs.append((f"{kind}-{size[0]}x{size[1]}", buffer.getvalue()))
+    return inputs
+
+
+def benchmark_pipeline(inputs: List[Tuple[str, bytes]], color_palette: ColorPalette,
+                       target_sizes: List[Tuple[WIDTH, HEIGHT]] = SUITE_TARGET_SIZES,
+                       tile_shapes: List[Tuple[WIDTH, HEIGHT]] = SUITE_TILE_SHAPES,
+                       preview_tile_sizes: List[Tuple[WIDTH, HEIGHT]] = SUITE_PREVIEW_TILE_SIZES,
+                       repeat: int = 3) -> List[Dict]:
+    """
+    Time every pipeline stage over a sweep of image, tile and grid sizes.
+
+    Each record has the stage name, the input name, the parameters and the timings
+    from time_runs; closest_color records are per call.
+
+    :param inputs: List of (input name, image bytes), see suite_inputs
+    :param color_palette: The palette to match against
+    :return: List of result records
+    """
+    records = []
+
+    def record(stage: str, input_name: str, params: Dict, fn: Callable[[], object], calls: int = 1) -> None:
+        timings = time_runs(fn, repeat)
+        for key in ('best', 'median'):
+            timings[key] /= calls
+        records.append({'stage': stage, 'input': input_name, 'params': params, **timings})
+
+    rng = np.random.default_rng(0)
+    colors = [tuple(int(c) for c in rgb) for rgb in rng.integers(0, 256, (CLOSEST_COLOR_CALLS, 3))]
+    record('closest_color', 'random', {'calls': CLOSEST_COLOR_CALLS},
+           lambda: [color_palette.closest_color(color) for color in colors], calls=CLOSEST_COLOR_CALLS)
+
+    for input_name, data in inputs:
+        image, _ = create_image_from_bytes(io.BytesIO(data))
+        source = {'source_size': list(image.size)}
+        record('create_image_from_bytes', input_name, source,
+               lambda: create_image_from_bytes(io.BytesIO(data)))
+
+        for target_size in target_sizes:
+            params = {**source, 'target_size': list(target_size)}
+            # 解码时按目标尺寸降低分辨率（JPEG draft / reduce）
+            record('create_image_from_bytes', input_name, params,
+                   lambda: create_image_from_bytes(io.BytesIO(data), target_size))
+            record('resize_image', input_name, params, lambda: resize_image(image, target_size))
+            resized_image = resize_image(image, target_size)
+
+            for tile_shape in tile_shapes:
+                params = {**source, 'target_size': list(target_size), 'tile_shape': list(tile_shape)}
+                record('split_image_into_tiles', input_name, params,
+                       lambda: split_image_into_tiles(resized_image, tile_shape, color_palette))
+                tiles = split_image_into_tiles(resized_image, tile_shape, color_palette)[0]
+
+                for preview_tile_size in preview_tile_sizes:
+                    params = {'grid_shape': list(tiles.shape), 'preview_tile_size': list(preview_tile_size)}
+                    record('preview_tiles', input_name, params,
+                           lambda: preview_tiles(tiles, tiles.shape, preview_tile_size, color_palette))
+    return records
+
+
+def environment_info() -> Dict:
+    """Where the numbers come from: commit, interpreter and library versions, CPU count."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': Image.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def _record_id(record: Dict) -> str:
+    return json.dumps([record['stage'], record['input'], record['params']], sort_keys=True)
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 1.1) -> List[Dict]:
+    """
+    Match records of two suite runs and report the ones that got slower.
+
+    :param baseline: Earlier output of the suite (as loaded from JSON)
+    :param current: Newer output of the suite
+    :param threshold: Ratio of best times above which a record counts as a regression
+    :return: List of {'stage', 'input', 'params', 'baseline', 'current', 'ratio'}, slowest first
+    """
+    previous = {_record_id(record): record for record in baseline['results']}
+    regressions = []
+    for record in current['results']:
+        old = previous.get(_record_id(record))
+        if old is None or old['best'] <= 0:
+            continue
+        ratio = record['best'] / old['best']
+        if ratio > threshold:
+            regressions.append({'stage': record['stage'], 'input': record['input'], 'params': record['params'],
+                                'baseline': old['best'], 'current': record['best'], 'ratio': ratio})
+    return sorted(regressions, key=lambda item: item['ratio'], reverse=True)
+
+
+def _print_table(title: str, rows: List[Tuple[str, Dict[str, float]]]) -> None:
+    print(title)
+    for name, values in rows:
+        cells = "  ".join(f"{key}={value:.4f}" for key, value in values.items())
+        print(f"  {name:<14} {cells}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the pixel-art pipeline")
+    parser.add_argument('images', nargs='*', default=SAMPLE_IMAGES)
+    parser.add_argument('--size', type=int, nargs=2, default=(400, 400), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--tile', type=int, nargs=2, default=(8, 8), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--lut', choices=['none', 'exact', 'compact'], default='none',
+                        help="Attach a palette lookup table before timing (speeds up palette_vote)")
+    parser.add_argument('--scaling', action='store_true',
+                        help="Benchmark banded parallel tile reduction on a synthetic 8K-wide image instead")
+    pool = parser.add_mutually_exclusive_group()
+    pool.add_argument('--processes', action='store_true', help="Use processes with --scaling")
+    pool.add_argument('--threads', action='store_true',
+                      help="Use threads with --scaling (default: processes for mode, threads otherwise)")
+    parser.add_argument('--suite', action='store_true',
+                        help="Sweep every pipeline stage over sample and synthetic images of several sizes")
+    parser.add_argument('--quick', action='store_true', help="Smaller sweep for --suite")
+    parser.add_argument('--json', metavar='PATH', help="Write the --suite results to this file")
+    parser.add_argument('--compare', metavar='PATH', help="Report --suite records slower than this earlier run")
+    parser.add_argument('--threshold', type=float, default=1.1, help="Slowdown ratio reported by --compare")
+    parser.add_argument('--crossover', action='store_true',
+                        help="Compare palette index and brute-force matching over palette and batch sizes")
+    parser.add_argument('--metric', choices=INDEXED_METRICS, default='redmean',
+                        help="Distance metric for --crossover and --dither")
+    parser.add_argument('--stream', action='store_true',
+                        help="Compare whole-image and banded splitting of a synthetic 4000x3000 image resized to --size")
+    parser.add_argument('--dither', action='store_true',
+                        help=f"Time every dither method on a {DITHER_GRID_SIZE[0]}x{DITHER_GRID_SIZE[1]} grid of tile colors")
+    parser.add_argument('--pattern-io', action='store_true',
+                        help="Compare loading a stored pattern of a gradient split at --size/--tile with PNG decoding")
+    args = parser.parse_args()
+
+    if args.lut != 'none':
+        mardPalette.build_lut(args.lut)
+
+    if args.suite:
+        run_suite(args)
+        return
+
+    if args.crossover:
+        for record in benchmark_index_crossover(CROSSOVER_PALETTE_SIZES, CROSSOVER_BATCH_SIZES, args.metric,
+                                                args.repeat):
+            print(f"  colors={record['colors']:<5} pixels={record['pixels']:<6} brute={record['brute'] * 1000:9.3f} ms"
+                  f"  index={record['index'] * 1000:9.3f} ms  speedup={record['speedup']:6.2f}"
+                  f"  build={record['build']:.2f} s  candidates={record['mean_candidates']:.1f}")
+        return
+
+    if args.stream:
+        image = synthetic_image('gradient', (4000, 3000))
+        results = benchmark_streaming(image, tuple(args.size), tuple(args.tile), mardPalette)
+        _print_table(f"streaming 4000x3000 -> {args.size[0]}x{args.size[1]} tile {args.tile[0]}x{args.tile[1]}",
+                     list(results.items()))
+        return
+
+    if args.pattern_io:
+        image = synthetic_image('gradient', tuple(args.size))
+        tiles = split_image_into_tiles(image, tuple(args.tile), mardPalette)[0]
+        results = benchmark_pattern_io(tiles, tuple(args.tile), mardPalette, args.repeat)
+        _print_table(f"pattern io {tiles.shape[0]}x{tiles.shape[1]} tiles", list(results.items()))
+        return
+
+    if args.dither:
+        if args.lut != 'none' and args.metric != 'redmean':
+            mardPalette.build_lut(args.lut, metric=args.metric)
+        results = benchmark_dithering(DITHER_GRID_SIZE, mardPalette, args.metric, args.repeat)
+        _print_table(f"dithering {DITHER_GRID_SIZE[0]}x{DITHER_GRID_SIZE[1]} {args.metric}", list(results.items()))
+        return
+
+    if args.scaling:
+        image = synthetic_image('gradient', (7680, 4320))
+        worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+        use_processes = True if args.processes else (False if args.threads else None)
+        results = benchmark_parallel_scaling(image, tuple(args.tile), mardPalette, worker_counts,
+                                             use_processes=use_processes, repeat=args.repeat)
+        _print_table(f"parallel scaling 7680x4320 tile {args.tile[0]}x{args.tile[1]}", list(results.items()))
+        return
+
+    for path in args.images:
+        image = Image.open(path).convert('RGB').resize(tuple(args.size))
+        results = benchmark_reducers(image, tuple(args.tile), mardPalette, args.repeat)
+        ranked = sorted(results.items(), key=lambda item: item[1]['seconds'])
+        _print_table(f"{path} {args.size[0]}x{args.size[1]} tile {args.tile[0]}x{args.tile[1]}", ranked)
+
+
+def run_suite(args) -> None:
+    source_sizes = SUITE_SOURCE_SIZES[:1] if args.quick else SUITE_SOURCE_SIZES
+    sweep = {}
+    if args.quick:
+        sweep = {'target_sizes': SUITE_TARGET_SIZES[:1], 'preview_tile_sizes': SUITE_PREVIEW_TILE_SIZES[:1]}
+    records = benchmark_pipeline(suite_inputs(args.images, source_sizes), mardPalette, repeat=args.repeat, **sweep)
+    output = {'environment': {**environment_info(), 'lut': args.lut}, 'results': records}
+
+    for record in records:
+        params = " ".join(f"{key}={'x'.join(map(str, value)) if isinstance(value, list) else value}"
+                          for key, value in record['params'].items())
+        print(f"  {record['stage']:<24} {record['input']:<20} {record['best'] * 1000:10.3f} ms  {params}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(json.load(f), output, args.threshold)
+        print(f"{len(regressions)} records slower than {args.compare} by more than {args.threshold:.2f}x")
+        for item in regressions:
+            print(f"  {item['stage']:<24} {item['input']:<20} {item['ratio']:.2f}x  {item['params']}")
+
+
+if __name__ == '__main__':
+    main()
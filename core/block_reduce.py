@@ -0,0 +1,230 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Literal, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .instrument import stage
+
+WIDTH = int
+HEIGHT = int
+
+
+def image_to_array(image: Image.Image) -> np.ndarray:
+    """
+    Convert an image to an (H, W, C) uint8 array with C = 3 (RGB) or 4 (RGBA).
+
+    RGBA images keep their alpha channel so that the most frequent color is computed
+    over the same 4-tuples that Image.getdata() returns.
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def tile_view(pixels: np.ndarray, tile_shape: Tuple[WIDTH, HEIGHT]) -> np.ndarray:
+    """
+    View an (H, W, ...) array as (ny, tile_h, nx, tile_w, ...) without copying.
+
+    Pixels on the right and bottom edges that do not fill a whole tile are dropped.
+
+    :param pixels: Array of shape (H, W, ...)
+    :param tile_shape: Tuple of (width, height) of each tile
+    :return: Array of shape (ny, tile_h, nx, tile_w, ...)
+    """
+    tile_width, tile_height = tile_shape
+    num_tiles_x = pixels.shape[1] // tile_width
+    num_tiles_y = pixels.shape[0] // tile_height
+    cropped = pixels[:num_tiles_y * tile_height, :num_tiles_x * tile_width]
+    return cropped.reshape((num_tiles_y, tile_height, num_tiles_x, tile_width) + pixels.shape[2:])
+
+
+def tile_blocks(pixels: np.ndarray, tile_shape: Tuple[WIDTH, HEIGHT]) -> np.ndarray:
+    """
+    Gather the pixels of every tile into one row, in the same order as tile.getdata().
+
+    :param pixels: Array of shape (H, W, ...)
+    :param tile_shape: Tuple of (width, height) of each tile
+    :return: Array of shape (ny * nx, tile_h * tile_w, ...)
+    """
+    view = tile_view(pixels, tile_shape)
+    num_tiles_y, tile_height, num_tiles_x, tile_width = view.shape[:4]
+    blocks = view.swapaxes(1, 2)
+    return blocks.reshape((num_tiles_y * num_tiles_x, tile_height * tile_width) + pixels.shape[2:])
+
+
+def pack_colors(pixels: np.ndarray) -> np.ndarray:
+    """Pack the channels of an (..., C) uint8 array (C <= 4) into uint32 values."""
+    packed = np.zeros(pixels.shape[:-1], dtype=np.uint32)
+    for channel in range(pixels.shape[-1]):
+        packed <<= 8
+        packed |= pixels[..., channel]
+    return packed
+
+
+def unpack_colors(packed: np.ndarray, channels: int) -> np.ndarray:
+    """Inverse of pack_colors."""
+    shifts = np.arange(channels - 1, -1, -1, dtype=np.uint32) * 8
+    return ((packed[..., None] >> shifts) & 0xFF).astype(np.uint8)
+
+
+def _legacy_tie_break(tile_pixels: np.ndarray, candidates: set) -> tuple:
+    # max(set(colors), key=colors.count) returns the first maximum in set iteration order.
+    # That order only depends on the values inserted and their insertion order, so rebuilding
+    # the set from the same tuples reproduces it in O(n) instead of O(n^2).
+    for color in set(map(tuple, tile_pixels.tolist())):
+        if color in candidates:
+            return color
+    raise AssertionError("tied colors must occur in the tile")
+
+
+def block_mode(blocks: np.ndarray, legacy_ties: bool = True) -> np.ndarray:
+    """
+    Compute the most frequent color of every tile at once.
+
+    Colors are packed into uint32 and sorted per tile; the longest run of equal values
+    is the mode. When several colors share the highest count, legacy_ties reproduces
+    the choice of max(set(colors), key=colors.count); otherwise the smallest packed
+    value wins.
+
+    :param blocks: Array of shape (T, n, C) as returned by tile_blocks
+    :param legacy_ties: Resolve ties exactly like the original per-tile implementation
+    :return: Array of shape (T, C) with the dominant color of each tile
+    """
+    num_tiles, tile_pixels, channels = blocks.shape
+    if num_tiles == 0 or tile_pixels == 0:
+        return np.zeros((num_tiles, channels), dtype=np.uint8)
+
+    packed = np.sort(pack_colors(blocks), axis=1).ravel()
+    run_starts = np.ones(packed.shape, dtype=bool)
+    run_starts[1:] = packed[1:] != packed[:-1]
+    # 每个色块的第一个像素总是新的一段，保证段不会跨越色块
+    run_starts[::tile_pixels] = True
+    run_offsets = np.flatnonzero(run_starts)
+    run_lengths = np.diff(np.append(run_offsets, packed.size))
+    run_tiles = run_offsets // tile_pixels
+    first_runs = np.searchsorted(run_offsets, np.arange(num_tiles) * tile_pixels)
+
+    max_lengths = np.maximum.reduceat(run_lengths, first_runs)
+    is_max = run_lengths == max_lengths[run_tiles]
+    max_runs = np.flatnonzero(is_max)
+    # max_runs 按色块有序，max_run_bounds[t] 是色块 t 的第一个最长段
+    max_run_bounds = np.searchsorted(run_tiles[max_runs], np.arange(num_tiles + 1))
+    dominant = unpack_colors(packed[run_offsets[max_runs[max_run_bounds[:-1]]]], channels)
+
+    if legacy_ties:
+        tie_counts = np.diff(max_run_bounds)
+        for tile in np.flatnonzero(tie_counts > 1):
+            tile_runs = max_runs[max_run_bounds[tile]:max_run_bounds[tile + 1]]
+            tied = unpack_colors(packed[run_offsets[tile_runs]], channels)
+            dominant[tile] = _legacy_tie_break(blocks[tile], set(map(tuple, tied.tolist())))
+    return dominant
+
+
+def block_mean(blocks: np.ndarray) -> np.ndarray:
+    """Mean RGB color of every tile, rounded to integers."""
+    return np.rint(blocks[..., :3].mean(axis=1)).astype(np.uint8)
+
+
+def block_median(blocks: np.ndarray) -> np.ndarray:
+    """Per-channel median RGB color of every tile, rounded to integers."""
+    return np.rint(np.median(blocks[..., :3], axis=1)).astype(np.uint8)
+
+
+def block_trimmed_mean(blocks: np.ndarray, proportion: float = 0.1) -> np.ndarray:
+    """
+    Per-channel mean of every tile after dropping the lowest and highest values.
+
+    :param blocks: Array of shape (T, n, C) as returned by tile_blocks
+    :param proportion: Fraction of pixels cut from each end of every channel
+    :return: Array of shape (T, 3) with the trimmed mean color of each tile
+    """
+    tile_pixels = blocks.shape[1]
+    cut = min(int(tile_pixels * proportion), (tile_pixels - 1) // 2)
+    ordered = np.sort(blocks[..., :3], axis=1)
+    return np.rint(ordered[:, cut:tile_pixels - cut].mean(axis=1)).astype(np.uint8)
+
+
+def block_palette_vote(blocks: np.ndarray, color_palette, metric: str = 'redmean') -> np.ndarray:
+    """
+    Map every pixel to the palette first and return the most frequent palette index of each tile.
+
+    Ties go to the lowest palette index.
+
+    :param blocks: Array of shape (T, n, C) as returned by tile_blocks
+    :param color_palette: The ColorPalette to match against
+    :param metric: Distance metric used to match the pixels
+    :return: Array of shape (T,) with palette indices
+    """
+    num_tiles = blocks.shape[0]
+    num_colors = len(color_palette.colors)
+    pixel_indices = color_palette.closest_colors(blocks[..., :3], metric=metric)
+    offsets = np.arange(num_tiles)[:, None] * num_colors
+    votes = np.bincount((pixel_indices + offsets).ravel(), minlength=num_tiles * num_colors)
+    return votes.reshape(num_tiles, num_colors).argmax(axis=1)
+
+
+@dataclass(frozen=True)
+class TileReducer:
+    """
+    A way of reducing the pixels of every tile to one color.
+
+    reduce receives the (T, n, C) blocks, the palette and the distance metric. Reducers with
+    yields_indices return palette indices of shape (T,); the others return
+    representative RGB colors of shape (T, 3) that are matched to the palette afterwards.
+    """
+    name: str
+    reduce: Callable[[np.ndarray, object, str], np.ndarray]
+    yields_indices: bool = False
+
+
+TILE_REDUCERS: Dict[str, TileReducer] = {
+    'mode': TileReducer('mode', lambda blocks, *_: block_mode(blocks)),
+    'mean': TileReducer('mean', lambda blocks, *_: block_mean(blocks)),
+    'median': TileReducer('median', lambda blocks, *_: block_median(blocks)),
+    'trimmed_mean': TileReducer('trimmed_mean', lambda blocks, *_: block_trimmed_mean(blocks)),
+    'palette_vote': TileReducer('palette_vote', block_palette_vote, yields_indices=True),
+}
+ReducerName = Literal['mode', 'mean', 'median', 'trimmed_mean', 'palette_vote']
+
+
+def get_reducer(reducer: str) -> TileReducer:
+    """根据名称获取色块归约方式"""
+    try:
+        return TILE_REDUCERS[reducer]
+    except KeyError:
+        raise ValueError(f"Unknown tile reducer: {reducer}. Choose one of {', '.join(TILE_REDUCERS)}")
+
+
+def reduce_tile_colors(blocks: np.ndarray, reducer: str = 'mode') -> np.ndarray:
+    """
+    Representative RGB color of every tile, before it is matched to the palette.
+
+    :param blocks: Array of shape (T, n, C) as returned by tile_blocks
+    :param reducer: Name of a reducer in TILE_REDUCERS that yields colors
+    :return: Array of shape (T, 3) with RGB colors
+    """
+    tile_reducer = get_reducer(reducer)
+    if tile_reducer.yields_indices:
+        raise ValueError(f"The {reducer} reducer picks palette colors directly and yields no tile colors")
+    with stage('tile_reduce', pixels=blocks.shape[0] * blocks.shape[1]):
+        return tile_reducer.reduce(blocks, None, None)[:, :3]
+
+
+def reduce_tiles(blocks: np.ndarray, color_palette, reducer: str = 'mode', metric: str = 'redmean') -> np.ndarray:
+    """
+    Reduce every tile to a palette index with the selected reducer.
+
+    :param blocks: Array of shape (T, n, C) as returned by tile_blocks
+    :param color_palette: The ColorPalette to match against
+    :param reducer: Name of a reducer in TILE_REDUCERS
+    :param metric: Distance metric used to match colors to the palette, see core.color_distance
+    :return: Array of shape (T,) with palette indices
+    """
+    tile_reducer = get_reducer(reducer)
+    with stage('tile_reduce', pixels=blocks.shape[0] * blocks.shape[1]):
+        result = tile_reducer.reduce(blocks, color_palette, metric)
+    if tile_reducer.yields_indices:
+        return result
+    with stage('palette_match', pixels=len(result)):
+        return color_palette.closest_colors(result[:, :3], metric=metric)
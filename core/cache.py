@@ -0,0 +1,154 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+from PIL import Image
+
+from .ingest import bytes_per_pixel
+
+# 内存缓存的默认容量，可通过环境变量覆盖
+DEFAULT_MEMORY_BYTES = int(os.environ.get('PIXEL_ART_RESULT_CACHE_BYTES', 512 * 1024 ** 2))
+DEFAULT_DISK_DIR = os.environ.get('PIXEL_ART_RESULT_CACHE_DIR') or None
+
+_MISSING = object()
+
+
+def make_key(*parts: Any) -> str:
+    """Content-addressed cache key: sha256 over the repr of the parts."""
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    """sha256 of raw bytes, used to address uploaded images."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def estimate_nbytes(value: Any) -> int:
+    """Approximate memory held by a cached value."""
+    if isinstance(value, Image.Image):
+        return value.width * value.height * bytes_per_pixel(value.mode)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_nbytes(k) + estimate_nbytes(v) for k, v in value.items())
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+
+class ByteLRUCache:
+    """Thread-safe LRU cache that evicts by total estimated size instead of entry count."""
+
+    def __init__(self, max_bytes: int = DEFAULT_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value: Any) -> None:
+        size = estimate_nbytes(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            if size > self.max_bytes:
+                return  # 单个值超过容量时不缓存
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+class DiskCache:
+    """Pickle files in a directory, one per key, written atomically."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return default  # 缓存文件损坏时当作未命中
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+class ResultCache:
+    """
+    Two-tier cache: an in-memory LRU bounded by bytes and an optional on-disk tier.
+
+    Disk hits are promoted to memory.
+    """
+
+    def __init__(self, memory_bytes: int = DEFAULT_MEMORY_BYTES, disk_dir: Optional[str] = DEFAULT_DISK_DIR):
+        self.memory = ByteLRUCache(memory_bytes)
+        self.disk = DiskCache(disk_dir) if disk_dir else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key, _MISSING)
+            if value is not _MISSING:
+                self.memory.put(key, value)
+                return value
+        return default
+
+    def put(self, key: str, value: Any) -> None:
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def get_or_compute(self, key: str, compute) -> tuple:
+        """
+        Return (value, hit) for key, calling compute() and storing its result on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value, True
+        value = compute()
+        self.put(key, value)
+        return value, False
+
+
+default_cache = ResultCache()
@@ -0,0 +1,228 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Literal, Tuple
+
+import numpy as np
+
+from .color_space import srgb_to_lab
+
+DistanceMetric = Literal['redmean', 'euclidean', 'cie76', 'cie94', 'ciede2000']
+
+
+def _broadcast_pair(pixels: np.ndarray, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Arrange pixels and palette colors so that elementwise operations give a distance matrix.
+
+    (N, 3) pixels against (P, 3) colors become (N, 1, 3) and (1, P, 3). Arrays that
+    are already 3D, e.g. (N, 1, 3) pixels against (N, K, 3) per-pixel candidates as
+    used by PaletteIndex, are returned as they are. Either way every distance is
+    computed with the same elementwise operations, so the values are bit-identical.
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    palette = np.asarray(palette, dtype=np.float64)
+    if pixels.ndim == 2:
+        pixels = pixels[:, None, :]
+    if palette.ndim == 2:
+        palette = palette[None, :, :]
+    return pixels, palette
+
+
+def redmean_distance(pixels: np.ndarray, palette_rgb: np.ndarray) -> np.ndarray:
+    """
+    Compute the "redmean" color distance between every pixel and every palette color.
+
+    The arithmetic (including the floor divisions) mirrors ColorPalette.closest_color,
+    so argmin over the result picks exactly the same palette entry.
+
+    :param pixels: Array of shape (N, 3) with RGB values
+    :param palette_rgb: Array of shape (P, 3) with palette RGB values
+    :return: Array of shape (N, P) with distances
+    """
+    pixels, palette_rgb = _broadcast_pair(pixels, palette_rgb)
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    pr, pg, pb = palette_rgb[..., 0], palette_rgb[..., 1], palette_rgb[..., 2]
+
+    # 原地运算以减少 (N, P) 临时数组的分配；除以 256 是精确的，floor 等价于 "//"
+    rmean = r + pr
+    rmean *= 0.5
+    diff = r - pr
+    diff *= diff
+    term = 512 + rmean
+    term *= diff
+    term /= 256
+    distance = np.floor(term)
+
+    diff = g - pg
+    diff *= diff
+    diff *= 4
+    distance += diff
+
+    diff = b - pb
+    diff *= diff
+    term = 767 - rmean
+    term *= diff
+    term /= 256
+    distance += np.floor(term, out=term)
+    return distance
+
+
+def euclidean_distance(pixels: np.ndarray, palette_rgb: np.ndarray) -> np.ndarray:
+    """
+    Squared Euclidean distance in RGB between every pixel and every palette color.
+
+    :param pixels: Array of shape (N, 3) with RGB values
+    :param palette_rgb: Array of shape (P, 3) with palette RGB values
+    :return: Array of shape (N, P) with squared distances
+    """
+    pixels, palette_rgb = _broadcast_pair(pixels, palette_rgb)
+    distance = pixels[..., 0] - palette_rgb[..., 0]
+    distance *= distance
+    for channel in (1, 2):
+        diff = pixels[..., channel] - palette_rgb[..., channel]
+        diff *= diff
+        distance += diff
+    return distance
+
+
+def cie76_distance(pixels_lab: np.ndarray, palette_lab: np.ndarray) -> np.ndarray:
+    """
+    Squared CIE76 color difference (Euclidean distance in L*a*b*).
+
+    :param pixels_lab: Array of shape (N, 3) with L*a*b* values
+    :param palette_lab: Array of shape (P, 3) with L*a*b* values
+    :return: Array of shape (N, P) with squared delta E
+    """
+    return euclidean_distance(pixels_lab, palette_lab)
+
+
+def cie94_distance(pixels_lab: np.ndarray, palette_lab: np.ndarray) -> np.ndarray:
+    """
+    Squared CIE94 color difference (graphic arts weights), the pixel being the reference color.
+
+    :param pixels_lab: Array of shape (N, 3) with L*a*b* values
+    :param palette_lab: Array of shape (P, 3) with L*a*b* values
+    :return: Array of shape (N, P) with squared delta E
+    """
+    pixels_lab, palette_lab = _broadcast_pair(pixels_lab, palette_lab)
+    l1, a1, b1 = pixels_lab[..., 0], pixels_lab[..., 1], pixels_lab[..., 2]
+    l2, a2, b2 = palette_lab[..., 0], palette_lab[..., 1], palette_lab[..., 2]
+    c1 = np.hypot(a1, b1)
+    c2 = np.hypot(a2, b2)
+
+    dl = l1 - l2
+    dc = c1 - c2
+    da = a1 - a2
+    db = b1 - b2
+    # dH^2 = da^2 + db^2 - dC^2，舍入误差可能得到很小的负数
+    dh_squared = np.maximum(da * da + db * db - dc * dc, 0)
+    sc = 1 + 0.045 * c1
+    sh = 1 + 0.015 * c1
+    return dl * dl + (dc / sc) ** 2 + dh_squared / (sh * sh)
+
+
+def ciede2000_distance(pixels_lab: np.ndarray, palette_lab: np.ndarray) -> np.ndarray:
+    """
+    Squared CIEDE2000 color difference (kL = kC = kH = 1).
+
+    Follows Sharma, Wu and Dalal, "The CIEDE2000 Color-Difference Formula:
+    Implementation Notes, Supplementary Test Data, and Mathematical Observations".
+
+    :param pixels_lab: Array of shape (N, 3) with L*a*b* values
+    :param palette_lab: Array of shape (P, 3) with L*a*b* values
+    :return: Array of shape (N, P) with squared delta E
+    """
+    pixels_lab, palette_lab = _broadcast_pair(pixels_lab, palette_lab)
+    l1, a1, b1 = pixels_lab[..., 0], pixels_lab[..., 1], pixels_lab[..., 2]
+    l2, a2, b2 = palette_lab[..., 0], palette_lab[..., 1], palette_lab[..., 2]
+
+    c_bar = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    c_bar7 = c_bar ** 7
+    g = 0.5 * (1 - np.sqrt(c_bar7 / (c_bar7 + 25.0 ** 7)))
+    a1p = (1 + g) * a1
+    a2p = (1 + g) * a2
+    c1p = np.hypot(a1p, b1)
+    c2p = np.hypot(a2p, b2)
+    # 色相角取 [0, 2pi)；彩度为 0 时 atan2(0, 0) = 0，与规范一致
+    h1p = np.arctan2(b1, a1p) % (2 * np.pi)
+    h2p = np.arctan2(b2, a2p) % (2 * np.pi)
+
+    chroma_product = c1p * c2p
+    achromatic = chroma_product == 0
+    dhp = h2p - h1p
+    dhp = np.where(dhp > np.pi, dhp - 2 * np.pi, np.where(dhp < -np.pi, dhp + 2 * np.pi, dhp))
+    dhp[achromatic] = 0
+    dl = l2 - l1
+    dc = c2p - c1p
+    dh = 2 * np.sqrt(chroma_product) * np.sin(dhp / 2)
+
+    l_bar = (l1 + l2) / 2
+    c_barp = (c1p + c2p) / 2
+    h_sum = h1p + h2p
+    h_bar = np.where(np.abs(h1p - h2p) <= np.pi, h_sum / 2,
+                     np.where(h_sum < 2 * np.pi, (h_sum + 2 * np.pi) / 2, (h_sum - 2 * np.pi) / 2))
+    h_bar = np.where(achromatic, h_sum, h_bar)
+
+    t = (1 - 0.17 * np.cos(h_bar - np.radians(30)) + 0.24 * np.cos(2 * h_bar)
+         + 0.32 * np.cos(3 * h_bar + np.radians(6)) - 0.20 * np.cos(4 * h_bar - np.radians(63)))
+    d_theta = np.radians(30) * np.exp(-((np.degrees(h_bar) - 275) / 25) ** 2)
+    c_barp7 = c_barp ** 7
+    rc = 2 * np.sqrt(c_barp7 / (c_barp7 + 25.0 ** 7))
+    l_offset = (l_bar - 50) ** 2
+    sl = 1 + 0.015 * l_offset / np.sqrt(20 + l_offset)
+    sc = 1 + 0.045 * c_barp
+    sh = 1 + 0.015 * c_barp * t
+    rt = -np.sin(2 * d_theta) * rc
+
+    dl /= sl
+    dc /= sc
+    dh /= sh
+    return dl * dl + dc * dc + dh * dh + rt * dc * dh
+
+
+@dataclass(frozen=True)
+class ColorDistance:
+    """
+    A color difference formula.
+
+    distance takes (N, 3) pixels and (P, 3) palette colors in the metric's color space
+    ('rgb' or 'lab') and returns an (N, P) array; (N, 1, 3) pixels against (N, K, 3)
+    candidate colors give an (N, K) array. Only the ordering matters for matching,
+    so the Lab formulas return squared delta E.
+    """
+    name: str
+    space: Literal['rgb', 'lab']
+    distance: Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+DISTANCE_METRICS: Dict[str, ColorDistance] = {
+    'redmean': ColorDistance('redmean', 'rgb', redmean_distance),
+    'euclidean': ColorDistance('euclidean', 'rgb', euclidean_distance),
+    'cie76': ColorDistance('cie76', 'lab', cie76_distance),
+    'cie94': ColorDistance('cie94', 'lab', cie94_distance),
+    'ciede2000': ColorDistance('ciede2000', 'lab', ciede2000_distance),
+}
+
+
+def get_metric(metric: str) -> ColorDistance:
+    """根据名称获取颜色距离公式"""
+    try:
+        return DISTANCE_METRICS[metric]
+    except KeyError:
+        raise ValueError(f"Unknown distance metric: {metric}. Choose one of {', '.join(DISTANCE_METRICS)}")
+
+
+def palette_distance(pixels: np.ndarray, color_palette, metric: DistanceMetric = 'redmean') -> np.ndarray:
+    """
+    Distance between every pixel and every palette color.
+
+    Lab metrics convert the pixels through the 256-entry sRGB linearization table and
+    use the Lab table precomputed by the palette.
+
+    :param pixels: Array of shape (N, 3) with RGB values
+    :param color_palette: The ColorPalette to compare against
+    :param metric: Name of a metric in DISTANCE_METRICS
+    :return: Array of shape (N, P)
+    """
+    color_distance = get_metric(metric)
+    if color_distance.space == 'lab':
+        return color_distance.distance(srgb_to_lab(pixels), color_palette.lab)
+    return color_distance.distance(pixels, color_palette.rgb)
@@ -0,0 +1,86 @@
+from typing import Tuple
+
+import numpy as np
+
+# sRGB (D65) -> CIE XYZ
+SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+# D65 参考白
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+_LAB_EPSILON = 216 / 24389
+_LAB_KAPPA = 24389 / 27
+
+
+def _srgb_channel_to_linear(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64) / 255
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+# 8 位通道值的线性化查找表，整数像素查表即可，不必逐个求幂
+SRGB_TO_LINEAR = _srgb_channel_to_linear(np.arange(256))
+SRGB_TO_LINEAR.setflags(write=False)
+
+
+def srgb_to_linear(rgb: np.ndarray) -> np.ndarray:
+    """
+    Convert sRGB values in 0-255 to linear RGB in 0-1.
+
+    Integer input is converted through the 256-entry SRGB_TO_LINEAR table.
+
+    :param rgb: Array of shape (..., 3)
+    :return: float64 array of the same shape
+    """
+    rgb = np.asarray(rgb)
+    if np.issubdtype(rgb.dtype, np.integer):
+        return SRGB_TO_LINEAR[rgb]
+    return _srgb_channel_to_linear(rgb)
+
+
+def _lab_f(t: np.ndarray) -> np.ndarray:
+    return np.where(t > _LAB_EPSILON, np.cbrt(t), (_LAB_KAPPA * t + 16) / 116)
+
+
+def linear_to_lab(linear: np.ndarray) -> np.ndarray:
+    """
+    Convert linear RGB in 0-1 to CIE L*a*b* (D65).
+
+    :param linear: Array of shape (..., 3)
+    :return: float64 array of the same shape with L*, a*, b*
+    """
+    f = _lab_f(np.asarray(linear, dtype=np.float64) @ SRGB_TO_XYZ.T / D65_WHITE)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def srgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """Convert sRGB values in 0-255 to CIE L*a*b* (D65), see srgb_to_linear and linear_to_lab."""
+    return linear_to_lab(srgb_to_linear(rgb))
+
+
+def lab_box(rgb_low: np.ndarray, rgb_high: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bounding boxes in L*a*b* of boxes of sRGB colors.
+
+    X, Y and Z grow with every RGB channel, so each of them (and L*) is extreme at
+    the low and high corners; a* and b* are bounded by combining opposite extremes.
+
+    :param rgb_low: Array of shape (..., 3) with the low corners (0-255)
+    :param rgb_high: Array of shape (..., 3) with the high corners (0-255)
+    :return: Tuple of (low, high) arrays of shape (..., 3) with L*a*b* bounds
+    """
+    f_low = _lab_f(srgb_to_linear(rgb_low) @ SRGB_TO_XYZ.T / D65_WHITE)
+    f_high = _lab_f(srgb_to_linear(rgb_high) @ SRGB_TO_XYZ.T / D65_WHITE)
+    low = np.stack([116 * f_low[..., 1] - 16,
+                    500 * (f_low[..., 0] - f_high[..., 1]),
+                    200 * (f_low[..., 1] - f_high[..., 2])], axis=-1)
+    high = np.stack([116 * f_high[..., 1] - 16,
+                     500 * (f_high[..., 0] - f_low[..., 1]),
+                     200 * (f_high[..., 1] - f_low[..., 2])], axis=-1)
+    return low, high
@@ -0,0 +1,186 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Literal, Tuple
+
+import numpy as np
+
+from .palette_index import INDEXED_METRICS
+
+DitherMethod = Literal['none', 'bayer', 'floyd_steinberg', 'atkinson', 'sierra']
+
+# 有序抖动的阈值幅度（RGB 单位），约为色板相邻颜色间距的一半
+BAYER_SPREAD = 32.0
+
+
+@dataclass(frozen=True)
+class DiffusionKernel:
+    """
+    An error-diffusion kernel.
+
+    weights lists (dy, dx, weight) for the neighbours that receive a share of the
+    quantization error, relative to the current pixel; each share is weight / divisor.
+    lag is the number of columns a row has to trail the row above: every neighbour
+    satisfies dx + lag * dy >= 1, so all the pixels on an anti-diagonal x + lag * y = t
+    only receive error from earlier anti-diagonals and can be quantized together.
+    """
+    name: str
+    weights: Tuple[Tuple[int, int, int], ...]
+    divisor: int
+    lag: int
+
+
+DIFFUSION_KERNELS: Dict[str, DiffusionKernel] = {
+    'floyd_steinberg': DiffusionKernel('floyd_steinberg', (
+        (0, 1, 7),
+        (1, -1, 3), (1, 0, 5), (1, 1, 1),
+    ), 16, 2),
+    # Atkinson 只扩散 6/8 的误差，高光和暗部更干净
+    'atkinson': DiffusionKernel('atkinson', (
+        (0, 1, 1), (0, 2, 1),
+        (1, -1, 1), (1, 0, 1), (1, 1, 1),
+        (2, 0, 1),
+    ), 8, 2),
+    'sierra': DiffusionKernel('sierra', (
+        (0, 1, 5), (0, 2, 3),
+        (1, -2, 2), (1, -1, 4), (1, 0, 5), (1, 1, 4), (1, 2, 2),
+        (2, -1, 2), (2, 0, 3), (2, 1, 2),
+    ), 32, 3),
+}
+DITHER_METHODS = ('none', 'bayer') + tuple(DIFFUSION_KERNELS)
+
+
+def bayer_matrix(size: int) -> np.ndarray:
+    """
+    Bayer threshold matrix of the given power-of-two size, normalized to [-0.5, 0.5).
+
+    :param size: Side length of the matrix (1, 2, 4, 8, ...)
+    :return: float32 array of shape (size, size)
+    """
+    if size < 1 or size & (size - 1):
+        raise ValueError(f"Bayer matrix size must be a power of two, got {size}")
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return ((matrix + 0.5) / (size * size) - 0.5).astype(np.float32)
+
+
+def _quantize(colors: np.ndarray) -> np.ndarray:
+    return (np.clip(colors, 0, 255) + 0.5).astype(np.uint8)
+
+
+def _matcher(color_palette, metric: str) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Resolve once how uint8 pixels are matched, so the per-wavefront calls skip the dispatch.
+
+    A lookup table built for the metric is used directly; otherwise indexable metrics go
+    through the palette's spatial index, which pays off over the many small batches of
+    error diffusion.
+    """
+    lut = color_palette.luts.get(metric)
+    if lut is not None and lut.mode == 'exact':
+        table = lut.table
+        return lambda pixels: table[pixels[:, 0], pixels[:, 1], pixels[:, 2]]
+    if lut is not None:
+        return lambda pixels: lut.lookup(pixels, color_palette)
+    if metric in INDEXED_METRICS:
+        return color_palette.index(metric).query
+    return lambda pixels: color_palette.closest_colors(pixels, metric=metric)
+
+
+def ordered_dither(colors: np.ndarray, color_palette, metric: str = 'redmean', size: int = 4,
+                   spread: float = BAYER_SPREAD) -> np.ndarray:
+    """
+    Ordered (Bayer) dithering: offset every color by its position's threshold, then match.
+
+    :param colors: Array of shape (H, W, 3) with RGB colors
+    :param color_palette: The ColorPalette to match against
+    :param metric: Distance metric used to match colors to the palette
+    :param size: Side length of the Bayer matrix
+    :param spread: Offset range in RGB units
+    :return: Array of shape (H, W) with palette indices
+    """
+    height, width = colors.shape[:2]
+    thresholds = np.tile(bayer_matrix(size), (height // size + 1, width // size + 1))[:height, :width]
+    shifted = _quantize(colors + spread * thresholds[..., None])
+    return _matcher(color_palette, metric)(shifted.reshape(-1, 3)).reshape(height, width)
+
+
+def error_diffusion(colors: np.ndarray, color_palette, kernel: DiffusionKernel, metric: str = 'redmean') -> np.ndarray:
+    """
+    Error-diffusion dithering, processed one anti-diagonal wavefront at a time.
+
+    Diffusion makes every pixel depend on its left neighbour, so a whole row can not be
+    quantized at once. Instead the pixels with x + kernel.lag * y = t, one per row, are
+    matched against the palette together and push their errors forward, which gives
+    exactly the result of the usual left-to-right, top-to-bottom scan in
+    W + lag * (H - 1) vectorized steps.
+
+    :param colors: Array of shape (H, W, 3) with RGB colors
+    :param color_palette: The ColorPalette to match against
+    :param kernel: The diffusion kernel
+    :param metric: Distance metric used to match colors to the palette
+    :return: Array of shape (H, W) with palette indices
+    """
+    height, width = colors.shape[:2]
+    match = _matcher(color_palette, metric)
+    palette_rgb = color_palette.rgb.astype(np.float32)
+    # 误差缓冲区右侧、左侧和下方留出核的范围，越界的误差落在边缘上被丢弃
+    reach_y = max(dy for dy, _, _ in kernel.weights)
+    reach_x = max(abs(dx) for _, dx, _ in kernel.weights)
+    stride = width + 2 * reach_x
+    # 每个通道一个平面，全部展开成一维：一维花式索引累加比 (N, 3) 的行索引快得多
+    planes = np.zeros((3, height + reach_y, stride), dtype=np.float32)
+    planes[:, :height, reach_x:reach_x + width] = np.moveaxis(colors[..., :3], -1, 0)
+    plane_size = planes[0].size
+    values = planes.ravel()
+    palette_planes = np.ascontiguousarray(palette_rgb.T)
+
+    # 同一波前上两个像素的扩散目标重合，当且仅当两个偏移的 dx + lag * dy 相同。
+    # 把偏移分组，每组里这个值互不相同，一组的目标就不会重复，可以一次花式索引累加；
+    # 同值的偏移按 dy 从大到小分到前后的组，来自上一行像素的误差先累加，与逐像素扫描的顺序一致
+    by_class: Dict[int, list] = {}
+    for dy, dx, weight in sorted(kernel.weights, key=lambda item: -item[0]):
+        by_class.setdefault(dx + kernel.lag * dy, []).append((dy * stride + dx, weight / kernel.divisor))
+    groups = []
+    for rank in range(max(len(members) for members in by_class.values())):
+        members = [members[rank] for members in by_class.values() if len(members) > rank]
+        groups.append((np.array([offset for offset, _ in members]),
+                       np.array([share for _, share in members], dtype=np.float32)))
+
+    # 波前 t 上第 y 行的像素位于 x = t - lag * y，它在缓冲区和结果中的展开位置都是 y 的线性函数加 t
+    rows = np.arange(height)
+    buffer_positions = rows * (stride - kernel.lag) + reach_x + np.arange(3)[:, None] * plane_size
+    output_positions = rows * (width - kernel.lag)
+    indices = np.empty(height * width, dtype=np.intp)
+    for t in range(width + kernel.lag * (height - 1)):
+        first = max(0, -(-(t - width + 1) // kernel.lag))
+        last = min(height - 1, t // kernel.lag) + 1
+        positions = buffer_positions[:, first:last] + t
+        current = values[positions]
+        matched = match(_quantize(current).T)
+        indices[output_positions[first:last] + t] = matched
+        error = current - palette_planes[:, matched]
+        for offsets, shares in groups:
+            values[(positions[:, :, None] + offsets).ravel()] += np.multiply.outer(error, shares).ravel()
+    return indices.reshape(height, width)
+
+
+def dither_colors(colors: np.ndarray, color_palette, method: DitherMethod = 'floyd_steinberg',
+                  metric: str = 'redmean') -> np.ndarray:
+    """
+    Map a grid of colors to palette indices with dithering.
+
+    :param colors: Array of shape (H, W, 3) with RGB colors, e.g. the reduced tile colors
+    :param color_palette: The ColorPalette to match against
+    :param method: 'none', 'bayer', 'floyd_steinberg', 'atkinson' or 'sierra'
+    :param metric: Distance metric used to match colors to the palette
+    :return: Array of shape (H, W) with palette indices
+    """
+    if method == 'none':
+        return color_palette.closest_colors(colors[..., :3], metric=metric)
+    if method == 'bayer':
+        return ordered_dither(colors[..., :3], color_palette, metric)
+    try:
+        kernel = DIFFUSION_KERNELS[method]
+    except KeyError:
+        raise ValueError(f"Unknown dither method: {method}. Choose one of {', '.join(DITHER_METHODS)}")
+    return error_diffusion(colors, color_palette, kernel, metric)
@@ -1,70 +1,217 @@
 from dataclasses import dataclass
 from PIL import Image
-from typing import Dict, List, Tuple, Literal
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple, Literal, Union
 import io
 from PIL import ImageStat
-from PIL import ImageOps  # 添加此行
-from PIL import ImageDraw
+from PIL import ImageFont
+import hashlib
+import logging
+import numpy as np
+from .color_distance import DistanceMetric, get_metric, palette_distance, redmean_distance  # noqa: F401 (旧的导入路径)
+from .color_space import linear_to_lab, srgb_to_linear
+from .block_reduce import ReducerName, image_to_array, reduce_tile_colors, reduce_tiles, tile_blocks
+from .dither import DitherMethod, dither_colors
+from .preview import render_preview
+from .tile_grid import AveragedImage, TileGrid, colors_to_indices
+from .ingest import IngestLimits, IngestReport, ingest_image
+from .instrument import stage
+from .parallel import reduce_tiles_parallel
+from .palette_lut import DEFAULT_CACHE_DIR, LutMode, PaletteLUT, load_or_build_lut
+from .palette_index import PaletteIndex, should_use_index
+logger = logging.getLogger(__name__)
+
 ImageFormat = Literal['JPEG', 'PNG', 'WEBP']
 WIDTH = int
 HEIGHT = int
 
+# closest_colors 每批处理的像素数，限制 (N, P) 距离矩阵的内存占用
+MATCH_CHUNK_SIZE = 8192
+
+
 class ColorPalette:
-    @dataclass    
+    @dataclass(frozen=True)
     class Color:
         name: str
         color_hex: str
 
-    def __init__(self, colors: List[Dict]):
-        self.colors = [self.Color(color['name'], color['color']) for color in colors]
+    def __init__(self, colors: List[Dict], strict: bool = False):
+        """
+        构建时一次性编译色板：颜色列表、名称/颜色 -> 索引的字典、RGB 数组、线性 RGB 和 Lab 数组。
+        这些结构构建后都是只读的，按名称、索引或 RGB 查找都是常数时间。
+        名称重复时按名称查找取第一条并记录警告，颜色本身都保留。
+
+        :param colors: [{'name': ..., 'color': 'rrggbb'}, ...]
+        :param strict: 名称重复时抛出异常，新色板应开启
+        :raises ValueError: strict 时颜色名称重复，或十六进制颜色无效
+        """
+        self.colors: Tuple[ColorPalette.Color, ...] = tuple(self.Color(color['name'], color['color']) for color in colors)
+        self.names: Tuple[str, ...] = tuple(color.name for color in self.colors)
+        self.hex: Tuple[str, ...] = tuple(color.color_hex for color in self.colors)
+
+        index_by_name = {}
+        duplicates = []
+        for index, name in enumerate(self.names):
+            if name in index_by_name:
+                duplicates.append(name)
+            index_by_name.setdefault(name, index)
+        if duplicates:
+            message = f"Duplicate color names in palette: {', '.join(sorted(set(duplicates)))}"
+            if strict:
+                raise ValueError(message)
+            logger.warning("%s; lookups by name use the first entry", message)
+        self.index_by_name: Mapping[str, int] = MappingProxyType(index_by_name)
+        self.index_by_color: Mapping[ColorPalette.Color, int] = MappingProxyType(
+            {color: index for index, color in enumerate(self.colors)})
+
+        # 预编译色板的 RGB 数组 (P, 3)，避免每次匹配都重新解析十六进制
+        self.rgb = np.array([self.hex_to_rgb(color_hex) for color_hex in self.hex], dtype=np.uint8).reshape(-1, 3)
+        self.linear_rgb = srgb_to_linear(self.rgb)
+        self.lab = linear_to_lab(self.linear_rgb)
+        for array in (self.rgb, self.linear_rgb, self.lab):
+            array.setflags(write=False)
+        # RGB 相同的颜色取第一个，与 closest_colors 距离相同时取第一个一致
+        index_by_rgb = {}
+        for index, rgb in enumerate(map(tuple, self.rgb.tolist())):
+            index_by_rgb.setdefault(rgb, index)
+        self.index_by_rgb: Mapping[Tuple[int, int, int], int] = MappingProxyType(index_by_rgb)
+
+        content = "\n".join(f"{color.name}:{color.color_hex.lower()}" for color in self.colors)
+        self._palette_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        # 由 build_lut 设置（每种距离公式一张表），设置后整数像素的匹配直接查表
+        self.luts: Dict[str, PaletteLUT] = {}
+        # 由 palette_index 按需构建（每种距离公式一个），大色板的批量匹配只比较候选色
+        self.indexes: Dict[str, PaletteIndex] = {}
+
+    def __len__(self) -> int:
+        return len(self.colors)
+
+    def __reduce__(self):
+        # MappingProxyType 不能 pickle：按颜色列表重建色板，已构建的查找表随状态一起传递，空间索引按需重建
+        colors = [{'name': color.name, 'color': color.color_hex} for color in self.colors]
+        return self.__class__, (colors,), {'luts': dict(self.luts)}
+
+    @property
+    def lut(self) -> Optional[PaletteLUT]:
+        """默认距离公式 (redmean) 的查找表"""
+        return self.luts.get('redmean')
+
+    @property
+    def palette_hash(self) -> str:
+        """色板内容的哈希，用作缓存键"""
+        return self._palette_hash
+
+    def index_of(self, name: str) -> int:
+        """根据颜色名称获取色板索引"""
+        try:
+            return self.index_by_name[name]
+        except KeyError:
+            raise ValueError(f"Color {name} not found in palette") from None
+
+    def index_of_rgb(self, rgb: Tuple[int, int, int]) -> Optional[int]:
+        """RGB 恰好是色板颜色时返回其索引，否则返回 None"""
+        return self.index_by_rgb.get(tuple(int(c) for c in rgb[:3]))
 
     def get_hex_from_name(self, name: str) -> str:
         """根据颜色名称获取十六进制颜色"""
-        for color in self.colors:
-            if color.name == name:
-                return color.color_hex
-        raise ValueError(f"Color {name} not found in palette")
-        
+        return self.hex[self.index_of(name)]
+
     def hex_to_rgb(self, hex_color: str) -> Tuple[int, int, int]:
         """将十六进制颜色转换为RGB元组"""
+        if len(hex_color) != 6:
+            raise ValueError(f"Invalid hex color: {hex_color!r}")
         return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
-    def closest_color(self, avg_color: Tuple[int, int, int]) -> Color:
+    def closest_color(self, avg_color: Tuple[int, int, int], metric: DistanceMetric = 'redmean') -> Color:
         """找到与平均颜色最接近的色板颜色"""
-        closest = None
-        min_distance = float('inf')
-
-        for color in self.colors:
-            palette_color = self.hex_to_rgb(color.color_hex)
-            # 使用简化的颜色差别公式计算距离
-            rmean = (avg_color[0] + palette_color[0]) / 2
-            rd = avg_color[0] - palette_color[0]
-            gd = avg_color[1] - palette_color[1]
-            bd = avg_color[2] - palette_color[2]
-            distance = (((512 + rmean) * rd * rd) // 256) + 4 * gd * gd + (((767 - rmean) * bd * bd) // 256)
-
-            if distance < min_distance:
-                min_distance = distance
-                closest = color
-
-        return closest
-
-
-def create_image_from_bytes(image_stream) -> Tuple[Image.Image, ImageFormat]:
+        index = self.closest_colors(np.asarray([avg_color[:3]]), metric=metric)[0]
+        return self.colors[index]
+
+    def closest_colors(self, pixels: np.ndarray, use_lut: bool = True, metric: DistanceMetric = 'redmean',
+                       use_index: Optional[bool] = None) -> np.ndarray:
+        """
+        批量查找最接近的色板颜色。
+
+        :param pixels: 形状为 (..., 3) 的 RGB 数组
+        :param use_lut: 已为该距离公式构建查找表且像素为整数时直接查表
+        :param metric: 距离公式：'redmean'（默认）、'euclidean'、'cie76'、'cie94' 或 'ciede2000'
+        :param use_index: 是否用空间索引匹配整数像素；None 时根据色板大小和像素数自动选择
+        :return: 形状为 (...) 的色板索引数组
+        """
+        pixels = np.asarray(pixels)
+        is_integer = np.issubdtype(pixels.dtype, np.integer)
+        lut = self.luts.get(metric) if use_lut else None
+        if lut is not None and is_integer:
+            return lut.lookup(pixels, self)
+        get_metric(metric)
+        flat = pixels.reshape(-1, 3)
+        if use_index is None:
+            use_index = should_use_index(metric, len(self.colors), len(flat))
+        if use_index and is_integer:
+            return self.index(metric).query(pixels)
+        indices = np.empty(len(flat), dtype=np.intp)
+        for start in range(0, len(flat), MATCH_CHUNK_SIZE):
+            chunk = flat[start:start + MATCH_CHUNK_SIZE]
+            # argmin 在距离相同时取第一个，与逐个比较时的 "<" 语义一致
+            indices[start:start + MATCH_CHUNK_SIZE] = palette_distance(chunk, self, metric).argmin(axis=1)
+        return indices.reshape(pixels.shape[:-1])
+
+    def index(self, metric: DistanceMetric = 'redmean') -> PaletteIndex:
+        """获取该距离公式的空间索引，第一次使用时构建"""
+        palette_index = self.indexes.get(metric)
+        if palette_index is None:
+            palette_index = self.indexes[metric] = PaletteIndex(self, metric)
+        return palette_index
+
+    def build_lut(self, mode: LutMode = 'exact', bits: int = 6, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                  metric: DistanceMetric = 'redmean') -> PaletteLUT:
+        """
+        构建 RGB -> 色板索引查找表，并缓存到磁盘。
+
+        redmean 使用可分离的整数算法；其他距离公式逐个红色切片穷举匹配，首次构建较慢
+        （CIEDE2000 的 exact 表需要几分钟），之后从磁盘缓存加载，每张图的匹配只剩查表。
+
+        :param mode: 'exact' 为完整的 256^3 表；'compact' 为量化表，边界附近的像素再精确匹配
+        :param bits: compact 模式下每个通道保留的位数 (6 即 64^3)
+        :param cache_dir: 缓存目录，None 表示不写磁盘
+        :param metric: 距离公式，每种公式各有一张表
+        :return: 查找表，同时保存在 self.luts[metric]
+        """
+        get_metric(metric)
+        match = lambda points: self.closest_colors(points, use_lut=False, metric=metric)
+        lut = load_or_build_lut(self.rgb, self.palette_hash, metric, mode, bits, cache_dir, match)
+        self.luts[metric] = lut
+        return lut
+
+def create_image_from_bytes(image_stream, target_size: Optional[Tuple[WIDTH, HEIGHT]] = None,
+                            limits: Optional[IngestLimits] = None) -> Tuple[Image.Image, ImageFormat]:
     """
     Create an image object from a byte stream and determine its format.
+
+    The image is decoded within the memory budget given by limits (see core.ingest);
+    larger images fall back to a reduced-resolution decode. When target_size is given
+    the image is decoded at the smallest resolution that is still at least target_size
+    (after EXIF rotation), so that resize_image only has to do the final resample.
     
     :param image_bytes: Byte stream of the image
+    :param target_size: Optional (width, height) the image will be resized to afterwards
+    :param limits: Optional decode budget, IngestLimits.from_env() by default
     :return: Tuple of (Image object, format)
     """
-    try:
-        img = Image.open(image_stream)
-        
-        # 使用ImageOps.exif_transpose处理EXIF方向
-        img = ImageOps.exif_transpose(img)
+    img, img_format, _ = decode_image_from_bytes(image_stream, target_size, limits)
+    return img, img_format  # Return both image and format
+
+
+def decode_image_from_bytes(image_stream, target_size: Optional[Tuple[WIDTH, HEIGHT]] = None,
+                            limits: Optional[IngestLimits] = None) -> Tuple[Image.Image, ImageFormat, IngestReport]:
+    """
+    Same as create_image_from_bytes, also returning the IngestReport of the decode.
 
-        img_format = img.format  # Get the image format
-        return img, img_format  # Return both image and format
+    :return: Tuple of (Image object, format, report)
+    """
+    try:
+        # 先读文件头，按内存预算和目标尺寸解码，并处理EXIF方向
+        return ingest_image(image_stream, target_size, limits)
     except Exception as e:
         raise ValueError("Failed to create image from bytes: " + str(e))  # Handle errors
 
@@ -77,19 +224,38 @@ def resize_image(image: Image.Image, target_size: Tuple[WIDTH, HEIGHT], resample
     :param target_size: Tuple of (width, height) for the target size
     :param resample_method: Resampling method to use (default: BICUBIC)
     """
-    resized_img = image.resize(target_size, resample=resample_method)
+    with stage('resize', pixels=target_size[0] * target_size[1]):
+        resized_img = image.resize(target_size, resample=resample_method)
     return resized_img
     
 
-def split_image_into_tiles(image: Image.Image, tile_shape: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette) -> Tuple[List[ColorPalette.Color], Image.Image, Dict[str, int]]:
+def split_image_into_tiles(image: Image.Image, tile_shape: Tuple[WIDTH, HEIGHT], color_palette: ColorPalette,
+                           reducer: ReducerName = 'mode', workers: Optional[int] = None,
+                           use_processes: Optional[bool] = None,
+                           metric: DistanceMetric = 'redmean',
+                           dither: DitherMethod = 'none') -> Tuple[TileGrid, AveragedImage, Dict[str, int]]:
     """
-    Splits the image into tiles, computes the average color of each tile,
+    Splits the image into tiles, reduces each tile to one color,
     and maps it to the closest color in the palette to reduce noise.
 
     :param image: The input image.
     :param tile_shape: Tuple of (width, height) representing the size of each tile.
     :param color_palette: An instance of ColorPalette.
-    :return: A tuple containing the list of tile colors, the resized image, and a dictionary of color counts.
+    :param reducer: How each tile is reduced: 'mode' (most frequent color, default), 'mean', 'median',
+                    'trimmed_mean' or 'palette_vote' (majority palette color of the tile's pixels).
+    :param workers: Process bands of whole tile rows on this many threads (or processes); None or 1 is serial.
+                    The result is identical to the serial path.
+    :param use_processes: Use a process pool reading the image from shared memory instead of threads.
+                          None (default) uses processes for 'mode', whose tie-break holds the GIL,
+                          and threads for the other reducers.
+    :param metric: Color distance used to match tiles to the palette: 'redmean' (default), 'euclidean',
+                   'cie76', 'cie94' or 'ciede2000'. A lookup table built for the metric is used when present.
+    :param dither: Dither the reduced tile colors while matching them to the palette: 'none' (default),
+                   'bayer', 'floyd_steinberg', 'atkinson' or 'sierra'. Not available with 'palette_vote';
+                   dithering needs the whole grid, so tiles are then reduced serially.
+    :return: A tuple containing the tile grid (palette indices, usable as a list of tile colors),
+             the averaged image (a lazy AveragedImage; materialize() builds the upscaled image),
+             and a dictionary of color counts.
     """
     tile_width, tile_height = tile_shape
     image_width, image_height = image.size
@@ -98,75 +264,48 @@ def split_image_into_tiles(image: Image.Image, tile_shape: Tuple[WIDTH, HEIGHT],
     num_tiles_x = image_width // tile_width
     num_tiles_y = image_height // tile_height
 
-    tiles = []
-    color_counts = {}
-    averaged_image = Image.new("RGB", (num_tiles_x, num_tiles_y))
-
-    for y in range(num_tiles_y):
-        for x in range(num_tiles_x):
-            # Define the region for the current tile
-            left = x * tile_width
-            upper = y * tile_height
-            right = left + tile_width
-            lower = upper + tile_height
-
-            tile = image.crop((left, upper, right, lower))
-
-            # Compute the most frequently occurring color of the tile
-            colors = list(tile.getdata())  # Get all pixel colors as a list
-            most_frequent_color = max(set(colors), key=colors.count)  # Find the most common color
-            avg_color = most_frequent_color  # Use the most frequent color
-
-            # Find the closest color in the palette
-            closest_color = color_palette.closest_color(avg_color)
-            tiles.append(closest_color)
-
-            # Update color count
-            color_name = closest_color.name
-            if color_name in color_counts:
-                color_counts[color_name] += 1
-            else:
-                color_counts[color_name] = 1
-
-            # Assign the closest color to the averaged_image
-            averaged_image.putpixel((x, y), color_palette.hex_to_rgb(closest_color.color_hex))
-
-    # Resize the averaged image to the original size using nearest neighbor to maintain uniform blocks
-    resized_image = averaged_image.resize((image_width, image_height), Image.NEAREST)
-
-    return tiles, resized_image, color_counts
-
-
-def preview_tiles(tiles: List[ColorPalette.Color], 
+    # 一次性把图像重排为 (色块数, 色块像素数, 通道) 的数组，所有色块同时归约并匹配色板
+    pixels = image_to_array(image)
+    if dither != 'none':
+        # 误差扩散依赖相邻色块，先归约出整张网格的代表色，再统一抖动匹配
+        colors = reduce_tile_colors(tile_blocks(pixels, tile_shape), reducer)
+        with stage('palette_match', pixels=len(colors)):
+            indices = dither_colors(colors.reshape(num_tiles_y, num_tiles_x, 3), color_palette, dither, metric)
+    elif workers is not None and workers > 1:
+        # 并行条带在其他线程/进程中运行，归约和色板匹配合并记为一个阶段
+        with stage('tile_reduce', pixels=pixels.shape[0] * pixels.shape[1]):
+            indices = reduce_tiles_parallel(pixels, tile_shape, color_palette, reducer, workers, use_processes, metric)
+    else:
+        indices = reduce_tiles(tile_blocks(pixels, tile_shape), color_palette, reducer, metric)
+    tiles = TileGrid(indices.reshape(num_tiles_y, num_tiles_x), color_palette)
+    color_counts = tiles.counts
+
+    # 平均色图像按需生成：调用 materialize() 才展开到原尺寸
+    averaged_image = AveragedImage(tiles, (image_width, image_height), tile_shape)
+
+    return tiles, averaged_image, color_counts
+
+
+def preview_tiles(tiles: Union[TileGrid, List[ColorPalette.Color]], 
                   tile_shape: Tuple[WIDTH, HEIGHT],
                   tile_image_size: Tuple[WIDTH, HEIGHT],
-                  color_palette: ColorPalette) -> Image.Image:
+                  color_palette: ColorPalette,
+                  show_labels: bool = True,
+                  font: Optional[ImageFont.ImageFont] = None) -> Image.Image:
     """
     根据色块颜色列表重新构建图像。
+
+    色块图层通过色板 RGB 表一次性展开，标签从按字体和色块尺寸缓存的字形图集中拼接。
     
-    :param tiles: 色块颜色列表
+    :param tiles: 色块网格 (TileGrid) 或色块颜色列表
     :param tile_shape: tiles 对应的图像二维排列尺寸
     :param tile_image_size: 每个色块的图像尺寸
+    :param show_labels: 是否在色块上绘制颜色名称
+    :param font: 标签字体，None 使用 Pillow 默认字体
     :return: 重建的图像
     """
-    # 计算图像的宽度和高度
-    img_width = tile_shape[0] * tile_image_size[0]
-    img_height = tile_shape[1] * tile_image_size[1]
-
-    # 创建一个新的图像
-    new_image = Image.new("RGB", (img_width, img_height))
-
-    for index, color in enumerate(tiles):
-        # 创建一个填充了最近色板颜色的色块
-        colored_tile = Image.new("RGB", tile_image_size, color_palette.hex_to_rgb(color.color_hex))
-
-        drawer = ImageDraw.Draw(colored_tile)
-        drawer.text((5, 5), color.name, fill=(255, 255, 255))
-
-        # 计算色块的放置位置
-        x_position = (index % tile_shape[0]) * tile_image_size[0]
-        y_position = (index // tile_shape[0]) * tile_image_size[1]
-        new_image.paste(colored_tile, (x_position, y_position))
-
-    return new_image
-
+    indices = colors_to_indices(tiles, color_palette)
+    with stage('preview_render') as record:
+        preview = render_preview(indices, tuple(tile_shape), tuple(tile_image_size), color_palette, show_labels, font)
+        record.pixels = preview.width * preview.height
+    return preview
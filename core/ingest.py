@@ -0,0 +1,212 @@
+import logging
+import math
+import os
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+
+from PIL import ExifTags, Image, ImageOps
+
+from .instrument import peak_rss_bytes, stage
+
+logger = logging.getLogger(__name__)
+
+WIDTH = int
+HEIGHT = int
+
+# Image.reduce 不支持的模式
+_UNREDUCIBLE_MODES = ('1', 'P', 'PA')
+# JPEG 解码时可以直接缩小的倍数 (DCT scaling)
+_JPEG_SCALES = (1, 2, 4, 8)
+
+
+def bytes_per_pixel(mode: str) -> int:
+    """Bytes Pillow uses per pixel for an image mode in memory (multi-band 8-bit modes are padded to 4)."""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+@dataclass(frozen=True)
+class IngestLimits:
+    """
+    Memory budget for decoding uploads.
+
+    :param max_pixels: Most pixels a decoded image may have; larger images are decoded at reduced resolution
+    :param max_decoded_bytes: Most bytes a decoded image may take in memory, same fallback as max_pixels
+    :param max_transient_pixels: Formats that cannot be scaled while decoding (everything but JPEG) are decoded
+                                 at full size before being reduced; larger ones are rejected
+    :param max_target_pixels: Most pixels a requested target size may have, see check_output_size
+    :param max_preview_pixels: Most pixels a requested preview may have, see check_output_size
+    """
+    max_pixels: int = 40_000_000
+    max_decoded_bytes: int = 160 * 1024 ** 2
+    max_transient_pixels: int = 100_000_000
+    max_target_pixels: int = 16_000_000
+    max_preview_pixels: int = 50_000_000
+
+    @classmethod
+    def from_env(cls) -> 'IngestLimits':
+        """
+        从环境变量 PIXEL_ART_MAX_PIXELS / PIXEL_ART_MAX_DECODED_BYTES / PIXEL_ART_MAX_TRANSIENT_PIXELS /
+        PIXEL_ART_MAX_TARGET_PIXELS / PIXEL_ART_MAX_PREVIEW_PIXELS 读取限制
+        """
+        defaults = cls()
+        return cls(
+            max_pixels=int(os.environ.get('PIXEL_ART_MAX_PIXELS', defaults.max_pixels)),
+            max_decoded_bytes=int(os.environ.get('PIXEL_ART_MAX_DECODED_BYTES', defaults.max_decoded_bytes)),
+            max_transient_pixels=int(os.environ.get('PIXEL_ART_MAX_TRANSIENT_PIXELS', defaults.max_transient_pixels)),
+            max_target_pixels=int(os.environ.get('PIXEL_ART_MAX_TARGET_PIXELS', defaults.max_target_pixels)),
+            max_preview_pixels=int(os.environ.get('PIXEL_ART_MAX_PREVIEW_PIXELS', defaults.max_preview_pixels)),
+        )
+
+    def check_output_size(self, target_size: Tuple[WIDTH, HEIGHT], tile_shape: Tuple[WIDTH, HEIGHT],
+                          preview_tile_size: Optional[Tuple[WIDTH, HEIGHT]] = None) -> None:
+        """
+        Reject requested sizes whose resized image or preview would not fit the budget.
+
+        The decode budget only bounds the source image; the resized image, its tile
+        blocks and the preview are allocated from the requested sizes, so those are
+        checked before any work is done.
+
+        :param target_size: Tuple of (width, height) the image is resized to
+        :param tile_shape: Tuple of (width, height) of each tile in the resized image
+        :param preview_tile_size: Tuple of (width, height) of each tile in the preview, None if no preview is made
+        :raise ValueError: If a size exceeds max_target_pixels or max_preview_pixels
+        """
+        target_pixels = target_size[0] * target_size[1]
+        if target_pixels > self.max_target_pixels:
+            raise ValueError(f"Target size {target_size[0]}x{target_size[1]} exceeds the limit of "
+                             f"{self.max_target_pixels} pixels")
+        if preview_tile_size is not None:
+            num_tiles = (target_size[0] // tile_shape[0]) * (target_size[1] // tile_shape[1])
+            preview_pixels = num_tiles * preview_tile_size[0] * preview_tile_size[1]
+            if preview_pixels > self.max_preview_pixels:
+                raise ValueError(f"Preview of {num_tiles} tiles of {preview_tile_size[0]}x{preview_tile_size[1]} "
+                                 f"pixels exceeds the limit of {self.max_preview_pixels} pixels")
+
+
+@dataclass
+class IngestReport:
+    """What happened while decoding one upload."""
+    format: Optional[str]
+    mode: str
+    source_size: Tuple[WIDTH, HEIGHT]
+    decoded_size: Tuple[WIDTH, HEIGHT]
+    reduction: int
+    budget_exceeded: bool
+    estimated_bytes: int
+    planned_bytes: int
+    actual_bytes: int
+    peak_rss_growth_bytes: int
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+def _stored_size(image: Image.Image, size: Tuple[WIDTH, HEIGHT]) -> Tuple[WIDTH, HEIGHT]:
+    """Convert a displayed size to the stored size when the EXIF orientation rotates by 90 degrees."""
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    if orientation in (5, 6, 7, 8):
+        return size[1], size[0]
+    return size
+
+
+def _budget_factor(width: int, height: int, mode: str, limits: IngestLimits) -> int:
+    """Smallest integer reduction that brings the decoded image within the limits."""
+    max_pixels = min(limits.max_pixels, limits.max_decoded_bytes // bytes_per_pixel(mode))
+    factor = max(1, math.isqrt(max(0, width * height - 1) // max(1, max_pixels)))
+    while math.ceil(width / factor) * math.ceil(height / factor) > max_pixels:
+        factor += 1
+    return factor
+
+
+def _target_factor(image: Image.Image, target_size: Optional[Tuple[WIDTH, HEIGHT]]) -> int:
+    """Largest integer reduction that keeps the image at least target_size."""
+    if target_size is None:
+        return 1
+    target_width, target_height = _stored_size(image, target_size)
+    if target_width <= 0 or target_height <= 0:
+        return 1
+    return max(1, min(image.width // target_width, image.height // target_height))
+
+
+def ingest_image(image_stream, target_size: Optional[Tuple[WIDTH, HEIGHT]] = None,
+                 limits: Optional[IngestLimits] = None) -> Tuple[Image.Image, Optional[str], IngestReport]:
+    """
+    Decode an upload within a memory budget.
+
+    The header is read first. If decoding at full size would exceed the limits, the
+    image is decoded at reduced resolution instead of failing: JPEGs are scaled by
+    libjpeg while decoding, other formats are decoded and reduced right away (as long
+    as they are under max_transient_pixels). When target_size is given the image is
+    also reduced as far as possible while staying at least target_size. EXIF
+    orientation is applied last.
+
+    :param image_stream: Byte stream of the image
+    :param target_size: Optional (width, height) the image will be resized to afterwards
+    :param limits: Memory budget, IngestLimits.from_env() by default
+    :return: Tuple of (Image object, format, report)
+    """
+    limits = limits or IngestLimits.from_env()
+    rss_before = peak_rss_bytes()
+
+    with stage('decode') as decode_record:
+        with warnings.catch_warnings():
+            # 像素上限由 IngestLimits 控制，Pillow 的警告只会干扰日志
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            img = Image.open(image_stream)
+        img_format = img.format
+        source_size = img.size
+        pixel_bytes = bytes_per_pixel(img.mode)
+        estimated_bytes = img.width * img.height * pixel_bytes
+
+        source_budget_factor = _budget_factor(img.width, img.height, img.mode, limits)
+        decode_scale = 1
+        if img_format == 'JPEG':
+            # libjpeg 在解码时按 1/2、1/4、1/8 缩小：优先满足内存预算，其次在不小于目标尺寸的前提下尽量缩小
+            budget_scale = min([s for s in _JPEG_SCALES if s >= source_budget_factor] or [_JPEG_SCALES[-1]])
+            target_scale = max(s for s in _JPEG_SCALES if s <= _target_factor(img, target_size))
+            decode_scale = max(budget_scale, target_scale)
+            if decode_scale > 1:
+                img.draft(img.mode, (img.width // decode_scale, img.height // decode_scale))
+
+        # 解码后仍超出预算（或仍大于目标尺寸的整数倍）时，再用 Image.reduce 缩小
+        budget_factor = _budget_factor(img.width, img.height, img.mode, limits)
+        factor = max(budget_factor, _target_factor(img, target_size))
+        planned_bytes = math.ceil(img.width / factor) * math.ceil(img.height / factor) * pixel_bytes
+        if factor > 1:
+            if budget_factor > 1 and img.width * img.height > limits.max_transient_pixels:
+                raise ValueError(f"Image of {img.width}x{img.height} pixels exceeds the decode budget "
+                                 f"and {img_format} cannot be decoded at a lower resolution")
+            if img.mode in _UNREDUCIBLE_MODES:
+                img = img.convert('RGBA' if 'transparency' in img.info or img.mode == 'PA' else 'RGB')
+            img.load()
+            img = img.reduce(factor)
+        # Image.open 只读取文件头，这里完成解码（已缩小的图像不会重复解码）
+        img.load()
+        decode_record.pixels = img.width * img.height
+
+    with stage('exif_transpose', pixels=img.width * img.height):
+        img = ImageOps.exif_transpose(img)
+
+    report = IngestReport(
+        format=img_format,
+        mode=img.mode,
+        source_size=source_size,
+        decoded_size=img.size,
+        reduction=decode_scale * factor,
+        budget_exceeded=source_budget_factor > 1,
+        estimated_bytes=estimated_bytes,
+        planned_bytes=planned_bytes,
+        actual_bytes=img.width * img.height * bytes_per_pixel(img.mode),
+        peak_rss_growth_bytes=max(0, peak_rss_bytes() - rss_before),
+    )
+    # 超出内存预算而降低分辨率解码时记为警告，默认的日志配置也会输出
+    logger.log(logging.WARNING if report.budget_exceeded else logging.INFO,
+               "ingested %s %sx%s -> %sx%s (1/%s), estimated %d bytes, actual %d bytes, peak RSS +%d bytes",
+               img_format, source_size[0], source_size[1], img.width, img.height, decode_scale * factor,
+               report.estimated_bytes, report.actual_bytes, report.peak_rss_growth_bytes)
+    return img, img_format, report
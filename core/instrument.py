@@ -0,0 +1,211 @@
+"""
+Per-stage timing and memory instrumentation.
+
+Core functions wrap their work in `stage(name)`. Nothing is recorded unless a
+Profile is active in the current context:
+
+    with Profile(trace_memory=True) as profile:
+        run_pipeline(...)
+    profile.as_dict()
+
+Finished profiles can be fed into a MetricsRegistry, which renders Prometheus text
+exposition for the REST deployment.
+"""
+import bisect
+import contextvars
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+STAGES = ('decode', 'exif_transpose', 'resize', 'tile_reduce', 'palette_match', 'preview_render', 'encode')
+
+# 直方图的桶上限（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current_profile: contextvars.ContextVar = contextvars.ContextVar('pixel_art_profile', default=None)
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@dataclass
+class StageRecord:
+    """
+    One run of one stage.
+
+    cpu_seconds is process CPU time, so it includes other threads working at the same
+    time. alloc_peak_bytes is the tracemalloc peak above the allocations live when the
+    stage started (None unless the profile traces memory); peak_rss_growth_bytes only
+    grows when the stage pushes the process to a new RSS peak.
+    """
+    name: str
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    pixels: int = 0
+    alloc_peak_bytes: Optional[int] = None
+    peak_rss_growth_bytes: int = 0
+
+
+class Profile:
+    """
+    Collects the stage records of one pipeline run.
+
+    A profile can be entered again while it is active (e.g. run_pipeline inside a
+    job that also times its encode step); records keep going to the same profile.
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.records: List[StageRecord] = []
+        self._tokens: List[contextvars.Token] = []
+        self._started_tracing = False
+
+    def __enter__(self) -> 'Profile':
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._tokens.append(_current_profile.set(self))
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _current_profile.reset(self._tokens.pop())
+        if self._started_tracing and not self._tokens:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def as_dict(self) -> Dict:
+        return {
+            'stages': [asdict(record) for record in self.records],
+            'wall_seconds': sum(record.wall_seconds for record in self.records),
+            'cpu_seconds': sum(record.cpu_seconds for record in self.records),
+            'peak_rss_bytes': peak_rss_bytes(),
+        }
+
+
+def current_profile() -> Optional['Profile']:
+    """The profile active in this context, if any."""
+    return _current_profile.get()
+
+
+@contextmanager
+def stage(name: str, pixels: int = 0) -> Iterator[StageRecord]:
+    """
+    Time the enclosed block as one stage of the active profile.
+
+    The yielded record's `pixels` can be set inside the block once the size is known.
+    Without an active profile this only creates the record.
+
+    :param name: Stage name, one of STAGES
+    :param pixels: Number of pixels the stage processes
+    """
+    record = StageRecord(name, pixels=pixels)
+    profile = _current_profile.get()
+    if profile is None:
+        yield record
+        return
+
+    tracing = profile.trace_memory and tracemalloc.is_tracing()
+    if tracing:
+        alloc_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    rss_before = peak_rss_bytes()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record.wall_seconds = time.perf_counter() - wall_start
+        record.cpu_seconds = time.process_time() - cpu_start
+        record.peak_rss_growth_bytes = max(0, peak_rss_bytes() - rss_before)
+        if tracing:
+            record.alloc_peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - alloc_before)
+        profile.records.append(record)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label: str = 'stage'):
+        self.name, self.documentation, self.label = name, documentation, label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_value, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value:g}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label: str = 'stage',
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.documentation, self.label = name, documentation, label
+        self.buckets = tuple(sorted(buckets))
+        # 每个标签值：(各桶计数（不累加）, 总和, 总数)
+        self._values: Dict[str, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            counts, total, count = self._values.get(label_value) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[label_value] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for upper, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if upper == float('inf') else f"{upper:g}"
+                    lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{le}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total:g}')
+                lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Per-stage Prometheus metrics aggregated from finished profiles.
+
+    Every process has its own registry; with several gunicorn workers each scrape
+    sees the worker that answered it.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix: str = 'pixel_art'):
+        self.stage_seconds = Histogram(f'{prefix}_stage_seconds', "Wall time of pipeline stages")
+        self.stage_cpu_seconds = Counter(f'{prefix}_stage_cpu_seconds_total', "CPU time spent in pipeline stages")
+        self.stage_pixels = Counter(f'{prefix}_stage_pixels_total', "Pixels processed by pipeline stages")
+        self.stage_runs = Counter(f'{prefix}_stage_runs_total', "Number of pipeline stage runs")
+
+    def observe(self, profile: Dict) -> None:
+        """Add the stages of a Profile.as_dict() result."""
+        for record in profile['stages']:
+            name = record['name']
+            self.stage_seconds.observe(name, record['wall_seconds'])
+            self.stage_cpu_seconds.inc(name, record['cpu_seconds'])
+            self.stage_pixels.inc(name, record['pixels'])
+            self.stage_runs.inc(name)
+
+    def render(self) -> str:
+        metrics = (self.stage_seconds, self.stage_cpu_seconds, self.stage_pixels, self.stage_runs)
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+# 进程内默认的指标注册表
+default_metrics = MetricsRegistry()
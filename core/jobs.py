@@ -0,0 +1,345 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from .artifacts import EncodeOptions, encode_image
+from .block_reduce import ReducerName
+from .color_distance import DistanceMetric
+from .dither import DitherMethod
+from .cache import DiskCache, ResultCache, default_cache, hash_bytes, make_key
+from .hanlde_image import HEIGHT, WIDTH
+from .instrument import MetricsRegistry, Profile, default_metrics
+from .palette import PALETTES, build_luts, lut_metrics_from_env
+from .pipeline import PREVIEW_TILE_SIZE, run_pipeline
+
+JOB_STATES = ('queued', 'running', 'done', 'failed')
+# 多个 HTTP worker 共享的任务目录，见 JobStore
+DEFAULT_JOB_DIR = os.path.join(tempfile.gettempdir(), 'pixel-art-jobs')
+# 任务记录和结果在磁盘上保留的时间（秒）
+JOB_TTL_SECONDS = 24 * 3600
+# 两次清理过期任务文件之间至少间隔的秒数
+PRUNE_INTERVAL_SECONDS = 60
+
+# 子进程中的进度队列，由 _init_worker 设置
+_progress_queue = None
+
+
+class QueueFullError(RuntimeError):
+    """Raised by JobQueue.submit when the queue depth limit is reached."""
+
+
+@dataclass(frozen=True)
+class JobSpec:
+    """Parameters of one pattern job."""
+    target_size: Tuple[WIDTH, HEIGHT]
+    tile_shape: Tuple[WIDTH, HEIGHT]
+    palette: str = 'mard'
+    reducer: ReducerName = 'mode'
+    metric: DistanceMetric = 'redmean'
+    dither: DitherMethod = 'none'
+    preview_tile_size: Tuple[WIDTH, HEIGHT] = PREVIEW_TILE_SIZE
+    with_preview: bool = True
+    preview_format: str = 'PNG'
+
+
+@dataclass
+class JobOutput:
+    """What a worker sends back; this is what lands in the result cache."""
+    indices: np.ndarray
+    preview: Optional[bytes]
+    preview_format: str
+    # 工作进程中记录的各阶段耗时，见 Profile.as_dict
+    profile: Dict = field(default_factory=dict)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indices.nbytes + (len(self.preview) if self.preview else 0)
+
+
+@dataclass
+class Job:
+    id: str
+    spec: JobSpec
+    key: str
+    state: str = 'queued'
+    stage: Optional[str] = None
+    # 各阶段开始的时间（相对提交时间，秒）
+    stages: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+    profile: Optional[Dict] = None
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    # 接收任务、运行进程池的进程；它退出后未完成的任务不会再有进展
+    owner_pid: int = field(default_factory=os.getpid)
+
+    def as_dict(self) -> Dict:
+        status = asdict(self)
+        status.pop('key')
+        status.pop('owner_pid')
+        return status
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """
+    Job records and outputs in a directory shared by every HTTP worker on a host.
+
+    Gunicorn runs one JobQueue per worker process, and a poll usually reaches a
+    different worker than the one that accepted the job. The accepting worker writes
+    the job record on every state change and the output when it finishes; any worker
+    can then answer status and result requests from here. Files older than ttl
+    seconds are removed.
+    """
+
+    def __init__(self, directory: str = DEFAULT_JOB_DIR, ttl: float = JOB_TTL_SECONDS):
+        self.directory = directory
+        self.ttl = ttl
+        self.records = DiskCache(os.path.join(directory, 'records'))
+        self.outputs = DiskCache(os.path.join(directory, 'outputs'))
+        self._last_prune = 0.0
+
+    def save(self, job: Job) -> None:
+        self.records.put(job.id, job)
+
+    def load(self, job_id: str) -> Optional[Job]:
+        """读取任务记录；接收任务的进程已经退出而任务未完成时，记为失败"""
+        job = self.records.get(job_id)
+        if job is not None and job.state in ('queued', 'running') and not _process_alive(job.owner_pid):
+            job.state, job.error = 'failed', "The worker running the job exited"
+            job.finished_at = time.time()
+        return job
+
+    def save_output(self, key: str, output: JobOutput) -> None:
+        self.outputs.put(key, output)
+
+    def load_output(self, key: str) -> Optional[JobOutput]:
+        return self.outputs.get(key)
+
+    def prune(self) -> None:
+        """删除过期的任务文件，两次清理之间至少间隔 PRUNE_INTERVAL_SECONDS"""
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL_SECONDS:
+            return
+        self._last_prune = now
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < now - self.ttl:
+                        os.remove(path)
+                except OSError:
+                    pass  # 其他 worker 可能同时在清理
+
+
+def pool_size_per_worker(total_processes: int, http_workers: int) -> int:
+    """每个 HTTP worker 的进程池大小，使所有 worker 的进程总数不超过 total_processes（每个至少 1 个）"""
+    return max(1, total_processes // max(1, http_workers))
+
+
+def _init_worker(progress_queue, lut_mode: str, lut_metrics: Tuple[str, ...] = ('redmean',)) -> None:
+    """在每个工作进程启动时执行一次：记录进度队列并加载色板查找表"""
+    global _progress_queue
+    _progress_queue = progress_queue
+    build_luts(lut_mode, lut_metrics)
+
+
+def _run_job(job_id: str, image_bytes: bytes, spec: JobSpec) -> JobOutput:
+    def report(stage: str) -> None:
+        if _progress_queue is not None:
+            _progress_queue.put((job_id, stage, time.time()))
+
+    color_palette = PALETTES[spec.palette]
+    profile = Profile()
+    with profile:
+        # 进程内不缓存，结果由父进程写入共享的结果缓存
+        result = run_pipeline(image_bytes, spec.target_size, spec.tile_shape, color_palette,
+                              reducer=spec.reducer, metric=spec.metric, dither=spec.dither, preview_tile_size=spec.preview_tile_size,
+                              cache=None, with_preview=spec.with_preview, on_stage=report, profile=profile)
+        preview = None
+        if result.preview_image is not None:
+            report('encode')
+            preview = encode_image(result.preview_image, EncodeOptions(format=spec.preview_format))
+    timings = {**profile.as_dict(), 'ingest': result.ingest.as_dict() if result.ingest else None}
+    return JobOutput(result.tiles.indices, preview, spec.preview_format, timings)
+
+
+class JobQueue:
+    """
+    Runs pattern jobs on a process pool.
+
+    submit() returns a job id right away; status() reports the state and the current
+    pipeline stage, and result() reads the finished output from the result cache.
+    Each worker loads the palettes and their lookup tables once at startup. Jobs
+    whose result is already cached finish immediately, and submit() raises
+    QueueFullError once max_queue_depth jobs are queued or running in this queue.
+    Stage timings measured in the workers are added to `metrics` as jobs finish.
+
+    With a JobStore, job records and outputs are also written to disk, so the
+    queues of all HTTP worker processes can answer for each other's jobs.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_queue_depth: int = 16,
+                 cache: ResultCache = default_cache, lut_mode: str = 'exact',
+                 max_finished: int = 256, start_method: str = 'spawn',
+                 metrics: Optional[MetricsRegistry] = default_metrics, lut_metrics: Tuple[str, ...] = ('redmean',),
+                 store: Optional[JobStore] = None):
+        context = multiprocessing.get_context(start_method)
+        self.metrics = metrics
+        self.max_queue_depth = max_queue_depth
+        self.max_finished = max_finished
+        self.cache = cache
+        self.store = store
+        self._jobs: 'OrderedDict[str, Job]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._progress = context.Queue()
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                             initializer=_init_worker, initargs=(self._progress, lut_mode, tuple(lut_metrics)))
+        self._listener = threading.Thread(target=self._listen, name='job-progress', daemon=True)
+        self._listener.start()
+
+    @classmethod
+    def from_env(cls) -> 'JobQueue':
+        """
+        从环境变量创建：PIXEL_ART_JOB_PROCESSES 是所有 HTTP worker 合计的进程池上限（默认 CPU 数），
+        按 PIXEL_ART_WORKERS 个 HTTP worker 平分；任务记录和结果写入 PIXEL_ART_JOB_DIR 共享。
+        另有 PIXEL_ART_JOB_QUEUE_DEPTH / PIXEL_ART_LUT_MODE / PIXEL_ART_LUT_METRICS
+        """
+        cpu_count = os.cpu_count() or 1
+        total_processes = int(os.environ.get('PIXEL_ART_JOB_PROCESSES', cpu_count))
+        http_workers = int(os.environ.get('PIXEL_ART_WORKERS', cpu_count))
+        return cls(max_workers=pool_size_per_worker(total_processes, http_workers),
+                   max_queue_depth=int(os.environ.get('PIXEL_ART_JOB_QUEUE_DEPTH', 16)),
+                   lut_mode=os.environ.get('PIXEL_ART_LUT_MODE', 'exact'),
+                   lut_metrics=lut_metrics_from_env(),
+                   store=JobStore(os.environ.get('PIXEL_ART_JOB_DIR', DEFAULT_JOB_DIR)))
+
+    @property
+    def depth(self) -> int:
+        """Number of queued or running jobs."""
+        with self._lock:
+            return sum(job.state in ('queued', 'running') for job in self._jobs.values())
+
+    def submit(self, image_bytes: bytes, spec: JobSpec) -> str:
+        """
+        Queue a job.
+
+        :param image_bytes: Raw bytes of the uploaded image
+        :param spec: Job parameters
+        :return: The job id
+        """
+        if spec.palette not in PALETTES:
+            raise ValueError(f"Unknown palette: {spec.palette}")
+        key = make_key('job', hash_bytes(image_bytes), PALETTES[spec.palette].palette_hash, spec)
+        job = Job(uuid.uuid4().hex, spec, key)
+
+        if self.store is not None:
+            self.store.prune()
+        with self._lock:
+            if self.cache.get(key) is not None or (self.store is not None and self.store.load_output(key) is not None):
+                job.state, job.finished_at = 'done', time.time()
+                self._remember(job)
+                return job.id
+            if sum(j.state in ('queued', 'running') for j in self._jobs.values()) >= self.max_queue_depth:
+                raise QueueFullError(f"Job queue is full ({self.max_queue_depth} jobs pending)")
+            self._remember(job)
+
+        future = self._executor.submit(_run_job, job.id, image_bytes, spec)
+        future.add_done_callback(lambda f, job_id=job.id: self._finish(job_id, f))
+        return job.id
+
+    def _get(self, job_id: str) -> Job:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job
+        # 任务可能由另一个 HTTP worker 接收
+        job = self.store.load(job_id) if self.store is not None else None
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def status(self, job_id: str) -> Dict:
+        """Current status of a job; raises KeyError for unknown ids."""
+        job = self._get(job_id)
+        with self._lock:
+            return job.as_dict()
+
+    def result(self, job_id: str) -> Optional[JobOutput]:
+        """Output of a finished job, or None if it is not done or was evicted from the cache."""
+        job = self._get(job_id)
+        if job.state != 'done':
+            return None
+        output = self.cache.get(job.key)
+        if output is None and self.store is not None:
+            output = self.store.load_output(job.key)
+        return output
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+        self._progress.put(None)
+        self._listener.join()
+
+    def _save(self, job: Job) -> None:
+        if self.store is not None:
+            self.store.save(job)
+
+    def _remember(self, job: Job) -> None:
+        self._jobs[job.id] = job
+        self._save(job)
+        # 只保留最近 max_finished 个已结束的任务
+        finished = [job_id for job_id, j in self._jobs.items() if j.state in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _listen(self) -> None:
+        while True:
+            message = self._progress.get()
+            if message is None:
+                return
+            job_id, stage, timestamp = message
+            with self._lock:
+                job = self._jobs.get(job_id)
+                # 进度消息可能晚于结果到达，已结束的任务忽略
+                if job is None or job.state not in ('queued', 'running'):
+                    continue
+                job.state, job.stage = 'running', stage
+                job.stages[stage] = round(timestamp - job.submitted_at, 6)
+                self._save(job)
+
+    def _finish(self, job_id: str, future: Future) -> None:
+        error = future.exception()
+        if error is None:
+            output = future.result()
+            with self._lock:
+                key = self._jobs[job_id].key
+            self.cache.put(key, output)
+            if self.store is not None:
+                self.store.save_output(key, output)
+            if self.metrics is not None:
+                self.metrics.observe(output.profile)
+        with self._lock:
+            job = self._jobs[job_id]
+            job.finished_at = time.time()
+            if error is None:
+                job.state, job.stage, job.profile = 'done', None, output.profile
+            else:
+                job.state, job.error = 'failed', str(error)
+            self._save(job)
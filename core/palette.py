@@ -1,3 +1,6 @@
+import os
+from typing import Tuple
+
 from .hanlde_image import ColorPalette
 
 mardPalette = ColorPalette([
@@ -66,6 +69,8 @@ mardPalette = ColorPalette([
     { "name": 'D3', "color": '0f50b0' },
     { "name": 'D4', "color": '123178' },
     { "name": 'D5', "color": 'bb26b6' },
+    # D6 出现两次（aa76e4 和 ab73ff），两条都是在用的颜色。按名称查找取第一条；
+    # 第二条的正式编号需要色板维护者确认，确认前保留原数据
     { "name": 'D6', "color": 'aa76e4' },
     { "name": 'D6', "color": 'ab73ff' },
     { "name": 'D7', "color": '7927ce' },
@@ -171,3 +176,22 @@ mardPalette = ColorPalette([
     { "name": 'M15', "color": '7f7f7f' },
 ])
 
+# 可按名称选择的色板
+PALETTES = {
+    'mard': mardPalette,
+}
+
+
+def lut_metrics_from_env() -> Tuple[str, ...]:
+    """环境变量 PIXEL_ART_LUT_METRICS（逗号分隔）指定预先构建查找表的距离公式，默认只有 redmean"""
+    return tuple(m.strip() for m in os.environ.get('PIXEL_ART_LUT_METRICS', 'redmean').split(',') if m.strip())
+
+
+def build_luts(mode: str = 'exact', metrics: Tuple[str, ...] = ('redmean',)) -> None:
+    """为所有色板构建（或从磁盘缓存加载）查找表；mode 为 'none' 时不构建"""
+    if mode == 'none':
+        return
+    for color_palette in PALETTES.values():
+        for metric in metrics:
+            if metric not in color_palette.luts:
+                color_palette.build_lut(mode, metric=metric)
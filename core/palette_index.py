@@ -0,0 +1,194 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from .color_distance import get_metric
+from .color_space import lab_box, srgb_to_lab
+
+# 支持空间索引的距离公式：这些公式在 RGB 单元上有可计算的上下界
+INDEXED_METRICS = ('redmean', 'euclidean', 'cie76')
+# 自动选择索引的阈值 (最少颜色数, 最少像素数)，由 benchmark.py --crossover 在随机像素上测得；
+# 色板或批次更小时穷举更快。cie76 的界较松、候选色更多，交叉点更靠后
+INDEX_THRESHOLDS: Dict[str, Tuple[int, int]] = {
+    'redmean': (64, 1024),
+    'euclidean': (64, 1024),
+    'cie76': (128, 2048),
+}
+# 每种公式默认的单元划分：Lab 盒子的界较松，用更细的单元
+DEFAULT_CELL_BITS: Dict[str, int] = {'redmean': 4, 'euclidean': 4, 'cie76': 5}
+# 构建和查询时每批处理的 (像素/单元, 颜色) 元素数，限制临时数组的内存占用
+CHUNK_ELEMENTS = 1 << 20
+# 按最宽的候选列表一次算完的批次上限（像素数 × 宽度）：更大的批次只在填充浪费不超过一倍时才这样算，
+# 否则按宽度分组。流式处理的条带通常有几万像素，少数单元有 20 多个候选色而多数只有 1~4 个
+SINGLE_PASS_ELEMENTS = 1 << 16
+
+
+def _gaps(low: np.ndarray, high: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Smallest and largest |x - v| over x in [low, high], broadcast over the inputs."""
+    nearest = np.maximum(np.maximum(low - values, values - high), 0)
+    farthest = np.maximum(np.abs(values - low), np.abs(values - high))
+    return nearest, farthest
+
+
+def _euclidean_bounds(low: np.ndarray, high: np.ndarray, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bounds of the squared Euclidean distance between any point of a box and every palette color.
+
+    :param low: Array of shape (C, 3) with the low corners of the boxes
+    :param high: Array of shape (C, 3) with the high corners of the boxes
+    :param palette: Array of shape (P, 3) with palette colors in the same space
+    :return: Tuple of (lower, upper) arrays of shape (C, P)
+    """
+    lower = upper = 0
+    for channel in range(3):
+        nearest, farthest = _gaps(low[:, channel, None], high[:, channel, None], palette[None, :, channel])
+        lower = lower + nearest * nearest
+        upper = upper + farthest * farthest
+    return lower, upper
+
+
+def _lab_bounds(low: np.ndarray, high: np.ndarray, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Lab 盒子和像素的 Lab 值都是浮点运算得到的，留一点余量防止舍入误差剪掉真正的最近色
+    lower, upper = _euclidean_bounds(low, high, palette)
+    return lower * (1 - 1e-9) - 1e-9, upper * (1 + 1e-9) + 1e-9
+
+
+def _redmean_bounds(low: np.ndarray, high: np.ndarray, palette: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bounds of the redmean distance between any pixel of an RGB box and every palette color.
+
+    Uses the integer form floor((1024 + r + pr) * dr^2 / 512) + 4 * dg^2
+    + floor((1534 - r - pr) * db^2 / 512) of redmean_distance. Every term is monotonic
+    in its weight and in the squared difference, so the extremes are taken at the box
+    edges and the bounds are exact integers.
+    """
+    low = low.astype(np.int64)
+    high = high.astype(np.int64)
+    palette = palette.astype(np.int64)
+    red_low, red_high, pr = low[:, 0, None], high[:, 0, None], palette[None, :, 0]
+    near_r, far_r = _gaps(red_low, red_high, pr)
+    near_g, far_g = _gaps(low[:, 1, None], high[:, 1, None], palette[None, :, 1])
+    near_b, far_b = _gaps(low[:, 2, None], high[:, 2, None], palette[None, :, 2])
+    lower = ((1024 + red_low + pr) * near_r ** 2 // 512 + 4 * near_g ** 2
+             + (1534 - red_high - pr) * near_b ** 2 // 512)
+    upper = ((1024 + red_high + pr) * far_r ** 2 // 512 + 4 * far_g ** 2
+             + (1534 - red_low - pr) * far_b ** 2 // 512)
+    return lower, upper
+
+
+class PaletteIndex:
+    """
+    Spatial index over the RGB cube for matching pixels to a large palette.
+
+    The cube is split into (2^cell_bits)^3 cells. For every cell the distance from any
+    of its pixels to each palette color is bounded from below and above; a color whose
+    lower bound exceeds the smallest upper bound can never be the closest one, so each
+    cell keeps only the remaining candidates. A query looks up the pixel's cell and
+    computes exact distances to those candidates only, which gives exactly the indices
+    of the brute-force search (candidates are kept in palette order, so ties still go to
+    the lowest index).
+
+    A KD-tree needs a fixed Euclidean metric; this grid works for redmean, whose weights
+    depend on the pixel, and is plain numpy.
+    """
+
+    def __init__(self, color_palette, metric: str = 'redmean', cell_bits: Optional[int] = None):
+        if metric not in INDEXED_METRICS:
+            raise ValueError(f"The {metric} metric cannot be indexed. Choose one of {', '.join(INDEXED_METRICS)}")
+        if cell_bits is None:
+            cell_bits = DEFAULT_CELL_BITS[metric]
+        if not 1 <= cell_bits <= 6:
+            raise ValueError("Palette indexes need between 1 and 6 bits per channel")
+        self.metric = metric
+        self.cell_bits = cell_bits
+        self.color_distance = get_metric(metric)
+        self.palette_values = color_palette.lab if self.color_distance.space == 'lab' else color_palette.rgb
+
+        step = 1 << (8 - cell_bits)
+        num_cells = 1 << (3 * cell_bits)
+        # 单元编号为 (r << 2b) | (g << b) | b，与 np.indices 展开的顺序一致
+        rgb_low = np.indices((1 << cell_bits,) * 3).reshape(3, -1).T * step
+        rgb_high = rgb_low + step - 1
+        if metric == 'redmean':
+            low, high, bounds = rgb_low, rgb_high, _redmean_bounds
+        elif metric == 'euclidean':
+            low, high, bounds = rgb_low, rgb_high, _euclidean_bounds
+        else:
+            low, high = lab_box(rgb_low, rgb_high)
+            bounds = _lab_bounds
+
+        num_colors = len(self.palette_values)
+        batch = max(1, CHUNK_ELEMENTS // num_colors)
+        candidate_masks = np.empty((num_cells, num_colors), dtype=bool)
+        for start in range(0, num_cells, batch):
+            lower, upper = bounds(low[start:start + batch], high[start:start + batch], self.palette_values)
+            candidate_masks[start:start + batch] = lower <= upper.min(axis=1, keepdims=True)
+
+        self.counts = candidate_masks.sum(axis=1)
+        width = int(self.counts.max())
+        candidates = np.empty((num_cells, width), dtype=np.int32)
+        for start in range(0, num_cells, batch):
+            # 稳定排序把候选色按索引顺序排到前面，不足的位置用第一个候选色填充
+            masks = candidate_masks[start:start + batch]
+            order = np.argsort(~masks, axis=1, kind='stable')[:, :width]
+            padding = np.arange(width)[None, :] >= self.counts[start:start + batch, None]
+            candidates[start:start + batch] = np.where(padding, order[:, :1], order)
+        self.candidates = candidates
+        # 查询时按候选数向上取整到 2 的幂分组，每组只截取需要的列
+        self.widths = np.minimum(1 << np.ceil(np.log2(self.counts)).astype(np.int64), width)
+        for array in (self.counts, self.candidates, self.widths):
+            array.setflags(write=False)
+
+    @property
+    def nbytes(self) -> int:
+        return self.counts.nbytes + self.candidates.nbytes + self.widths.nbytes
+
+    def mean_candidates(self) -> float:
+        """每个单元平均的候选色数量"""
+        return float(self.counts.mean())
+
+    def query(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Find the closest palette color of every pixel.
+
+        :param pixels: Integer array of shape (..., 3) with values in 0..255
+        :return: Array of shape (...) with palette indices
+        """
+        pixels = np.asarray(pixels)
+        if not np.issubdtype(pixels.dtype, np.integer):
+            raise ValueError("Palette indexes only match integer pixels")
+        flat = pixels.reshape(-1, 3)
+        shift = 8 - self.cell_bits
+        channels = flat.astype(np.intp) >> shift
+        cells = (channels[:, 0] << (2 * self.cell_bits)) | (channels[:, 1] << self.cell_bits) | channels[:, 2]
+
+        cell_widths = self.widths[cells]
+        widest = int(cell_widths.max(initial=1))
+        padded = len(flat) * widest
+        if padded <= SINGLE_PASS_ELEMENTS or padded <= min(CHUNK_ELEMENTS, 2 * int(cell_widths.sum())):
+            # 小批量（或各单元候选数相近时）直接按最宽的候选列表一次算完，省去分组的开销
+            return self._match(flat, cells, widest).reshape(pixels.shape[:-1])
+
+        indices = np.empty(len(flat), dtype=np.intp)
+        for width in np.unique(cell_widths):
+            members = np.flatnonzero(cell_widths == width)
+            batch = max(1, CHUNK_ELEMENTS // int(width))
+            for start in range(0, len(members), batch):
+                selected = members[start:start + batch]
+                indices[selected] = self._match(flat[selected], cells[selected], width)
+        return indices.reshape(pixels.shape[:-1])
+
+    def _match(self, pixels: np.ndarray, cells: np.ndarray, width: int) -> np.ndarray:
+        candidates = self.candidates[cells, :width]
+        if self.color_distance.space == 'lab':
+            pixels = srgb_to_lab(pixels)
+        distance = self.color_distance.distance(pixels[:, None, :], self.palette_values[candidates])
+        return candidates[np.arange(len(candidates)), distance.argmin(axis=1)]
+
+
+def should_use_index(metric: str, num_colors: int, num_pixels: int) -> bool:
+    """根据色板大小和批次大小判断空间索引是否比穷举更快"""
+    if metric not in INDEX_THRESHOLDS:
+        return False
+    min_colors, min_pixels = INDEX_THRESHOLDS[metric]
+    return num_colors >= min_colors and num_pixels >= min_pixels
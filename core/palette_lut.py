@@ -0,0 +1,229 @@
+import hashlib
+import os
+from typing import Callable, Literal, Optional
+
+import numpy as np
+
+LutMode = Literal['exact', 'compact']
+
+# 查找表缓存目录，可通过环境变量覆盖
+DEFAULT_CACHE_DIR = os.environ.get(
+    'PIXEL_ART_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'pixel-art'),
+)
+LUT_FORMAT_VERSION = 1
+
+
+def _redmean_grid(palette_rgb: np.ndarray, r_values: np.ndarray, g_values: np.ndarray, b_values: np.ndarray) -> np.ndarray:
+    """
+    Find the closest palette index (redmean distance) for every point of an RGB grid.
+
+    For a fixed red value the distance splits into a per-palette term plus a
+    green-only and a blue-only term, so each red slice is a running minimum over
+    palette entries of an outer sum instead of a full (N, P) distance matrix.
+    Everything is kept in integers: floor((512 + rmean) * rd^2 / 256) equals
+    floor((1024 + r + pr) * rd^2 / 512), which matches ColorPalette.closest_color.
+
+    :param palette_rgb: Array of shape (P, 3) with palette RGB values
+    :param r_values: Red values of the grid axis
+    :param g_values: Green values of the grid axis
+    :param b_values: Blue values of the grid axis
+    :return: Array of shape (len(r_values), len(g_values), len(b_values)) with palette indices
+    """
+    palette_rgb = np.asarray(palette_rgb, dtype=np.int64)
+    pr, pg, pb = palette_rgb[:, 0], palette_rgb[:, 1], palette_rgb[:, 2]
+    r_values = np.asarray(r_values, dtype=np.int64)
+    g_values = np.asarray(g_values, dtype=np.int64)
+    b_values = np.asarray(b_values, dtype=np.int64)
+
+    green_terms = 4 * (g_values[None, :] - pg[:, None]) ** 2
+    blue_squares = (b_values[None, :] - pb[:, None]) ** 2
+    index_dtype = np.uint8 if len(palette_rgb) <= 256 else np.uint16
+
+    table = np.empty((len(r_values), len(g_values), len(b_values)), dtype=index_dtype)
+    best = np.empty((len(g_values), len(b_values)), dtype=np.int32)
+    distance = np.empty_like(best)
+    closer = np.empty(best.shape, dtype=bool)
+    for i, r in enumerate(r_values):
+        red_sum = r + pr
+        red_terms = ((1024 + red_sum) * (r - pr) ** 2) // 512
+        green_red_terms = (red_terms[:, None] + green_terms).astype(np.int32)
+        blue_terms = (((1534 - red_sum)[:, None] * blue_squares) // 512).astype(np.int32)
+
+        best.fill(np.iinfo(np.int32).max)
+        slice_indices = table[i]
+        for p in range(len(palette_rgb)):
+            np.add(green_red_terms[p][:, None], blue_terms[p][None, :], out=distance)
+            # 严格小于，距离相同时保留较小的索引
+            np.less(distance, best, out=closer)
+            np.copyto(best, distance, where=closer)
+            np.copyto(slice_indices, p, where=closer)
+    return table
+
+
+def _match_grid(match: Callable[[np.ndarray], np.ndarray], r_values: np.ndarray, g_values: np.ndarray,
+                b_values: np.ndarray, num_colors: int) -> np.ndarray:
+    """
+    Closest palette index for every point of an RGB grid using an arbitrary matcher.
+
+    Used for metrics without a separable integer form; the grid is matched one red
+    slice at a time.
+
+    :param match: Maps an (N, 3) uint8 array to (N,) palette indices
+    :return: Array of shape (len(r_values), len(g_values), len(b_values)) with palette indices
+    """
+    index_dtype = np.uint8 if num_colors <= 256 else np.uint16
+    table = np.empty((len(r_values), len(g_values), len(b_values)), dtype=index_dtype)
+    points = np.empty((len(g_values), len(b_values), 3), dtype=np.uint8)
+    points[..., 1] = np.asarray(g_values)[:, None]
+    points[..., 2] = np.asarray(b_values)[None, :]
+    for i, r in enumerate(r_values):
+        points[..., 0] = r
+        table[i] = match(points.reshape(-1, 3)).reshape(table.shape[1:])
+    return table
+
+
+class PaletteLUT:
+    """
+    RGB -> palette index lookup table.
+
+    'exact' mode stores the index of every one of the 256^3 colors. 'compact' mode
+    stores one index per quantized cell of 2^bits values per channel and flags the
+    cells whose corners disagree (decision boundaries pass through them); pixels
+    falling in those cells are refined with an exact palette search.
+
+    Compact tables assume a cell whose eight corners agree lies entirely in that
+    color's region. Regions are not convex under any of the metrics, so in rare cases
+    (a few pixels per million on random input) another color pokes into such a cell;
+    use 'exact' when every pixel must match the brute-force result.
+    """
+
+    def __init__(self, table: np.ndarray, mode: LutMode, bits: int = 8, ambiguous: Optional[np.ndarray] = None,
+                 metric: str = 'redmean'):
+        self.table = table
+        self.mode = mode
+        self.bits = bits
+        self.ambiguous = ambiguous
+        self.metric = metric
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes + (self.ambiguous.nbytes if self.ambiguous is not None else 0)
+
+    def lookup(self, pixels: np.ndarray, color_palette=None) -> np.ndarray:
+        """
+        Map RGB pixels to palette indices.
+
+        :param pixels: Integer array of shape (..., 3) with values in 0..255
+        :param color_palette: Palette used to refine ambiguous cells (required in compact mode)
+        :return: Array of shape (...) with palette indices
+        """
+        pixels = np.asarray(pixels)
+        flat = pixels.reshape(-1, 3)
+        if self.mode == 'exact':
+            indices = self.table[flat[:, 0], flat[:, 1], flat[:, 2]]
+            return indices.astype(np.intp).reshape(pixels.shape[:-1])
+
+        shift = 8 - self.bits
+        cells = flat.astype(np.intp) >> shift
+        cells = (cells[:, 0], cells[:, 1], cells[:, 2])
+        indices = self.table[cells].astype(np.intp)
+        refine = self.ambiguous[cells]
+        if refine.any():
+            if color_palette is None:
+                raise ValueError("A color palette is required to refine a compact lookup table")
+            indices[refine] = color_palette.closest_colors(flat[refine], use_lut=False, metric=self.metric)
+        return indices.reshape(pixels.shape[:-1])
+
+
+def lut_cache_key(palette_hash: str, metric: str, mode: LutMode, bits: int) -> str:
+    """根据色板内容、距离公式和表格参数生成缓存键"""
+    key = f"v{LUT_FORMAT_VERSION}:{palette_hash}:{metric}:{mode}:{bits}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def compute_lut(palette_rgb: np.ndarray, mode: LutMode = 'exact', bits: int = 6, metric: str = 'redmean',
+                match: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> PaletteLUT:
+    """
+    Compute a lookup table without touching the cache.
+
+    :param palette_rgb: Array of shape (P, 3) with palette RGB values
+    :param mode: 'exact' for the full 256^3 table, 'compact' for a quantized table
+    :param bits: Bits per channel kept by the compact table
+    :param metric: Name of the distance metric the table is built for
+    :param match: Brute-force matcher (N, 3) uint8 -> (N,) indices, required for metrics other than redmean
+    :return: The lookup table
+    """
+    if metric == 'redmean':
+        grid = lambda r, g, b: _redmean_grid(palette_rgb, r, g, b)
+    elif match is not None:
+        grid = lambda r, g, b: _match_grid(match, r, g, b, len(palette_rgb))
+    else:
+        raise ValueError(f"A matcher is required to build a lookup table for the {metric} metric")
+
+    if mode == 'exact':
+        values = np.arange(256)
+        return PaletteLUT(grid(values, values, values), 'exact', metric=metric)
+    if mode != 'compact':
+        raise ValueError(f"Unknown lookup table mode: {mode}")
+    if not 1 <= bits <= 7:
+        raise ValueError("Compact lookup tables need between 1 and 7 bits per channel")
+
+    # 在每个量化单元的边界上采样：单元 i 覆盖 [i*step, (i+1)*step - 1]
+    step = 1 << (8 - bits)
+    cells = 1 << bits
+    lower = np.arange(cells) * step
+    corners = np.concatenate([lower, lower + step - 1])
+    corner_table = grid(corners, corners, corners)
+
+    low, high = slice(0, cells), slice(cells, 2 * cells)
+    table = corner_table[low, low, low]
+    ambiguous = np.zeros(table.shape, dtype=bool)
+    for r in (low, high):
+        for g in (low, high):
+            for b in (low, high):
+                ambiguous |= corner_table[r, g, b] != table
+    return PaletteLUT(table, 'compact', bits, ambiguous, metric)
+
+
+def load_or_build_lut(palette_rgb: np.ndarray, palette_hash: str, metric: str = 'redmean',
+                      mode: LutMode = 'exact', bits: int = 6, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                      match: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> PaletteLUT:
+    """
+    Load a lookup table from the on-disk cache, building and storing it on a miss.
+
+    :param palette_rgb: Array of shape (P, 3) with palette RGB values
+    :param palette_hash: Hash of the palette contents, part of the cache key
+    :param metric: Name of the distance metric, part of the cache key
+    :param mode: 'exact' or 'compact'
+    :param bits: Bits per channel kept by the compact table
+    :param cache_dir: Cache directory, or None to disable the disk cache
+    :param match: Brute-force matcher for metrics other than redmean, see compute_lut
+    :return: The lookup table
+    """
+    if mode == 'exact':
+        bits = 8
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f"lut-{lut_cache_key(palette_hash, metric, mode, bits)}.npz")
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    ambiguous = data['ambiguous'] if 'ambiguous' in data.files else None
+                    return PaletteLUT(data['table'], mode, bits, ambiguous, metric)
+            except (OSError, ValueError, KeyError):
+                pass  # 缓存文件损坏时重新生成
+
+    lut = compute_lut(palette_rgb, mode, bits, metric, match)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = {'table': lut.table}
+        if lut.ambiguous is not None:
+            arrays['ambiguous'] = lut.ambiguous
+        # 先写临时文件再原子替换，避免并发进程读到半个文件
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    return lut
@@ -0,0 +1,102 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context, shared_memory
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .block_reduce import reduce_tiles, tile_blocks
+
+WIDTH = int
+HEIGHT = int
+
+# 每个 worker 分到的条带数，多于 1 可以平衡各条带耗时的差异
+BANDS_PER_WORKER = 4
+
+# 这些归约方式在 Python 循环里持有 GIL（mode 的平局处理），默认用进程池而不是线程
+GIL_BOUND_REDUCERS = frozenset({'mode'})
+
+# 进程池 worker 中的色板，由 _init_process_worker 设置
+_worker_palette = None
+
+
+def tile_row_bands(num_tiles_y: int, workers: int) -> List[Tuple[int, int]]:
+    """Split tile rows into contiguous [start, stop) bands, a few per worker."""
+    num_bands = max(1, min(num_tiles_y, workers * BANDS_PER_WORKER))
+    edges = np.linspace(0, num_tiles_y, num_bands + 1).round().astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+
+def _reduce_band(pixels: np.ndarray, band: Tuple[int, int], tile_shape: Tuple[WIDTH, HEIGHT],
+                 color_palette, reducer: str, metric: str) -> np.ndarray:
+    tile_height = tile_shape[1]
+    start, stop = band
+    return reduce_tiles(tile_blocks(pixels[start * tile_height:stop * tile_height], tile_shape), color_palette,
+                        reducer, metric)
+
+
+def _init_process_worker(color_palette) -> None:
+    global _worker_palette
+    _worker_palette = color_palette
+
+
+def _reduce_shared_band(shm_name: str, shape: Tuple[int, ...], band: Tuple[int, int],
+                        tile_shape: Tuple[WIDTH, HEIGHT], reducer: str, metric: str) -> np.ndarray:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        return _reduce_band(pixels, band, tile_shape, _worker_palette, reducer, metric)
+    finally:
+        shm.close()
+
+
+def reduce_tiles_parallel(pixels: np.ndarray, tile_shape: Tuple[WIDTH, HEIGHT], color_palette,
+                          reducer: str = 'mode', workers: Optional[int] = None,
+                          use_processes: Optional[bool] = None, metric: str = 'redmean') -> np.ndarray:
+    """
+    Reduce tiles to palette indices, splitting the image into bands of whole tile rows.
+
+    Every tile is reduced independently, so the result is bit-identical to
+    reduce_tiles(tile_blocks(pixels, tile_shape), ...). Threads share the pixel array
+    directly and only scale where NumPy releases the GIL; the legacy tie-break of 'mode'
+    is a Python loop that holds it for most of the run, so 'mode' uses processes by
+    default. Processes read the pixels from a shared memory block and receive the
+    palette once per worker.
+
+    :param pixels: Array of shape (H, W, C) as returned by image_to_array
+    :param tile_shape: Tuple of (width, height) of each tile
+    :param color_palette: The palette to match against
+    :param reducer: Name of a reducer in TILE_REDUCERS
+    :param workers: Number of threads or processes, os.cpu_count() by default
+    :param use_processes: Use a process pool with shared memory instead of threads;
+        None picks processes for the reducers in GIL_BOUND_REDUCERS and threads otherwise
+    :param metric: Distance metric used to match colors to the palette
+    :return: Array of shape (ny * nx,) with palette indices in row-major order
+    """
+    workers = workers or os.cpu_count() or 1
+    num_tiles_y = pixels.shape[0] // tile_shape[1]
+    bands = tile_row_bands(num_tiles_y, workers)
+    if workers == 1 or len(bands) <= 1:
+        return reduce_tiles(tile_blocks(pixels, tile_shape), color_palette, reducer, metric)
+
+    if use_processes is None:
+        use_processes = reducer in GIL_BOUND_REDUCERS
+    if not use_processes:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                lambda band: _reduce_band(pixels, band, tile_shape, color_palette, reducer, metric), bands))
+        return np.concatenate(results)
+
+    pixels = np.ascontiguousarray(pixels)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, pixels.nbytes))
+    try:
+        np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[...] = pixels
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                                 initializer=_init_process_worker, initargs=(color_palette,)) as executor:
+            futures = [executor.submit(_reduce_shared_band, shm.name, pixels.shape, band, tile_shape, reducer, metric)
+                       for band in bands]
+            results = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+    return np.concatenate(results)
@@ -0,0 +1,238 @@
+"""
+Compact binary file format for finished patterns.
+
+Layout (little-endian):
+
+    offset  size  field
+    0       8     magic b'BEADPAT\\0'
+    8       2     format version
+    10      1     index dtype code (1 = uint8, 2 = uint16)
+    11      1     compression code (0 = none, 1 = RLE, 2 = zlib)
+    12      4     columns
+    16      4     rows
+    20      2     tile width
+    22      2     tile height
+    24      32    SHA-256 palette hash (ColorPalette.palette_hash, raw bytes)
+    56      4     data offset
+    60      8     data length in bytes
+    68      ...   zero padding up to the data offset (a multiple of DATA_ALIGNMENT)
+
+Uncompressed grids are stored row-major at the data offset, so load_pattern can map
+the file with np.memmap and slice sub-regions without reading the rest. RLE data is
+the number of runs (uint32), the run values (index dtype) and the run lengths
+(uint16, longer runs are split); zlib data is the deflated row-major grid.
+"""
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Literal, Optional, Tuple, Union
+
+import numpy as np
+
+from .hanlde_image import HEIGHT, WIDTH, ColorPalette
+from .tile_grid import TileGrid, index_dtype
+
+PatternCompression = Literal['none', 'rle', 'zlib']
+
+MAGIC = b'BEADPAT\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHBBIIHH32sIQ')
+# 数据区按 64 字节对齐，内存映射后的数组与缓存行对齐
+DATA_ALIGNMENT = 64
+# RLE 的游程长度用 uint16 存储，更长的游程拆开
+MAX_RUN_LENGTH = np.iinfo(np.uint16).max
+ZLIB_LEVEL = 6
+
+_DTYPE_CODES = {np.dtype(np.uint8): 1, np.dtype(np.uint16): 2}
+_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+_COMPRESSION_CODES = {'none': 0, 'rle': 1, 'zlib': 2}
+_COMPRESSIONS = {code: name for name, code in _COMPRESSION_CODES.items()}
+
+
+@dataclass
+class StoredPattern:
+    """A pattern read back from disk: the index grid plus the header fields."""
+    # (rows, columns) 的索引数组；未压缩文件按内存映射读取时是 np.memmap
+    indices: np.ndarray
+    tile_shape: Tuple[WIDTH, HEIGHT]
+    palette_hash: str
+    compression: PatternCompression
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        """(columns, rows) of the grid, in the same order as PIL sizes."""
+        return self.indices.shape[1], self.indices.shape[0]
+
+    def to_tile_grid(self, color_palette: ColorPalette) -> TileGrid:
+        """
+        Attach the palette the pattern was made with.
+
+        :raise ValueError: If the palette's hash differs from the stored one
+        """
+        if color_palette.palette_hash != self.palette_hash:
+            raise ValueError("The pattern was stored with a different palette")
+        return TileGrid(self.indices, color_palette)
+
+
+def rle_encode(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run-length encode a 1D array.
+
+    :param values: 1D array
+    :return: Tuple of (run values, uint16 run lengths); runs longer than MAX_RUN_LENGTH are split
+    """
+    if len(values) == 0:
+        return values[:0], np.zeros(0, dtype=np.uint16)
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(values)))
+    pieces = -(-lengths // MAX_RUN_LENGTH)
+    run_values = np.repeat(values[starts], pieces)
+    run_lengths = np.full(len(run_values), MAX_RUN_LENGTH, dtype=np.int64)
+    # 拆开的游程前几段都是满长度，最后一段是余下的部分
+    run_lengths[np.cumsum(pieces) - 1] = lengths - (pieces - 1) * MAX_RUN_LENGTH
+    return run_values, run_lengths.astype(np.uint16)
+
+
+def rle_decode(run_values: np.ndarray, run_lengths: np.ndarray) -> np.ndarray:
+    """rle_encode 的逆运算"""
+    return np.repeat(run_values, run_lengths.astype(np.intp))
+
+
+def _encode_data(indices: np.ndarray, compression: PatternCompression) -> bytes:
+    flat = np.ascontiguousarray(indices).ravel()
+    if compression == 'none':
+        return flat.tobytes()
+    if compression == 'rle':
+        run_values, run_lengths = rle_encode(flat)
+        return struct.pack('<I', len(run_values)) + run_values.tobytes() + run_lengths.astype('<u2').tobytes()
+    if compression == 'zlib':
+        return zlib.compress(flat.tobytes(), ZLIB_LEVEL)
+    raise ValueError(f"Unknown pattern compression: {compression}. Choose one of {', '.join(_COMPRESSION_CODES)}")
+
+
+def _decode_data(data: bytes, dtype: np.dtype, rows: int, columns: int, compression: PatternCompression) -> np.ndarray:
+    if compression == 'none':
+        flat = np.frombuffer(data, dtype=dtype)
+    elif compression == 'rle':
+        (num_runs,) = struct.unpack_from('<I', data)
+        run_values = np.frombuffer(data, dtype=dtype, count=num_runs, offset=4)
+        run_lengths = np.frombuffer(data, dtype='<u2', count=num_runs, offset=4 + num_runs * dtype.itemsize)
+        flat = rle_decode(run_values, run_lengths)
+    else:
+        flat = np.frombuffer(zlib.decompress(data), dtype=dtype)
+    if flat.size != rows * columns:
+        raise ValueError(f"Pattern data holds {flat.size} tiles, the header says {columns}x{rows}")
+    return flat.reshape(rows, columns)
+
+
+def encode_pattern(tiles: TileGrid, tile_shape: Tuple[WIDTH, HEIGHT],
+                   compression: PatternCompression = 'none') -> bytes:
+    """
+    Serialize a tile grid.
+
+    :param tiles: The pattern
+    :param tile_shape: Tuple of (width, height) of each tile in the resized image, kept for reprints
+    :param compression: 'none' (default, can be memory-mapped), 'rle' or 'zlib'
+    :return: The file contents
+    """
+    dtype = index_dtype(len(tiles.palette.colors))
+    # 索引统一按 little-endian 存储
+    data = _encode_data(tiles.indices.astype(dtype.newbyteorder('<'), copy=False), compression)
+    data_offset = -(-HEADER.size // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    columns, rows = tiles.shape
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, _DTYPE_CODES[dtype], _COMPRESSION_CODES[compression],
+                         columns, rows, tile_shape[0], tile_shape[1], bytes.fromhex(tiles.palette.palette_hash),
+                         data_offset, len(data))
+    return header.ljust(data_offset, b'\0') + data
+
+
+def _parse_header(header: bytes) -> dict:
+    if len(header) < HEADER.size:
+        raise ValueError("Not a pattern file: too short")
+    (magic, version, dtype_code, compression_code, columns, rows, tile_width, tile_height, palette_hash,
+     data_offset, data_length) = HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError("Not a pattern file: bad magic")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported pattern format version {version}")
+    if dtype_code not in _DTYPES or compression_code not in _COMPRESSIONS:
+        raise ValueError("Corrupt pattern header")
+    return {
+        'dtype': _DTYPES[dtype_code].newbyteorder('<'),
+        'compression': _COMPRESSIONS[compression_code],
+        'columns': columns,
+        'rows': rows,
+        'tile_shape': (tile_width, tile_height),
+        'palette_hash': palette_hash.hex(),
+        'data_offset': data_offset,
+        'data_length': data_length,
+    }
+
+
+def decode_pattern(data: bytes) -> StoredPattern:
+    """
+    Parse a pattern from bytes, e.g. an upload. Uncompressed grids are a read-only view of data.
+
+    :raise ValueError: If data is not a valid pattern
+    """
+    header = _parse_header(data)
+    start = header['data_offset']
+    payload = memoryview(data)[start:start + header['data_length']]
+    if len(payload) != header['data_length']:
+        raise ValueError("Truncated pattern file")
+    indices = _decode_data(payload, header['dtype'], header['rows'], header['columns'], header['compression'])
+    return StoredPattern(indices, header['tile_shape'], header['palette_hash'], header['compression'])
+
+
+def save_pattern(path: str, tiles: TileGrid, tile_shape: Tuple[WIDTH, HEIGHT],
+                 compression: PatternCompression = 'none') -> int:
+    """
+    Write a pattern file, replacing any existing file atomically.
+
+    :return: Size of the file in bytes
+    """
+    data = encode_pattern(tiles, tile_shape, compression)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def load_pattern(path: Union[str, os.PathLike], mmap: bool = True,
+                 color_palette: Optional[ColorPalette] = None) -> Union[StoredPattern, TileGrid]:
+    """
+    Read a pattern file.
+
+    Uncompressed files are memory-mapped by default: only the header is read, and
+    pages of the grid are loaded when they are touched, so slicing a region of a large
+    pattern reads just that region. Compressed files are read and decoded whole.
+
+    :param path: Path of the pattern file
+    :param mmap: Map uncompressed grids instead of reading them
+    :param color_palette: If given, check the palette hash and return a TileGrid
+    :return: StoredPattern, or TileGrid when color_palette is given
+    :raise ValueError: If the file is not a valid pattern or was made with another palette
+    """
+    with open(path, 'rb') as f:
+        header = _parse_header(f.read(HEADER.size))
+        if header['compression'] == 'none' and mmap:
+            shape = (header['rows'], header['columns'])
+            if header['rows'] * header['columns'] * header['dtype'].itemsize != header['data_length']:
+                raise ValueError("Pattern data does not match the header")
+            if header['data_length'] == 0:
+                indices = np.zeros(shape, dtype=header['dtype'])
+            else:
+                indices = np.memmap(f, dtype=header['dtype'], mode='r', offset=header['data_offset'], shape=shape)
+        else:
+            f.seek(header['data_offset'])
+            payload = f.read(header['data_length'])
+            if len(payload) != header['data_length']:
+                raise ValueError("Truncated pattern file")
+            indices = _decode_data(payload, header['dtype'], header['rows'], header['columns'],
+                                   header['compression'])
+    pattern = StoredPattern(indices, header['tile_shape'], header['palette_hash'], header['compression'])
+    if color_palette is not None:
+        return pattern.to_tile_grid(color_palette)
+    return pattern
@@ -0,0 +1,132 @@
+import io
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+from .block_reduce import ReducerName
+from .color_distance import DistanceMetric
+from .dither import DitherMethod
+from .cache import ResultCache, default_cache, hash_bytes, make_key
+from .hanlde_image import (HEIGHT, WIDTH, ColorPalette, ImageFormat, decode_image_from_bytes, preview_tiles,
+                           resize_image, split_image_into_tiles)
+from .ingest import IngestReport
+from .instrument import Profile, current_profile
+from .tile_grid import TileGrid
+
+PREVIEW_TILE_SIZE = (50, 50)
+
+
+@dataclass
+class PipelineResult:
+    image: Image.Image
+    image_format: Optional[ImageFormat]
+    resized_image: Image.Image
+    tiles: TileGrid
+    color_counts: Dict[str, int]
+    preview_image: Optional[Image.Image]
+    # 每个阶段是否命中缓存
+    cache_hits: Dict[str, bool] = field(default_factory=dict)
+    # 实际执行的各阶段耗时、内存和像素数，见 Profile.as_dict
+    profile: Dict = field(default_factory=dict)
+    # 解码时的尺寸、缩小倍数和内存估算；解码阶段命中缓存时是当初解码的记录
+    ingest: Optional[IngestReport] = None
+
+
+@dataclass(frozen=True)
+class PipelineKeys:
+    """
+    Cache keys of every pipeline stage.
+
+    Each key is derived from the previous stage's key plus the stage's own parameters,
+    so changing a late parameter (e.g. the preview tile size) reuses earlier stages.
+    """
+    decode: str
+    resize: str
+    tiles: str
+    preview: str
+
+    @classmethod
+    def build(cls, image_hash: str, target_size: Tuple[WIDTH, HEIGHT], tile_shape: Tuple[WIDTH, HEIGHT],
+              palette_hash: str, reducer: str, resample_method: int,
+              preview_tile_size: Tuple[WIDTH, HEIGHT], metric: str = 'redmean',
+              dither: str = 'none') -> 'PipelineKeys':
+        # 解码会按目标尺寸降低分辨率，所以目标尺寸也是解码阶段的参数。
+        # 缓存值是 (图像, 格式, IngestReport)，键名与只缓存 (图像, 格式) 的旧磁盘缓存区分开
+        decode = make_key('ingest', image_hash, tuple(target_size))
+        resize = make_key('resize', decode, tuple(target_size), int(resample_method))
+        tiles = make_key('tiles', resize, tuple(tile_shape), palette_hash, reducer, metric, dither)
+        preview = make_key('preview', tiles, tuple(preview_tile_size))
+        return cls(decode, resize, tiles, preview)
+
+
+def run_pipeline(image_bytes: bytes,
+                 target_size: Tuple[WIDTH, HEIGHT],
+                 tile_shape: Tuple[WIDTH, HEIGHT],
+                 color_palette: ColorPalette,
+                 reducer: ReducerName = 'mode',
+                 metric: DistanceMetric = 'redmean',
+                 dither: DitherMethod = 'none',
+                 resample_method=Image.Resampling.BICUBIC,
+                 preview_tile_size: Tuple[WIDTH, HEIGHT] = PREVIEW_TILE_SIZE,
+                 cache: Optional[ResultCache] = default_cache,
+                 with_preview: bool = True,
+                 on_stage: Optional[Callable[[str], None]] = None,
+                 profile: Optional[Profile] = None) -> PipelineResult:
+    """
+    Run decode -> resize -> split -> preview, caching every stage separately.
+
+    Stages are keyed by the sha256 of the image bytes and the parameters that affect
+    them (target size, resample method, tile size, palette hash, reducer, metric, dither, preview tile
+    size), so resubmitting the same photo with different settings only recomputes the
+    stages whose inputs changed.
+
+    :param image_bytes: Raw bytes of the uploaded image
+    :param target_size: Tuple of (width, height) the image is resized to
+    :param tile_shape: Tuple of (width, height) of each tile in the resized image
+    :param color_palette: The palette to match against
+    :param reducer: Tile reducer, see split_image_into_tiles
+    :param metric: Color distance used for palette matching, see split_image_into_tiles
+    :param dither: Dithering applied while matching tiles to the palette, see split_image_into_tiles
+    :param resample_method: Resampling method used by resize_image
+    :param preview_tile_size: Tuple of (width, height) of each tile in the preview
+    :param cache: Result cache to use, None to disable caching
+    :param with_preview: Render the preview image (skipped when only the index grid is needed)
+    :param on_stage: Called with the stage name ('decode', 'resize', 'tiles', 'preview') before each stage
+    :param profile: Profile collecting per-stage timings; defaults to the active profile, or a new one
+                    without memory tracing. Stages served from the cache are not recorded
+    :return: The results of every stage
+    """
+    if profile is None:
+        profile = current_profile() or Profile()
+    keys = PipelineKeys.build(hash_bytes(image_bytes), target_size, tile_shape, color_palette.palette_hash,
+                              reducer, resample_method, preview_tile_size, metric, dither)
+    hits = {}
+
+    def stage(name: str, key: str, compute):
+        if on_stage is not None:
+            on_stage(name)
+        if cache is None:
+            hits[name] = False
+            return compute()
+        value, hits[name] = cache.get_or_compute(key, compute)
+        return value
+
+    with profile:
+        image, image_format, ingest = stage('decode', keys.decode,
+                                            lambda: decode_image_from_bytes(io.BytesIO(image_bytes),
+                                                                            tuple(target_size)))
+        resized_image = stage('resize', keys.resize,
+                              lambda: resize_image(image, tuple(target_size), resample_method))
+        # 只缓存索引数组，色板对象不进入缓存
+        indices = stage('tiles', keys.tiles,
+                        lambda: split_image_into_tiles(resized_image, tuple(tile_shape), color_palette,
+                                                       reducer, metric=metric, dither=dither)[0].indices)
+        tiles = TileGrid(indices, color_palette)
+        preview_image = None
+        if with_preview:
+            preview_image = stage('preview', keys.preview,
+                                  lambda: preview_tiles(tiles, tiles.shape, tuple(preview_tile_size), color_palette))
+
+    return PipelineResult(image, image_format, resized_image, tiles, tiles.counts, preview_image, hits,
+                          profile.as_dict(), ingest)
@@ -0,0 +1,81 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+if TYPE_CHECKING:
+    from .hanlde_image import ColorPalette
+
+WIDTH = int
+HEIGHT = int
+
+# 标签相对色块左上角的位置和颜色
+LABEL_OFFSET = (5, 5)
+LABEL_FILL = (255, 255, 255)
+
+
+@lru_cache(maxsize=16)
+def glyph_atlas(color_palette: 'ColorPalette', tile_image_size: Tuple[WIDTH, HEIGHT],
+                font: Optional[ImageFont.ImageFont] = None) -> np.ndarray:
+    """
+    Pre-render one labeled tile per palette color.
+
+    Each entry is drawn exactly like a single preview tile (filled with the palette
+    color, name written at LABEL_OFFSET), so compositing atlas entries gives the same
+    pixels as drawing every tile separately. An extra all-black entry at the end is
+    used for grid cells that have no tile. Cached per palette, tile size and font.
+
+    :param color_palette: The palette to render
+    :param tile_image_size: Tuple of (width, height) of each tile in the preview
+    :param font: Font used for the labels, None for Pillow's default font
+    :return: Array of shape (P + 1, height, width, 3)
+    """
+    width, height = tile_image_size
+    atlas = np.zeros((len(color_palette.colors) + 1, height, width, 3), dtype=np.uint8)
+    for index, (color, rgb) in enumerate(zip(color_palette.colors, color_palette.rgb.tolist())):
+        tile = Image.new("RGB", tile_image_size, tuple(rgb))
+        ImageDraw.Draw(tile).text(LABEL_OFFSET, color.name, fill=LABEL_FILL, font=font)
+        atlas[index] = np.asarray(tile)
+    atlas.setflags(write=False)
+    return atlas
+
+
+def render_preview(indices: np.ndarray, tile_shape: Tuple[WIDTH, HEIGHT], tile_image_size: Tuple[WIDTH, HEIGHT],
+                   color_palette: 'ColorPalette', show_labels: bool = True,
+                   font: Optional[ImageFont.ImageFont] = None) -> Image.Image:
+    """
+    Render a preview image from row-major palette indices without drawing tile by tile.
+
+    :param indices: Row-major palette indices of the tiles
+    :param tile_shape: Tuple of (columns, rows) of the preview grid
+    :param tile_image_size: Tuple of (width, height) of each tile in the preview
+    :param color_palette: The palette the indices refer to
+    :param show_labels: Write the color name on every tile
+    :param font: Font used for the labels, None for Pillow's default font
+    :return: The preview image
+    """
+    columns, rows = tile_shape
+    width, height = tile_image_size
+    num_colors = len(color_palette.colors)
+
+    # 多余的色块落在图像之外，不足的格子保持黑色
+    grid = np.full(columns * rows, num_colors, dtype=np.intp)
+    flat = np.asarray(indices, dtype=np.intp).ravel()[:grid.size]
+    grid[:flat.size] = flat
+    grid = grid.reshape(rows, columns)
+
+    pixels = np.empty((rows * height, columns * width, 3), dtype=np.uint8)
+    if not show_labels:
+        colors = np.concatenate([color_palette.rgb, np.zeros((1, 3), dtype=np.uint8)])[grid]
+        for row in range(rows):
+            # 每行只展开一条像素线，再广播到色块高度
+            pixels[row * height:(row + 1) * height] = np.repeat(colors[row], width, axis=0)
+        return Image.fromarray(pixels, "RGB")
+
+    atlas = glyph_atlas(color_palette, (width, height), font)
+    for row in range(rows):
+        # (columns, height, width, 3) -> (height, columns * width, 3)
+        band = atlas[grid[row]].transpose(1, 0, 2, 3)
+        pixels[row * height:(row + 1) * height] = band.reshape(height, columns * width, 3)
+    return Image.fromarray(pixels, "RGB")
@@ -0,0 +1,152 @@
+from functools import cached_property
+from typing import TYPE_CHECKING, Dict, Iterator, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+if TYPE_CHECKING:
+    from .hanlde_image import ColorPalette
+
+
+def index_dtype(num_colors: int) -> np.dtype:
+    """Smallest unsigned integer type able to hold indices into a palette of num_colors."""
+    return np.dtype(np.uint8) if num_colors <= 256 else np.dtype(np.uint16)
+
+
+def colors_to_indices(colors: Sequence['ColorPalette.Color'], color_palette: 'ColorPalette') -> np.ndarray:
+    """Row-major palette indices of a list of palette colors."""
+    if isinstance(colors, TileGrid):
+        return colors.indices.ravel()
+    positions = color_palette.index_by_color
+    return np.array([positions[color] for color in colors], dtype=np.intp)
+
+
+class TileGrid(Sequence):
+    """
+    Result of splitting an image into tiles: a 2D array of palette indices plus the palette.
+
+    Names, hex strings, RGB values and color counts are derived lazily from the index
+    array. The grid also behaves like the List[ColorPalette.Color] it replaces: len(),
+    iteration and integer indexing go over the tiles in row-major order.
+    """
+
+    def __init__(self, indices: np.ndarray, color_palette: 'ColorPalette'):
+        indices = np.asarray(indices)
+        if indices.ndim != 2:
+            raise ValueError(f"TileGrid indices must be 2D, got shape {indices.shape}")
+        self.indices = indices.astype(index_dtype(len(color_palette.colors)), copy=False)
+        self.palette = color_palette
+
+    @classmethod
+    def from_colors(cls, colors: Sequence['ColorPalette.Color'], shape: Tuple[int, int],
+                    color_palette: 'ColorPalette') -> 'TileGrid':
+        """
+        Build a grid from a row-major list of palette colors.
+
+        :param colors: Palette colors of the tiles
+        :param shape: Tuple of (columns, rows) of the grid
+        :param color_palette: The palette the colors belong to
+        """
+        if isinstance(colors, TileGrid):
+            return colors
+        indices = colors_to_indices(colors, color_palette)
+        columns, rows = shape
+        return cls(indices.reshape(rows, columns), color_palette)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        """(columns, rows) of the grid, in the same order as PIL sizes."""
+        return self.indices.shape[1], self.indices.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.indices.nbytes
+
+    def __len__(self) -> int:
+        return self.indices.size
+
+    def __getitem__(self, item: Union[int, slice]):
+        flat = self.indices.ravel()
+        if isinstance(item, slice):
+            return [self.palette.colors[index] for index in flat[item]]
+        return self.palette.colors[flat[item]]
+
+    def __iter__(self) -> Iterator['ColorPalette.Color']:
+        colors = self.palette.colors
+        return (colors[index] for index in self.indices.ravel().tolist())
+
+    @cached_property
+    def names(self) -> np.ndarray:
+        """(rows, columns) array of color names."""
+        return np.array(self.palette.names, dtype=object)[self.indices]
+
+    @cached_property
+    def hex(self) -> np.ndarray:
+        """(rows, columns) array of hex color strings."""
+        return np.array(self.palette.hex, dtype=object)[self.indices]
+
+    @cached_property
+    def rgb(self) -> np.ndarray:
+        """(rows, columns, 3) uint8 array of RGB colors."""
+        return self.palette.rgb[self.indices]
+
+    @cached_property
+    def index_counts(self) -> np.ndarray:
+        """Number of tiles per palette index."""
+        return np.bincount(self.indices.ravel(), minlength=len(self.palette.colors))
+
+    @cached_property
+    def counts(self) -> Dict[str, int]:
+        """Color name -> number of tiles, in order of first appearance in the grid."""
+        index_counts = self.index_counts
+        used, first_seen = np.unique(self.indices.ravel(), return_index=True)
+        names = self.palette.names
+        counts: Dict[str, int] = {}
+        # 同名的颜色（如 mardPalette 的两个 D6）合计到一个名称下
+        for index in used[np.argsort(first_seen)]:
+            counts[names[index]] = counts.get(names[index], 0) + int(index_counts[index])
+        return counts
+
+
+class AveragedImage:
+    """
+    The tile colors of a split image, as an image built only when asked for.
+
+    split_image_into_tiles used to upscale the grid to the input size with Image.NEAREST
+    on every call, a full-resolution allocation nobody used. This view only keeps the
+    grid: image has one pixel per tile and materialize() expands it to any scale.
+    It is not a PIL image; callers that need one call materialize() explicitly.
+    """
+
+    def __init__(self, tiles: TileGrid, size: Tuple[int, int], tile_shape: Tuple[int, int]):
+        self.tiles = tiles
+        self.size = tuple(size)
+        self.tile_shape = tuple(tile_shape)
+
+    @cached_property
+    def image(self) -> Image.Image:
+        """One pixel per tile."""
+        return Image.fromarray(self.tiles.rgb, 'RGB')
+
+    def materialize(self, scale: Union[int, Tuple[int, int], None] = None) -> Image.Image:
+        """
+        Expand every tile to a block of pixels.
+
+        :param scale: Pixels per tile, an int or (x, y); None gives the size of the split image,
+                      identical to the former Image.NEAREST upscale
+        :return: RGB image
+        """
+        if scale is None:
+            columns, rows = self.tiles.shape
+            if (columns * self.tile_shape[0], rows * self.tile_shape[1]) != self.size:
+                # 图像尺寸不是色块的整数倍时各块宽度不一，沿用 Pillow 的最近邻缩放保证逐像素一致
+                return self.image.resize(self.size, Image.NEAREST)
+            scale = self.tile_shape
+        scale_x, scale_y = (scale, scale) if isinstance(scale, int) else scale
+        rgb = self.tiles.rgb
+        blocks = np.broadcast_to(rgb[:, None, :, None, :], (rgb.shape[0], scale_y, rgb.shape[1], scale_x, 3))
+        return Image.fromarray(blocks.reshape(rgb.shape[0] * scale_y, rgb.shape[1] * scale_x, 3), 'RGB')
+
+    def __array__(self, dtype=None, copy=None):
+        # 它不是 PIL 图像：np.asarray 否则会静默得到 0 维的 object 数组
+        raise TypeError("AveragedImage is not an image; call materialize() (or use .image) first")
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from core.block_reduce import block_mode, image_to_array, tile_blocks
+
+
+def legacy_mode(tile_pixels):
+    colors = list(map(tuple, tile_pixels.tolist()))
+    return max(set(colors), key=colors.count)
+
+
+@pytest.mark.parametrize('num_colors', [2, 3, 5, 16])
+@pytest.mark.parametrize('tile_pixels', [4, 6, 16])
+def test_block_mode_matches_legacy_ties(num_colors, tile_pixels):
+    # 颜色种类少、色块小，大多数色块都有并列的众数
+    rng = np.random.default_rng(num_colors * 100 + tile_pixels)
+    colors = rng.integers(0, 256, (num_colors, 3), dtype=np.uint8)
+    blocks = colors[rng.integers(0, num_colors, (500, tile_pixels))]
+    expected = np.array([legacy_mode(tile) for tile in blocks], dtype=np.uint8)
+    assert np.array_equal(block_mode(blocks), expected)
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA'])
+def test_block_mode_on_tiles_of_an_image(mode):
+    rng = np.random.default_rng(7)
+    pixels = (rng.integers(0, 4, (24, 36, len(mode))) * 60).astype(np.uint8)
+    blocks = tile_blocks(image_to_array(Image.fromarray(pixels, mode)), (3, 2))
+    expected = np.array([legacy_mode(tile) for tile in blocks], dtype=np.uint8)
+    assert np.array_equal(block_mode(blocks), expected)
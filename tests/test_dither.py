@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from core.dither import DIFFUSION_KERNELS, error_diffusion
+from core.palette import mardPalette
+
+
+def naive_error_diffusion(colors, color_palette, kernel, metric='redmean'):
+    """逐像素从左到右、从上到下扫描的误差扩散"""
+    height, width = colors.shape[:2]
+    values = colors[..., :3].astype(np.float32)
+    palette_rgb = color_palette.rgb.astype(np.float32)
+    shares = [(dy, dx, np.float32(weight / kernel.divisor)) for dy, dx, weight in kernel.weights]
+    indices = np.empty((height, width), dtype=np.intp)
+    for y in range(height):
+        for x in range(width):
+            current = values[y, x].copy()
+            pixel = (np.clip(current, 0, 255) + 0.5).astype(np.uint8)
+            index = color_palette.closest_colors(pixel[None], use_lut=False, use_index=False, metric=metric)[0]
+            indices[y, x] = index
+            error = current - palette_rgb[index]
+            for dy, dx, share in shares:
+                if y + dy < height and 0 <= x + dx < width:
+                    values[y + dy, x + dx] += error * share
+    return indices
+
+
+@pytest.mark.parametrize('kernel', list(DIFFUSION_KERNELS))
+@pytest.mark.parametrize('metric', ['redmean', 'cie76'])
+def test_error_diffusion_matches_naive_scan(kernel, metric):
+    rng = np.random.default_rng(3)
+    colors = rng.integers(0, 256, (9, 13, 3)).astype(np.uint8)
+    expected = naive_error_diffusion(colors, mardPalette, DIFFUSION_KERNELS[kernel], metric)
+    assert np.array_equal(error_diffusion(colors, mardPalette, DIFFUSION_KERNELS[kernel], metric), expected)
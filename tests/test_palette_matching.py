@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from core.hanlde_image import ColorPalette
+from core.palette import mardPalette
+from core.palette_index import INDEXED_METRICS, PaletteIndex
+
+
+def brute_force(color_palette, pixels, metric='redmean'):
+    return color_palette.closest_colors(pixels, use_lut=False, use_index=False, metric=metric)
+
+
+def sample_pixels(seed=0):
+    rng = np.random.default_rng(seed)
+    # 随机像素加上色板颜色本身及其 ±1 的邻居，距离相同的情况也覆盖到
+    neighbours = mardPalette.rgb.astype(np.int64)[:, None, :] + rng.integers(-1, 2, (len(mardPalette), 4, 3))
+    return np.concatenate([rng.integers(0, 256, (20000, 3)), mardPalette.rgb,
+                           np.clip(neighbours, 0, 255).reshape(-1, 3)]).astype(np.uint8)
+
+
+@pytest.mark.parametrize('metric', INDEXED_METRICS)
+@pytest.mark.parametrize('batch', [7, 3000, 24000])
+def test_palette_index_matches_brute_force(metric, batch):
+    pixels = sample_pixels()[:batch]
+    assert np.array_equal(PaletteIndex(mardPalette, metric).query(pixels), brute_force(mardPalette, pixels, metric))
+
+
+@pytest.mark.parametrize('cell_bits', [2, 5])
+def test_palette_index_cell_bits(cell_bits):
+    pixels = sample_pixels(1)
+    assert np.array_equal(PaletteIndex(mardPalette, 'redmean', cell_bits).query(pixels),
+                          brute_force(mardPalette, pixels))
+
+
+def test_exact_lut_matches_brute_force():
+    # 新建色板，不在共享的 mardPalette 上挂查找表
+    color_palette = ColorPalette([{'name': color.name, 'color': color.color_hex} for color in mardPalette.colors])
+    lut = color_palette.build_lut('exact', cache_dir=None)
+    pixels = sample_pixels(2)
+    assert np.array_equal(lut.lookup(pixels), brute_force(color_palette, pixels))
+    assert np.array_equal(color_palette.closest_colors(pixels), brute_force(color_palette, pixels))
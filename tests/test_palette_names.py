@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from core.hanlde_image import ColorPalette
+from core.palette import mardPalette
+from core.tile_grid import TileGrid
+
+DUPLICATED = [{'name': 'A1', 'color': '000000'}, {'name': 'A1', 'color': 'ffffff'}, {'name': 'A2', 'color': 'ff0000'}]
+
+
+def test_duplicate_names_keep_every_color():
+    color_palette = ColorPalette(DUPLICATED)
+    assert len(color_palette) == 3
+    assert color_palette.index_of('A1') == 0
+    assert color_palette.get_hex_from_name('A1') == '000000'
+
+
+def test_duplicate_names_strict():
+    with pytest.raises(ValueError, match='A1'):
+        ColorPalette(DUPLICATED, strict=True)
+
+
+def test_counts_sum_duplicate_names():
+    tiles = TileGrid(np.array([[2, 1], [0, 0]]), ColorPalette(DUPLICATED))
+    assert tiles.counts == {'A2': 1, 'A1': 3}
+
+
+def test_mard_palette_keeps_both_d6():
+    assert {'aa76e4', 'ab73ff'} <= {color.color_hex for color in mardPalette.colors if color.name == 'D6'}
@@ -0,0 +1,23 @@
+import pickle
+
+import numpy as np
+
+from core.palette import PALETTES
+from core.tile_grid import TileGrid
+
+
+def test_palette_pickle_round_trip():
+    color_palette = PALETTES['mard']
+    restored = pickle.loads(pickle.dumps(color_palette))
+    assert restored.colors == color_palette.colors
+    assert restored.palette_hash == color_palette.palette_hash
+    assert dict(restored.index_by_name) == dict(color_palette.index_by_name)
+    assert np.array_equal(restored.rgb, color_palette.rgb)
+
+
+def test_tile_grid_pickle_round_trip():
+    color_palette = PALETTES['mard']
+    tiles = TileGrid(np.arange(12).reshape(3, 4), color_palette)
+    restored = pickle.loads(pickle.dumps(tiles))
+    assert np.array_equal(restored.indices, tiles.indices)
+    assert restored.counts == tiles.counts